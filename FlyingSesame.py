@@ -1,21 +1,20 @@
-import sys
+import sys, argparse
 from PyQt5.QtWidgets import QApplication, QMainWindow, QAction, \
                             qApp, QDesktopWidget
 from PyQt5.QtCore import pyqtSlot
 from lib.MainWidget import MainWidget
 
 class pupil(QMainWindow):    
-    def __init__(self, height=500, width=500):
+    def __init__(self, height=500, width=500, replay_source=None, replay_rate=None, display_rate=15.0):
         super().__init__()
         self.H = 1400
         self.W = 1600
         
         # define main widget
-        self.main_widget = MainWidget()
+        self.main_widget = MainWidget(replay_source, replay_rate, display_rate)
         self.setCentralWidget(self.main_widget)
 
-        # define camera handle and functions
-        self.ic = self.main_widget.ic
+        # define camera backend
         self.camera = self.main_widget.camera
         self.initUI()
 
@@ -72,12 +71,7 @@ class pupil(QMainWindow):
 
     @pyqtSlot()
     def _selectdevice(self):
-        self.ic.IC_StopLive(self.main_widget.camera)
-        self.ic.IC_ShowDeviceSelectionDialog(None)
-
-        if self.ic.IC_IsDevValid(self.main_widget.camera):
-            self.ic.IC_StartLive(self.main_widget.camera, 0)
-            self.ic.IC_SaveDeviceStateToFile(self.camera, b'device.xml')
+        self.main_widget.camera.select_device()
     
     @pyqtSlot()
     def _launchDeepLabcCt(self):
@@ -92,14 +86,22 @@ class pupil(QMainWindow):
         self.main_widget._extract_pupil_size()
     @pyqtSlot()
     def _exitaction(self):
-        if self.ic.IC_IsDevValid(self.main_widget.camera):
-            self.ic.IC_StopLive(self.main_widget.camera)
-            self.ic.IC_ReleaseGrabber(self.main_widget.camera)
         self.main_widget.refresh_dev.stop()
+        self.main_widget.di_service.stop()
         self.main_widget.get_img.stop()
+        if self.main_widget.extraction is not None:
+            self.main_widget.extraction.stop()
+        self.main_widget.camera.close()
         qApp.quit()
 
 if __name__=='__main__':
-    app = QApplication(sys.argv)
-    ex = pupil()
+    parser = argparse.ArgumentParser(description='Pupilometry')
+    parser.add_argument('--replay', default=None, help='AVI file or image directory replayed instead of the camera')
+    parser.add_argument('--replay-rate', type=float, default=None, help='replay frame rate (Hz), as fast as possible if not given')
+    parser.add_argument('--display-rate', type=float, default=15.0,
+                        help='repaint rate (Hz) of the movie and the plot, the camera records at its own frame rate')
+    args, qt_args = parser.parse_known_args()
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    ex = pupil(replay_source=args.replay, replay_rate=args.replay_rate, display_rate=args.display_rate)
     sys.exit(app.exec_())
@@ -0,0 +1,114 @@
+import sys, os, argparse, glob, json, signal, threading, time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib'))
+
+from utils import LOGGING_CONFIG
+# console logs of the library go to stderr, stdout is kept for the json summary
+LOGGING_CONFIG['handlers']['info_console_handler']['stream'] = 'ext://sys.stderr'
+
+from lib.extraction import BatchExtractor, IMG_FORMATS
+from lib.workqueue import WorkQueue, run_worker
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Batch pupil size extraction from recorded sessions, without GUI')
+    parser.add_argument('patterns', nargs='*',
+                        help='glob patterns of sessions, image directories, .avi or .h5 files (e.g. "D:/data/**/Exp_*")')
+    parser.add_argument('--model', default=None, help='DeepLabCut model directory containing "pose_cfg.yaml"')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, half of the CPU cores if not given')
+    parser.add_argument('--chunk-size', type=int, default=256, help='number of frames in a shard of a worker')
+    parser.add_argument('--checkpoint-rows', type=int, default=1024, help='number of rows written to the disk at once')
+    parser.add_argument('--format', default='csv', choices=['csv', 'csv+npz'],
+                        help='csv : {session}.csv, csv+npz : columnar {session}.npz in addition')
+    parser.add_argument('--decoder', default='auto', choices=['auto', 'skimage', 'cv2', 'tifffile'], help='image decoder')
+    parser.add_argument('--no-resume', action='store_true', help='extract every frame again, ignoring the previous results')
+    parser.add_argument('--progress-interval', type=float, default=10, help='interval (sec) of progress lines on stderr, 0 to disable')
+    parser.add_argument('--queue', default=None,
+                        help='distribute the sessions through a work queue in this directory on shared storage and merge the results')
+    parser.add_argument('--work', default=None, help='run as a worker of the work queue in this directory')
+    parser.add_argument('--lease-timeout', type=float, default=300, help='seconds until a shard of a silent worker is given to another')
+    parser.add_argument('--poll-interval', type=float, default=10, help='seconds between polls of the work queue')
+    args = parser.parse_args()
+    if (args.work is None) and ((args.model is None) or (len(args.patterns)==0)):
+        parser.error('patterns and --model are required unless running as a worker (--work)')
+    return args
+
+def expand_patterns(patterns: list) -> list:
+    '''
+    paths matched by the glob patterns in order, without duplicates
+    '''
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern, recursive=True)) or ([pattern] if os.path.exists(pattern) else [])
+        for path in matched:
+            path = os.path.normpath(path)
+            if (os.path.isdir(path) or path.endswith(('.avi', '.h5'))) and (path not in paths):
+                paths.append(path)
+    return paths
+
+def _on_signal(cancel):
+    # interruption by user or job scheduler, finished chunks are kept and the next run resumes
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(sig, lambda *_: cancel())
+
+def run_queue_worker(args):
+    cancel = threading.Event()
+    _on_signal(cancel.set)
+    stats = run_worker(args.work, model_path=args.model, lease_timeout=args.lease_timeout,
+                        poll_interval=args.poll_interval, cancel=cancel)
+    print(json.dumps(stats), file=sys.stdout)
+    sys.exit(1 if (stats['failed'] or stats['cancelled']) else 0)
+
+def run_queue(args, paths: list):
+    if os.path.isfile(os.path.join(args.queue, 'queue.json')): # coordinator restarted, continue the existing queue
+        work_queue = WorkQueue(args.queue, args.lease_timeout)
+    else:
+        work_queue = WorkQueue.create(args.queue, args.model, paths, chunk_size=args.chunk_size, img_formats=IMG_FORMATS,
+                                        decoder=args.decoder, npz=args.format=='csv+npz', resume=not args.no_resume,
+                                        checkpoint_rows=args.checkpoint_rows, lease_timeout=args.lease_timeout)
+    cancel = threading.Event()
+    _on_signal(cancel.set)
+    def _progress(status: dict):
+        if args.progress_interval > 0:
+            print(json.dumps(status['shards']), file=sys.stderr, flush=True)
+
+    # the coordinator only reclaims expired leases and merges finished sessions, workers extract
+    stats = work_queue.wait(poll_interval=args.poll_interval, cancel=cancel, progress=_progress)
+    stats['paths'] = paths
+    print(json.dumps(stats), file=sys.stdout)
+    failed = any(session['state']=='failed' for session in stats['sessions'].values())
+    sys.exit(1 if (failed or stats['cancelled']) else 0)
+
+def main():
+    args = parse_args()
+    if args.work is not None:
+        return run_queue_worker(args)
+
+    paths = expand_patterns(args.patterns)
+    if len(paths)==0:
+        sys.exit('No session matches the patterns')
+    if args.queue is not None:
+        return run_queue(args, paths)
+
+    start_time = time.perf_counter()
+    last_report = [0.0]
+    def _progress(done: int, total: int):
+        now = time.perf_counter()
+        if (args.progress_interval > 0) and (now - last_report[0] >= args.progress_interval or done==total):
+            last_report[0] = now
+            elapsed = now - start_time
+            print(json.dumps({'done' : done, 'total' : total, 'elapsed' : elapsed,
+                                'fps' : done / elapsed if elapsed > 0 else 0.0}), file=sys.stderr, flush=True)
+
+    extractor = BatchExtractor(args.model, workers=args.workers, chunk_size=args.chunk_size, img_formats=IMG_FORMATS,
+                                decoder=args.decoder, npz=args.format=='csv+npz', resume=not args.no_resume,
+                                checkpoint_rows=args.checkpoint_rows, progress=_progress)
+    _on_signal(extractor.cancel)
+
+    stats = extractor.run(paths)
+    stats['paths'] = paths
+    print(json.dumps(stats), file=sys.stdout)
+    failed = any(session['state']=='failed' for session in stats['sessions'].values())
+    sys.exit(1 if (failed or stats['cancelled']) else 0)
+
+if __name__=='__main__':
+    main()
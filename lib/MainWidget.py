@@ -1,4 +1,4 @@
-import sys, os, shutil, ctypes, re, csv, time
+import sys, os, shutil, re, csv, time
 from PyQt5.QtWidgets import QFileDialog, QFileSystemModel, \
                             QInputDialog, QSplitter, QTreeView, QWidget, QPushButton, \
                             QHBoxLayout, QVBoxLayout, \
@@ -10,14 +10,12 @@ from PyQt5.QtGui import QFont, QPixmap, QDoubleValidator, QKeyEvent, \
                         QIntValidator, QPainter, QPen, QColor
 import pyqtgraph as pg
 
-from lib import tisgrabber as tis
 import numpy as np
 from skimage import io
 from datetime import datetime
-import cv2
 from dlclive import DLCLive, Processor
 from typing import Dict, List, Union
-from lib.utils import find_circle
+from lib.utils import metadata_row, pupil_row
 
 sys.path.append('./lib')
 if (sys.version_info.minor <= 7) and (sys.version_info.major==3): # add .dll search path for python 3.7 and older
@@ -29,12 +27,29 @@ logger = CustomLogger().info_logger
 
 
 
-from lib.SignalConnection import GetCamImage, RefreshDevState, TTLreceiver
-from lib.Automation.BDaq.InstantDiCtrl import InstantDiCtrl
+from lib.SignalConnection import GetCamImage, RefreshDevState, TTLreceiver, ExtractionThread
+from lib.camera import TisCamera, ReplayCamera
+from lib.buffers import TimeSeriesBuffer
+from lib.display import RenderScheduler, VideoView
+from lib.daq import DiInputService
 
 class MainWidget(QWidget):
-    def __init__(self):
+    def __init__(self, replay_source: Union[str, None]=None, replay_rate: Union[float, None]=None, display_rate: float=15.0):
+        '''
+        ----------
+        Input Args
+        -----------
+        replay_source : str or None
+            AVI file or image directory replayed instead of the camera, None uses the camera
+        replay_rate : float or None
+            replay frame rate (Hz), None replays as fast as possible
+        display_rate : float
+            repaint rate (Hz) of the movie and the plot, independent of the camera frame rate
+        '''
         super().__init__()
+        self.replay_source = replay_source
+        self.replay_rate = replay_rate
+        self.display_rate = display_rate
         
         # initialize and connect camera
         self._init_camera()
@@ -80,14 +95,15 @@ class MainWidget(QWidget):
         '''
         initialize and connect camera
         '''
-        # load library for camera control
-        # self.ic = ctypes.cdll.LoadLibrary('./lib/tisgrabber_x64.dll')
-        self.ic = ctypes.CDLL('./lib/tisgrabber_x64.dll')
-        tis.declareFunctions(self.ic)
-        self.ic.IC_InitLibrary(0)
+        # 'Callback' : driver pushes frames through IC_SetFrameReadyCallback
+        # 'Snap' : poll frames with IC_SnapImage
+        self.acquisition_mode = 'Callback'
 
         # connect camera
-        self.camera = tis.openDevice(self.ic)
+        if self.replay_source is None:
+            self.camera = TisCamera('./lib/tisgrabber_x64.dll', acquisition_mode=self.acquisition_mode)
+        else:
+            self.camera = ReplayCamera(self.replay_source, frame_rate=self.replay_rate, loop=True)
         self.max_fps = float(29.970000)
         self.min_fps = float(0.000001)
         self.frame_rate = 2
@@ -109,15 +125,27 @@ class MainWidget(QWidget):
         self.startPort = 2
         self.portCount = 1
 
-        try:
-            self.trig = InstantDiCtrl(self.dev_description)
-        except:
-            self.trig = None
+        # TTL detection, 'event' (DI change of state/interrupt), 'poll' or 'auto' (event if supported)
+        self.trigger_mode = 'auto'
+        self.trigger_sample_rate = 1000.0
+
+        # single sampler of the trigger device shared by the trigger wait, TTL termination and connection checks
+        self.di_service = DiInputService(self.dev_description, self.startPort, self.portCount,
+                                            mode=self.trigger_mode, sample_rate=self.trigger_sample_rate)
+        self.di_service.start()
 
     def _init_dynamic_plot_state(self):
         self.dynamic_plot = False
         self.fit_threshold = 0.9
 
+        # backpressure policy of the inference worker during recording, 'block', 'drop_oldest' or 'latest'
+        self.inference_policy = 'drop_oldest'
+        self.pupil_estimate = None
+        self.extraction = None # offline pupil extraction thread
+
+        # 'tiff' : one image file per frame, 'container' : single HDF5 file next to the experiment directory
+        self.storage = 'tiff'
+
     def _init_TTL_triggered_termination_receiver(self):
         self.TTLreceiver = TTLreceiver(self)
 
@@ -144,53 +172,48 @@ class MainWidget(QWidget):
 
     def _extract_pupil_size(self):
         '''
-        Extract pupil size from saved images
+        Extract pupil size from saved images, runs on the worker processes of ExtractionThread
         '''
+        if (self.extraction is not None) and self.extraction.isRunning():
+            reply = QMessageBox.question(self, 'Extraction in progress',
+                                            'Do you want to cancel the pupil size extraction?',
+                                            QMessageBox.Yes | QMessageBox.No)
+            if reply==QMessageBox.Yes:
+                self.extraction.stop()
+            return
+
         if not self.dynamic_plot:
             self._dlc_model()
+        if not hasattr(self, 'dlc_model_path'):
+            return
         QMessageBox.about(self, 'Select directories ', \
-                            f'Select directories containing pupil images')
+                            f'Select directories containing pupil images, session containers (.h5) or AVI files')
 
         dir_paths = self._get_dir_paths()
         
-        if len(dir_paths) > 0: # one or more directories are selected, execute the loop
-            for path in dir_paths:
-                img_names = [names for names in os.listdir(path) if names.endswith(self.img_formats)]
-                img_names = sorted(img_names, key=lambda x: int(x[:6]))
-
-                if len(img_names) > 0: # if no images, run the next loop
-                    pupil_data = []
-
-                    for idx, img_name in enumerate(img_names):
-                        img_data = {}
-                        img = io.imread(os.path.join(path, img_name))
-                        
-                        meta = self.parser.search(img_name)
-                        if meta==None:
-                            img_index = idx
-                        else:
-                            img_index = int(meta.group('index'))
-
-                        time_stamp = self._parse_timestamp(meta)
-                        
-                        self._metadatar_parsing(img_data, img_index, img_name, time_stamp) # save metadata
-                        dlc_output = self.dlclive.get_pose(img) # key points coordinate
-                        self._pupil_parsing(img_data, dlc_output)
-                        
-                        if idx==0:
-                            self.keys = img_data.keys()
-                        pupil_data.append(img_data)
-                    
-                    try:
-                        with open(f'{path}.csv', 'w', newline='') as f:
-                            writer = csv.DictWriter(f, fieldnames=self.keys)
-                            writer.writeheader()
-                            for row in pupil_data:
-                                writer.writerow(row)
-                    except:
-                        QMessageBox.about(self, 'Save error!', \
-                            f'Save error for "{os.path.basename(path)}" directory')
+        if len(dir_paths) > 0: # one or more directories are selected, execute the extraction
+            self.extraction = ExtractionThread(self, dir_paths)
+            self.extraction.extraction_progress.connect(self._update_extraction_progress)
+            self.extraction.extraction_finished.connect(self._extraction_finished)
+            self.extraction.start()
+
+    @pyqtSlot(int, int)
+    def _update_extraction_progress(self, done: int, total: int):
+        self.progress_check.setText(f'Extraction | {done:06d}/{total:06d}')
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
 
+    @pyqtSlot(dict)
+    def _extraction_finished(self, stats: Dict):
+        failed = [os.path.basename(name) for name, session in stats['sessions'].items() if session['state']=='failed']
+        if len(failed) > 0:
+            QMessageBox.about(self, 'Save error!', \
+                f'Extraction error for {", ".join(failed)}')
+
+        # reset the progress
+        self.progress_bar.setMaximum(self.frames)
+        self.progress_bar.setValue(0)
+        self.progress_check.setText(f'Progress | {0:06d}/{self.frames:06d}')
 
     def _get_dir_paths(self) -> List[str]:
         '''
@@ -251,19 +274,9 @@ class MainWidget(QWidget):
         time_stamp : None or datetime.datetime
             time stamp when image was acquired
         '''
-        # if no metadata, assign index depend on image name 
-        if time_stamp==None:
-            img_data['index'] = img_index
-            img_data['img_name'] = img_name
-            img_data['time_stamp'], img_data['time (sec)'] = '', ''
-        else:
-            if img_index==0: # if first image, save time stamp to get relative imaging time
-                self.first_time_stamp = time_stamp
-
-            img_data['index'] = img_index
-            img_data['img_name'] = img_name
-            img_data['time_stamp'] = datetime.strftime(time_stamp, '%Y-%m-%d_%H:%M:%S.%f')
-            img_data['time (sec)'] = (time_stamp - self.first_time_stamp).total_seconds() # relative imaging time
+        if (time_stamp is not None) and (img_index==0): # if first image, save time stamp to get relative imaging time
+            self.first_time_stamp = time_stamp
+        metadata_row(img_data, img_index, img_name, time_stamp, getattr(self, 'first_time_stamp', None))
 
     def _pupil_parsing(self, img_data: Dict, dlc_output: np.ndarray):
         '''
@@ -276,16 +289,7 @@ class MainWidget(QWidget):
         dlc_output : np.ndarray
             key points coordinates and probability
         '''
-        center, diameter, probability, num_points = find_circle(dlc_output) # dlc outputs
-        xc, yc = center # pupil center coordinates
-
-        for dlc_key, dlc_value in zip(self.dlc_keys, [num_points, xc, yc, diameter, probability]):
-            img_data[dlc_key] = dlc_value # store dlc output
-        
-        for idx, coords in enumerate(dlc_output): # extract key point coordinates
-            x, y, _ = coords
-            img_data[f'x{idx}'] = x # x-coordinate of n th key point 
-            img_data[f'y{idx}'] = y # y-coordinate of n th key point
+        pupil_row(img_data, dlc_output)
 
     # movie widget
     def _add_movie_widget(self):
@@ -294,14 +298,19 @@ class MainWidget(QWidget):
         connect widget to qthread for live imaging
         '''
         # generate display widget
-        self.display_label = QLabel(self)
-        self.display_label.setScaledContents(True)
-        self.display_label.resize(720, 1080)
+        self.display_view = VideoView(self)
+        self.display_view.resize(720, 1080)
+
+        # frames are coalesced and rendered at the display rate, the camera runs at its own rate
+        self.render_scheduler = RenderScheduler(self.display_rate, self)
+        self.render_scheduler.render.connect(self.display_image)
+        self.render_scheduler.tick.connect(self._refresh_plot)
+        self.render_scheduler.start()
 
         # generate thread and connect to display widget
         self.get_img = GetCamImage(self)
         self.get_img.start()
-        self.get_img.Pixmap_display.connect(self.display_image)
+        self._connect_display()
 
         # checkbox to show the fitted circle on pupil
         self.movie_frame.setFont(QFont('Arial', 12))
@@ -322,7 +331,7 @@ class MainWidget(QWidget):
         self.movie_layout.addWidget(self.show_circle, 1, 1, 1, 1)
         self.movie_layout.addWidget(self.set_thesh_label, 1, 5, 1, 4)
         self.movie_layout.addWidget(self.set_fit_threshold, 1, 9, 1, 2)
-        self.movie_layout.addWidget(self.display_label, 2, 1, 10, -1)
+        self.movie_layout.addWidget(self.display_view, 2, 1, 10, -1)
         self.movie_layout.addWidget(self.live_frame_rate, 12, 10, -1, 1)
     
     # graph widget
@@ -398,21 +407,30 @@ class MainWidget(QWidget):
 
     @pyqtSlot()
     def _rescale(self):
-        if (len(self.plot_data['x'])==0) and (len(self.plot_data['y'])==0):
+        if len(self.plot_data)==0:
             self.live_plot.setXRange(-5, 10)
             self.live_plot.setYRange(-5, 10)
         else:
-            xmin = self.plot_data['x'].min()
-            xmax = self.plot_data['x'].max()
-            ymin = self.plot_data['y'].min()
-            ymax = self.plot_data['y'].max()
+            xmin = self.plot_data.x[0]
+            xmax = self.plot_data.x[-1]
+            ymin = self.plot_data.y.min()
+            ymax = self.plot_data.y.max()
 
             self.live_plot.setXRange(xmin - np.abs(xmin)*0.05, xmax + np.abs(xmax)*0.05)
             self.live_plot.setYRange(ymin - np.abs(ymin)*0.05, ymax + np.abs(ymax)*0.05)
         self.live_plot.enableAutoRange()
 
     def _init_plot_data(self):
-        self.plot_data = {'x' : np.array([]), 'y' : np.array([]), 'y_avg' : np.array([])}
+        self.plot_data = TimeSeriesBuffer(avg_window=20)
+        self.plot_dirty = False
+
+    def _connect_display(self):
+        '''
+        connect the frame and pupil signals of the imaging thread
+        frames are handed to the render scheduler in the imaging thread (direct connection), not queued to the GUI thread
+        '''
+        self.get_img.Pixmap_display.connect(self.render_scheduler.submit, Qt.DirectConnection)
+        self.get_img.pupil_estimated.connect(self._pupil_estimated)
         
     def _dynamicplot_set(self, dynamic_plot_state: bool):
         '''
@@ -659,13 +677,14 @@ class MainWidget(QWidget):
 
     @pyqtSlot()
     def _resume_live_imaging(self):
-        if not self.ic.IC_IsDevValid(self.camera):
+        if not self.camera.is_valid():
             self._init_camera()
             self.get_img = GetCamImage(self)
-            self.get_img.Pixmap_display.connect(self.display_image)
+            self._connect_display()
 
         # initialize dynapic pupil size plot
         self._init_plot_data()
+        self.pupil_estimate = None
 
         # start live display  
         self.get_img.start()
@@ -735,26 +754,24 @@ class MainWidget(QWidget):
         self.recording_type='LiveDisplay'
         self._set_enable_inputs(True)
         self._dynamicplot_set(self.dynamic_plot)
-        self.video.release()
         logger.debug(f'Recording stop')
 
     @pyqtSlot()
     def _set_recording(self):
         # camera and trigger device connection check
-        if not self.ic.IC_IsDevValid(self.camera):
+        if not self.camera.is_valid():
             QMessageBox.about(self, 'Connection Error!', 'Connect camera')
 
-        elif self.trig is None:
+        elif not self.di_service.connected:
             QMessageBox.about(self, 'Connection Error!', 'Connect trigger device')
         
-        elif (not self.ic.IC_IsDevValid(self.camera)) and (self.trig is None):
+        elif (not self.camera.is_valid()) and (not self.di_service.connected):
             QMessageBox.about(self, 'Connection Error!', 'Connect camera and trigger device')
 
         # ready to receive TTL signal after all devices are connected
         else:
             # check whether the trigger device and TTL source are connected by BNC cable
-            _, data = self.trig.readAny(self.startPort, self.portCount)
-            if data==[255]:
+            if self.di_service.data==[255]:
                 QMessageBox.about(self, 'Connection Error!', 'Connect the trigger device to TTL source using BNC cable')
                 return
 
@@ -782,24 +799,8 @@ class MainWidget(QWidget):
 
             # make dir to save images
             self.tree_view.mk_exp_dir(self.parent_idx, save_dir_name)            
+            self.save_root = self.tree_view.model.filePath(self.parent_idx)
 
-            # if frame rate is larger than 15 Hz
-            # user have to select whether start recording with or without  monitoring
-            # if user want to monitor, the frame rate is set to 15 Hz 
-            if self.frame_rate > 15:
-                reply = QMessageBox.question(self, 'Notice!', 
-                                            'You can''t monitor the recording if the frame rate is larger than 15 Hz. \
-                                            Do you want to record without monitoring?',
-                                            QMessageBox.Yes | QMessageBox.No)
-                
-                # if yes, record movie without monitoring
-                if reply==QMessageBox.Yes:
-                    self.get_img.stop()
-                else:
-                    self.frame_rate = 15
-                    self.set_frame_rate.setText(f'{self.frame_rate:.6f}')
-                    self.set_frame_rate.completer()
-            
             # disable any button and input during trigger and dynamic plot setting
             self._set_enable_inputs(False)
             self._dynamicplot_set(False)
@@ -813,13 +814,7 @@ class MainWidget(QWidget):
             self.get_img.set_recording_mode()
             self.get_img.recording_termination.connect(self._stop_recording) # connect to recording stop signal
             self.get_img.recording_termination_TTL.connect(self._TTL_triggered_stop_recording) # connect TTL triggered recording termination 
-            self.get_img.save_img.connect(self._save_img)
-            self.get_img.Pixmap_display.connect(self.display_image)
-
-            # generate video
-            video_name = f'{self.tree_view.model.filePath(self.parent_idx)}/{self.tree_view.exp_name}.avi'
-            fourcc = cv2.VideoWriter_fourcc(*'MJPG') # set codec  
-            self.video = cv2.VideoWriter(video_name, fourcc, self.frame_rate, (self.img_width, self.img_height))
+            self.get_img.img_saved.connect(self._update_progress)
 
     @pyqtSlot()
     def _TTL_triggered_stop_recording(self):
@@ -830,7 +825,7 @@ class MainWidget(QWidget):
     @pyqtSlot()
     def _start_recording(self):
         # camera and trigger device connection check
-        if not self.ic.IC_IsDevValid(self.camera):
+        if not self.camera.is_valid():
             QMessageBox.about(self, 'Connection Error!', 'Connect camera')
 
         # ready to start recording after camera devices are connected
@@ -859,24 +854,8 @@ class MainWidget(QWidget):
 
             # make dir to save images
             self.tree_view.mk_exp_dir(self.parent_idx, save_dir_name)            
+            self.save_root = self.tree_view.model.filePath(self.parent_idx)
 
-            # if frame rate is larger than 15 Hz
-            # user have to select whether start recording with or without  monitoring
-            # if user want to monitor, the frame rate is set to 15 Hz 
-            if self.frame_rate > 15:
-                reply = QMessageBox.question(self, 'Notice!', 
-                                            'You can''t monitor the recording if the frame rate is larger than 15 Hz. \
-                                            Do you want to record without monitoring?',
-                                            QMessageBox.Yes | QMessageBox.No)
-                
-                # if yes, record movie without monitoring
-                if reply==QMessageBox.Yes:
-                    self.get_img.stop()
-                else:
-                    self.frame_rate = 15
-                    self.set_frame_rate.setText(f'{self.frame_rate:.6f}')
-                    self.set_frame_rate.completer()
-            
             # disable any button and input during trigger and dynamics plot setting
             self._set_enable_inputs(False)
             self._dynamicplot_set(False)
@@ -888,72 +867,22 @@ class MainWidget(QWidget):
             self.recording_type = 'Manual'
             self.get_img.set_recording_mode()
             self.get_img.recording_termination.connect(self._stop_recording)
-            self.get_img.save_img.connect(self._save_img)
-            self.get_img.Pixmap_display.connect(self.display_image)
+            self.get_img.img_saved.connect(self._update_progress)
 
-            # generate video
-            video_name = f'{self.tree_view.model.filePath(self.parent_idx)}/{self.tree_view.exp_name}.avi'
-            fourcc = cv2.VideoWriter_fourcc(*'MJPG') # set codec  
-            self.video = cv2.VideoWriter(video_name, fourcc, self.frame_rate, (self.img_width, self.img_height))
-
-    @pyqtSlot(dict)
-    def _save_img(self, live_signal: Dict):
+    @pyqtSlot(int)
+    def _update_progress(self, idx: int):
         '''
-        live_signal:
-            dictionary contain image and metadata
+        idx:
+            index of the image saved by the recording engine
         '''
-        idx = live_signal.get('index')
-        img = live_signal.get('image')
-        current_time = live_signal.get('time_stamp').strftime('%Y-%m-%d_%Hhr-%Mmin-%S.%fsec')
-        time_stamp = live_signal.get('time_stamp')
-        dlc_output = live_signal.get('dlc_output')
-
-        # set save path and image name
-        save_dir = f'{self.tree_view.model.filePath(self.parent_idx)}/{self.tree_view.exp_name}'        
-        img_name = f'{idx:06d}_{current_time}.tif'
-
         # update recording progress
         self.progress_check.setText(f'Progress | {idx+1:06d}/{self.frames:06d}')
         self.progress_bar.setValue(idx+1)
 
-        # save image
-        file_name = os.path.join(save_dir, img_name)
-        io.imsave(file_name, img)
-
-        # wirte video
-        self.video.write(img)
         if idx==(self.frames - 1):
-            self.video.release()
-
             # reset progress monitor
             self.progress_check.setText(f'Progress | {0:06d}/{self.frames:06d}')
 
-        
-        # save data (pupil size and metadata)
-        if self.show_circle.isChecked() and self.dynamic_plot:
-            live_img_data = {}
-            self._metadatar_parsing(live_img_data, idx, img_name, time_stamp)
-            self._pupil_parsing(live_img_data, dlc_output)
-
-            if idx==0:
-                self.keys = live_img_data.keys()
-            
-            try:
-                if not os.path.exists(f'{save_dir}.csv'):
-                    with open(f'{save_dir}.csv', 'w', newline='') as f:
-                        writer = csv.DictWriter(f, fieldnames=self.keys)
-                        writer.writeheader()
-                        writer.writerow(live_img_data)
-                else:
-                    with open(f'{save_dir}.csv', 'a', newline='') as f:
-                        writer = csv.DictWriter(f, fieldnames=self.keys)
-                        writer.writerow(live_img_data)
-
-            except:
-                QMessageBox.about(self, 'Save error!', \
-                    f'Save error for "{os.path.basename(file_name)}" directory')
-
-
     '''
     functions (slots) resppond to Thread
     '''
@@ -963,61 +892,77 @@ class MainWidget(QWidget):
         live_signal:
             dictionary contain image and metadata
         '''
-        center, diameter, img, fps, probability, dlc_output = (live_signal.get(key) for key in ['center', 'diameter', 'qimage', 'frame_rate', 'probability', 'dlc_output']) 
+        img, fps, inference, write_queue = (live_signal.get(key) for key in ['qimage', 'frame_rate', 'inference', 'write_queue'])
         
-        self.live_pixmap = QPixmap.fromImage(img)
-        self.live_pixmap.scaled(self.img_width, self.img_height, Qt.KeepAspectRatioByExpanding)
-        self.display_label.setPixmap(self.live_pixmap)
-        
-        # dynamic pupil fitting
+        # dynamic pupil fitting, draw the latest estimate from the inference worker as overlay
+        pupil = self.pupil_estimate
+        if self.show_circle.isChecked() and (pupil is not None) and (pupil['probability'] >= self.fit_threshold):
+            self.display_view.set_overlay(pupil['center'], pupil['diameter'], pupil['dlc_output'])
+        else:
+            self.display_view.set_overlay(None)
+
+        # the view paints the frame slot directly and holds the frame until the next one
+        self.display_view.set_frame(img, live_signal.get('frame'))
+
+        status = f'Frame rate : {fps:2.2f}'
+        if inference is not None:
+            status += f' | Inference queue : {inference["queue_depth"]} skipped : {inference["skipped"]}'
+        if write_queue is not None:
+            status += f' | Write queue : {write_queue}'
+        status += f' | Display : {self.display_rate:.0f} Hz render : {self.display_view.render_time_avg * 1000:.1f} ms'
+        self.live_frame_rate.setText(status)
+
+    @pyqtSlot(dict)
+    def _pupil_estimated(self, pupil: Dict):
+        '''
+        pupil fitting result from the inference worker
+        pupil:
+            dictionary contain frame index, time stamp and pupil fitting result
+        '''
+        self.pupil_estimate = pupil
+        center, diameter, probability = pupil['center'], pupil['diameter'], pupil['probability']
+
         if self.show_circle.isChecked() and (probability >= self.fit_threshold):
-            # plot pupil circle
-            painter = QPainter(self.display_label.pixmap())
-            painter.setPen(QPen(Qt.red, 1))
-            painter.drawEllipse(center[0] - diameter/2, center[1] - diameter/2, diameter, diameter)
-            
-            # plot key points
-            colors = ['#FF9900', '#33CC33', '#3399FF', '#FF3333']
-            for color, key_point in zip(colors, dlc_output):
-                painter.setPen(QPen(QColor(color), 4))
-                painter.drawPoint(key_point[0], key_point[1])
-            
             # get time stamp to calculate relative time
-            if (len(self.plot_data['x'])==0) and (len(self.plot_data['y'])==0):
-                self.ref_datetime = live_signal['time_stamp']
+            if len(self.plot_data)==0:
+                self.ref_datetime = pupil['time_stamp']
                 self._rescale()
 
-            # data plot
-            relative_time = float((live_signal['time_stamp'] - self.ref_datetime).total_seconds())
-            self.plot_data['x'] = np.append(self.plot_data['x'], relative_time)
-            self.plot_data['y'] = np.append(self.plot_data['y'], diameter)
-            self.plot_data['y_avg'] = np.append(self.plot_data['y_avg'], self.plot_data['y'][-20:].mean()) \
-                                    if len(self.plot_data['y']) >= 20 \
-                                    else np.append(self.plot_data['y_avg'], self.plot_data['y'].mean())
-
-            # Set plot range
-            if self.Xauto_rescale_checkbox.isChecked():
-                xmin = self.plot_data['x'][-self.num_plot_points] \
-                        if len(self.plot_data['x']) >= self.num_plot_points \
-                        else self.plot_data['x'][0]
-                xmax = self.plot_data['x'][-1]
-                self.live_plot.setXRange(xmin, xmax)
-                # self.live_plot.enableAutoRange(axis='x', enable=True)
-            if self.Yauto_rescale_checkbox.isChecked():
-                self.live_plot.enableAutoRange(axis='y', enable=True)
-
-            # update date
-            self.raw_data_item.setData(self.plot_data['x'], self.plot_data['y'])
-            self.avg_data_item.setData(self.plot_data['x'], self.plot_data['y_avg'])
-
-        self.live_frame_rate.setText(f'Frame rate : {fps:2.2f}')
+            # data plot, the plot is refreshed at the display rate
+            relative_time = float((pupil['time_stamp'] - self.ref_datetime).total_seconds())
+            self.plot_data.append(relative_time, diameter)
+            self.plot_dirty = True
+
+    @pyqtSlot()
+    def _refresh_plot(self):
+        '''
+        draw the pupil data appended since the last display tick
+        '''
+        if not self.plot_dirty:
+            return
+        self.plot_dirty = False
+
+        # Set plot range, only the visible points are sent to the plot
+        if self.Xauto_rescale_checkbox.isChecked():
+            visible = self.plot_data.last(self.num_plot_points)
+            self.live_plot.setXRange(self.plot_data.x[visible.start], self.plot_data.x[-1])
+        else:
+            (xmin, xmax), _ = self.live_plot.getViewBox().viewRange()
+            visible = self.plot_data.between(xmin, xmax)
+            # one more point on each side, so the average line reaches the edges of the view
+            visible = slice(max(visible.start - 1, 0), min(visible.stop + 1, len(self.plot_data)))
+        if self.Yauto_rescale_checkbox.isChecked():
+            self.live_plot.enableAutoRange(axis='y', enable=True)
+
+        # update date
+        self.raw_data_item.setData(self.plot_data.x[visible], self.plot_data.y[visible])
+        self.avg_data_item.setData(self.plot_data.x[visible], self.plot_data.y_avg[visible])
 
     @pyqtSlot(bool)
     def _connection_state_view(self, refresh: bool):
         if refresh:
             # Check camera connection state
-            camera = self.ic.IC_LoadDeviceStateFromFile(None, b'device.xml')
-            if self.ic.IC_IsDevValid(camera):
+            if self.camera.check_connection():
                 self.camera_connection_state_label.setText('Connected')
                 self.camera_connection_led.setStyleSheet("QLabel {background-color : green; border-color : black; \
                                                             border-style : default; border-width : 0px; \
@@ -1028,23 +973,13 @@ class MainWidget(QWidget):
                                                             border-style : default; border-width : 0px; \
                                                             border-radius : 19px; min-height: 3px; min-width: 5px}")
 
-            try:
-                self.trig = InstantDiCtrl(self.dev_description)
-                
-                if self.trig.device.location!=b'':
-                    self.trig_connection_state_label.setText('Connected')
-                    self.trig_connection_led.setStyleSheet("QLabel {background-color : green; border-color : black; \
-                                                            border-style : default; border-width : 0px; \
-                                                            border-radius : 19px; min-height: 3px; min-width: 5px}")
-                else:
-                    self.trig = None
-                    self.trig_connection_state_label.setText('Disconnected')
-                    self.trig_connection_led.setStyleSheet("QLabel {background-color : red; border-color : black; \
-                                                            border-style : default; border-width : 0px; \
-                                                            border-radius : 19px; min-height: 3px; min-width: 5px}")
-
-            except:
-                self.trig = None
+            # the trigger device is opened (and reopened) by the DI input service
+            if self.di_service.connected:
+                self.trig_connection_state_label.setText('Connected')
+                self.trig_connection_led.setStyleSheet("QLabel {background-color : green; border-color : black; \
+                                                        border-style : default; border-width : 0px; \
+                                                        border-radius : 19px; min-height: 3px; min-width: 5px}")
+            else:
                 self.trig_connection_state_label.setText('Disconnected')
                 self.trig_connection_led.setStyleSheet("QLabel {background-color : red; border-color : black; \
                                                         border-style : default; border-width : 0px; \
@@ -1,11 +1,13 @@
 from PyQt5.QtCore import pyqtSignal, QThread, pyqtSlot
 from PyQt5.QtGui import QImage
-from lib import tisgrabber as tis
 import numpy as np
-import ctypes, time
-from lib.utils import find_circle
-from typing import Tuple
-from datetime import datetime
+import time
+from lib.buffers import FrameHandle
+from lib.inference import InferenceWorker
+from lib.pacing import DeadlineScheduler
+from lib.engine import RecordingEngine, wait_for_ttl
+from lib.extraction import BatchExtractor
+from typing import Dict, List, Union
 
 from utils import CustomLogger
 
@@ -17,26 +19,22 @@ class GetCamImage(QThread):
 
     # signals triggered and manual recording mode
     recording_termination = pyqtSignal() # stop recording
-    save_img = pyqtSignal(dict) # save image
+    img_saved = pyqtSignal(int) # index of saved image
 
     recording_termination_TTL = pyqtSignal() # stop recording triggered by TTL
 
+    # pupil fitting result, emitted from the inference worker thread
+    pupil_estimated = pyqtSignal(dict)
+
     def __init__(self, parent):
         super().__init__(parent)
         self.parent = parent
-        self.camera = parent.camera
-        self.ic = parent.ic
-
-        self.Width = ctypes.c_long()
-        self.Height = ctypes.c_long()
-        self.BitsPerPixel = ctypes.c_int()
-        self.colorformat = ctypes.c_int()
+        self.camera = parent.camera # CameraBackend
         
         self.running = True
         
-        # moving avg filter for frame rate
-        # initial avg value is 30 Hz, sampling = 25
-        self.live_fps = np.ones(25)*30
+        # deadline based frame pacing and frame rate measurement
+        self.scheduler = DeadlineScheduler(self.parent.frame_rate)
 
         # container to store signal
         self.live_signal = {}
@@ -44,12 +42,35 @@ class GetCamImage(QThread):
         # triggered recording
         self.keep_recording = True
 
+        # pupil fitting stage
+        self.inference = None
+
+        # headless recording pipeline, GUI observes it
+        self.engine = None
+
     def run(self):
         if self.parent.recording_type=='LiveDisplay':
+            self._start_inference('latest')
             self.live_display_mode()
+            self._stop_inference(drain=False)
         elif self.parent.recording_type in ['Triggered', 'Manual']:
             self.recording_mode()
 
+    def _start_inference(self, policy: str):
+        '''
+        start the inference worker of live display if DeepLabCut model is loaded
+        '''
+        if not self.parent.dynamic_plot:
+            self.inference = None
+            return
+        self.inference = InferenceWorker(self.parent.dlclive, self.pupil_estimated.emit, policy=policy)
+        self.inference.start()
+
+    def _stop_inference(self, drain: bool):
+        if self.inference is not None:
+            self.inference.stop(drain=drain)
+            logger.debug(f'inference worker stopped {self.inference.stats()}')
+
     def resume(self):
         self.running = True
     
@@ -59,6 +80,8 @@ class GetCamImage(QThread):
     def stop(self):
         self.running = False
         self.keep_recording = False
+        if self.engine is not None:
+            self.engine.stop()
         self.quit()
         self.wait(10000)
     
@@ -68,154 +91,134 @@ class GetCamImage(QThread):
         self.keep_recording = True
         self.start()
 
-    def _ready_trigger(self):
+    def _ready_trigger(self) -> Union[int, None]:
         '''
-        ready TTL signal for triggered recording
-        Vmin = 0V, Vmax = 5V, duration > 200 ms
-        TTL on state, data = 255
-        TTL off state, data = 254
+        ready TTL signal for triggered recording, time.perf_counter_ns of the TTL signal or None if cancelled
         '''
-        self.outlier_check = np.array([0]*100) # to prevent outlier TTL signal, moving average filter
-
-        while self.running:
-            # receive TTL signal
-            # default data value = [254] when trigger receiving device is connected to the TTL source using BNC cable
-            _, data = self.parent.trig.readAny(self.parent.startPort, self.parent.portCount)
-            
-            self.outlier_check[:-1] = self.outlier_check[1:]
-            self.outlier_check[-1] = data[0]-254
-            
-            # when the device receive TTL signal, the data value becaomes [255]  
-            if data==[255] and (self.outlier_check.sum() >= 25):
-                self.running = False
+        return wait_for_ttl(self.parent.di_service, lambda: self.running)
 
     def _ready_camera(self):
         # start camera for live
-        self.ic.IC_StartLive(self.camera, 0)
-
-        # Query the values
-        self.ic.IC_GetImageDescription(self.camera, self.Width, self.Height, self.BitsPerPixel, self.colorformat)
-        
-        # Calculate the buffer size    
-        self.bpp = int(self.BitsPerPixel.value / 8.0 )
-        self.buffer_size = self.Width.value * self.Height.value * self.BitsPerPixel.value
-
-    def _get_sanp(self) -> np.ndarray:
-        # Get the image data
-        imagePtr =  self.ic.IC_GetImagePtr(self.camera)
-        imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_ubyte * self.buffer_size))
-
-        # Create the numpy array
-        img = np.ndarray(buffer = imagedata.contents,
-                dtype = np.uint8,
-                shape = (self.Height.value,
-                        self.Width.value,
-                        self.bpp))
+        self.camera.start(self.parent.frame_rate)
+        self.scheduler.set_frame_rate(self.parent.frame_rate)
+        self.scheduler.start()
 
-        # correct channel order                                
-        img[:, :, :] = img[:, :, ::-1]
-
-        # qimage for display
-        qimage = QImage(img.data, img.shape[1], img.shape[0], img.strides[0],  QImage.Format_RGB888)
-
-        return img, qimage
-    
-    def _get_circle(self, img: np.ndarray) -> Tuple[float, float, float, np.ndarray]:
+    def _pace(self, index: Union[int, None]=None) -> int:
         '''
+        wait for the deadline of frame if the camera doesn't pace the frames itself
+
         ----------
-        Input Args
+        Return
         -----------
-        img : ndarray (2D image, width x height)
-            2D numpy array image  
+        lateness : int
+            time (ns) the deadline was already passed, 0 for self paced camera
+        '''
+        if self.camera.self_paced:
+            return 0
+        return self.scheduler.wait(index)
+
+    def _frame_signal(self, handle: FrameHandle, frame_data: Dict) -> Dict:
+        '''
+        make a new signal dictionary for one consumer
+        every consumer gets its own frame handle, the slot is released when all consumers release it
 
         ----------
-        Return
+        Input Args
         -----------
-        center : np.ndarray
-            x, y coordinates for center of circle
-        diameter : np.float
-            diameter of circle
-        probability : float
-            averaged key point recognition probability
-        dlc_output : np.ndarray (dimension - No. key points * [x, y, probability])
-            key points coordinate and probability  
+        handle : FrameHandle
+            frame in the ring buffer
+        frame_data : dict
+            pupil fitting results and metadata of the frame
         '''
-        dlc_output = self.parent.dlclive.get_pose(img)
-        center, diameter, probability, _ = find_circle(dlc_output)
-        return center, diameter, probability, dlc_output
-
-    def _mov_avg_fps(self, start_time: float, end_time: float) -> float:
-        imaging_duration = end_time - start_time
-        fps = 0 if imaging_duration <= 0 else 1/imaging_duration
-        self.live_fps[0:-1] = self.live_fps[1:]
-        self.live_fps[-1] = fps
-        return self.live_fps.mean()
-
-    def _wait_imaging(self, start_time: float, end_time: float, frame_rate: float):
+        frame = handle.share()
+        img = frame.image
+        signal = dict(frame_data)
+        signal['frame'] = frame
+        signal['image'] = img
+        signal['qimage'] = QImage(img.data, img.shape[1], img.shape[0], img.strides[0],  QImage.Format_RGB888)
+        signal['time_stamp'] = handle.time_stamp
+        signal['frame_number'] = handle.frame_number
+        return signal
+
+    def _process_frame(self, handle: FrameHandle, frame_data: Dict):
         '''
-        make delay to adjust imaging spped
+        emit the frame to the display slot and queue it for pupil fitting
+        the pupil fitting result is emitted later by pupil_estimated signal
         '''
-        capture_duration = end_time - start_time
+        if self.camera.self_paced:
+            self.scheduler.tick() # measure frame rate only, the camera paces the frames
+        if self.inference is not None:
+            frame_data['inference'] = self.inference.stats()
 
-        # give time delay to adjust frame rate
-        if capture_duration < (1 / frame_rate):
-            sleep_time = (1/frame_rate) - capture_duration
-            time.sleep(sleep_time)
+        self._display_frame(handle, frame_data)
 
+        if (self.inference is not None) and self.parent.show_circle.isChecked(): # check dynamic pupil size measurements
+            self.inference.submit(handle.share())
+        handle.release()
+
+    def _display_frame(self, handle: FrameHandle, frame_data: Dict):
+        self.live_signal = self._frame_signal(handle, frame_data)
+        self.Pixmap_display.emit(self.live_signal) # emit image signal to display
+    
     def live_display_mode(self):
         self._ready_camera()
         
         while self.running:
-            loop_start = time.time() # loop starting time
-            if self.ic.IC_SnapImage(self.camera, 2000) == tis.IC_SUCCESS:
-                # get image from camera
-                img, self.live_signal['qimage'] = self._get_sanp()
-                self.live_signal['time_stamp'] = datetime.now() 
-                
-                if self.parent.show_circle.isChecked(): # check dynamic pupil size measurements
-                    # get center and diameter of pupil
-                    self.live_signal['center'], self.live_signal['diameter'], self.live_signal['probability'], self.live_signal['dlc_output'] = self._get_circle(img) 
-
-            loop_end = time.time() # imaging end time
-            self._wait_imaging(loop_start, loop_end, self.parent.frame_rate) # wait to adjust imaging speed
-            
-            wait_end = time.time() # loop end time (total duration = imaging time + waiting time)
-            self.live_signal['frame_rate'] = self._mov_avg_fps(loop_start, wait_end) # get frame rate
-            self.Pixmap_display.emit(self.live_signal) # emit image signal to display
-
-    def recording_mode(self):
-        if self.parent.recording_type=='Triggered':
-            self._ready_trigger()
-        self._ready_camera()
-
-        self.recording_termination_TTL.emit() # start TTL receiver that terminate recording  
+            # frame rate can be changed during live display
+            if self.scheduler.frame_rate!=self.parent.frame_rate:
+                self.scheduler.set_frame_rate(self.parent.frame_rate)
 
-        for idx in range(self.parent.frames):
-            loop_start = time.time() # loop starting time
-            if not self.keep_recording:
-                return
+            self._pace() # wait to adjust imaging speed
 
-            if self.ic.IC_SnapImage(self.camera, 2000) == tis.IC_SUCCESS:
-                # Get the image data
-                img, self.live_signal['qimage'] = self._get_sanp()
-                self.live_signal['time_stamp'] = datetime.now()
+            # get the most recent image from camera
+            handle = self.camera.next_frame(latest=True)
+            if handle is not None:
+                self._process_frame(handle, {'frame_rate' : self.scheduler.measured_frame_rate})
 
-                if self.parent.show_circle.isChecked(): # check dynamic pupil size measurements
-                    # get center and diameter of pupil
-                    self.live_signal['center'], self.live_signal['diameter'], _, self.live_signal['dlc_output'] = self._get_circle(img) 
+        self.camera.stop()
 
-            loop_end = time.time() # imaging end time
-            self._wait_imaging(loop_start, loop_end, self.parent.frame_rate) # wait to adjust imaging speed
-            
-            wait_end = time.time() # loop end time (total duration = imaging time + waiting time)
-            self.live_signal['frame_rate'] = self._mov_avg_fps(loop_start, wait_end) # get frame rate
-            self.live_signal['index'] = idx
-            self.live_signal['image'] = img
+    def recording_mode(self):
+        '''
+        run the headless recording engine and observe it
+        '''
+        wait_trigger = self._ready_trigger if self.parent.recording_type=='Triggered' else None
+        dlclive = self.parent.dlclive if (self.parent.dynamic_plot and self.parent.show_circle.isChecked()) else None
+
+        self.engine = RecordingEngine(self.camera, self.parent.save_root, self.parent.tree_view.exp_name,
+                                        self.parent.frames, self.parent.frame_rate,
+                                        dlclive=dlclive, inference_policy=self.parent.inference_policy,
+                                        wait_trigger=wait_trigger, storage=self.parent.storage,
+                                        di_service=self.parent.di_service if self.parent.di_service.connected else None)
+        self.engine.add_observer(on_started=self.recording_termination_TTL.emit, # start TTL receiver that terminate recording
+                                    on_frame=self._display_frame,
+                                    on_saved=self.img_saved.emit,
+                                    on_pupil=self.pupil_estimated.emit)
+        self.engine.run()
+        self.engine = None
+
+        if self.keep_recording:
+            self.recording_termination.emit()
+
+class ExtractionThread(QThread):
+    # offline pupil extraction progress, (extracted frames, total frames)
+    extraction_progress = pyqtSignal(int, int)
+    extraction_finished = pyqtSignal(dict) # extraction statistics
+
+    def __init__(self, parent, dir_paths: List[str]):
+        super().__init__(parent)
+        self.parent = parent
+        self.dir_paths = dir_paths
+        self.extractor = BatchExtractor(parent.dlc_model_path, img_formats=parent.img_formats,
+                                        progress=self.extraction_progress.emit)
 
-            self.Pixmap_display.emit(self.live_signal) # emit image signal to display
-            self.save_img.emit(self.live_signal) # emit image signal to save
+    def run(self):
+        stats = self.extractor.run(self.dir_paths)
+        logger.debug(f'pupil extraction finished {stats}')
+        self.extraction_finished.emit(stats)
 
-        self.recording_termination.emit()
+    def stop(self):
+        self.extractor.cancel()
+        self.wait(60000)
 
 class TTLreceiver(QThread):
     triggered_termination = pyqtSignal()
@@ -236,28 +239,18 @@ class TTLreceiver(QThread):
 
         time.sleep(2) # wait 2s during TTL keeps high (5V) state
 
-        self.outlier_check = np.array([0]*100) # to prevent outlier TTL signal, moving average filter
-
-        while self.keep_recording:
-            # receive TTL signal
-            # default data value = [254] when trigger receiving device is connected to the TTL source using BNC cable
-            _, data = self.parent.trig.readAny(self.parent.startPort, self.parent.portCount)
-            
-            self.outlier_check[:-1] = self.outlier_check[1:]
-            self.outlier_check[-1] = data[0]-254
-            
-            # when the device receive TTL signal, the data value becaomes [255]  
-            if data==[255] and (self.outlier_check.sum() >= 25):
-                logger.debug(f'TTL received')
-                self.triggered_termination.emit()
-                self.keep_recording = False
-                logger.debug(f'signal emit and stop the receiving')
+        # edges from the shared DI input service, the thread sleeps until the TTL signal
+        if wait_for_ttl(self.parent.di_service, lambda: self.keep_recording):
+            logger.debug(f'TTL received')
+            self.triggered_termination.emit()
+            self.keep_recording = False
+            logger.debug(f'signal emit and stop the receiving')
 
     def pause(self):
-        self.running = False
+        self.keep_recording = False
 
     def stop(self):
-        self.running = False
+        self.keep_recording = False
         self.quit()
         self.wait(10000)
 
@@ -0,0 +1,128 @@
+import ctypes, queue, time
+import numpy as np
+from datetime import datetime
+from typing import Union
+
+from lib.buffers import FrameRingBuffer, FrameHandle
+
+class FrameCallbackGrabber():
+    '''
+    Callback driven frame acquisition
+    the driver pushes every frame into a bounded queue through IC_SetFrameReadyCallback,
+    so capture no longer runs in lockstep with the processing loop
+
+    queued item : FrameHandle
+        frame_number : frame counter reported by the driver
+        time_stamp : time when the callback received the frame
+        image : read-only RGB view of the ring buffer slot
+    '''
+    def __init__(self, ic, camera, queue_size: int=64, buffer_capacity: int=96):
+        self.ic = ic
+        self.camera = camera
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.buffer_capacity = buffer_capacity
+        self.frame_buffer = None
+
+        self.Width = ctypes.c_long()
+        self.Height = ctypes.c_long()
+        self.BitsPerPixel = ctypes.c_int()
+        self.colorformat = ctypes.c_int()
+
+        # keep the reference of the ctypes callback, otherwise the driver calls freed memory
+        self._callback = self.ic.FRAMEREADYCALLBACK(self._frame_ready)
+        self.active = False
+        self.received = 0
+        self.dropped = 0
+        self.last_frame_number = None
+
+    def start(self, frame_rate: Union[float, None]=None):
+        '''
+        register the callback and start the live mode
+        ----------
+        Input Args
+        -----------
+        frame_rate : float or None
+            frame rate requested to the device, the device default is used if None
+        '''
+        self.ic.IC_SetFrameReadyCallback(self.camera, self._callback, None)
+        self.ic.IC_SetContinuousMode(self.camera, 0) # 0 : call the callback for every frame
+        if frame_rate is not None:
+            self.ic.IC_SetFrameRate(self.camera, ctypes.c_float(frame_rate))
+
+        # image description has to be fixed before the first callback
+        self.ic.IC_PrepareLive(self.camera, 0)
+        self.ic.IC_GetImageDescription(self.camera, self.Width, self.Height, self.BitsPerPixel, self.colorformat)
+        self.bpp = int(self.BitsPerPixel.value / 8.0)
+        self.shape = (self.Height.value, self.Width.value, self.bpp)
+        self.buffer_size = self.Height.value * self.Width.value * self.bpp
+        if (self.frame_buffer is None) or (self.frame_buffer.shape!=self.shape):
+            self.frame_buffer = FrameRingBuffer(self.buffer_capacity, self.shape)
+
+        self.active = True
+        self.ic.IC_StartLive(self.camera, 0)
+
+    def stop(self):
+        self.active = False
+        self.ic.IC_StopLive(self.camera)
+
+    def _frame_ready(self, hGrabber, pBuffer, framenumber, pData):
+        '''
+        called from the driver thread, copy the frame and return as fast as possible
+        '''
+        if not self.active:
+            return
+
+        capture_ns = time.perf_counter_ns()
+        time_stamp = datetime.now()
+        buffer = ctypes.cast(pBuffer, ctypes.POINTER(ctypes.c_ubyte * self.buffer_size)).contents
+        self.received += 1
+        self.last_frame_number = int(framenumber)
+
+        # driver buffer is reused for the next frame, copy once into the ring while correcting the channel order
+        src = np.frombuffer(buffer, dtype=np.uint8).reshape(self.shape)
+        handle = self.frame_buffer.write(src, int(framenumber), time_stamp, flip_channels=True, capture_ns=capture_ns)
+        if handle is None: # every slot is still used by consumers
+            self.dropped += 1
+            return
+
+        # drop the oldest frame if the consumer can't keep up
+        while True:
+            try:
+                self.frames.put_nowait(handle)
+                break
+            except queue.Full:
+                try:
+                    self.frames.get_nowait().release()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: float=2.0) -> Union[FrameHandle, None]:
+        '''
+        get the next frame in acquisition order, None if no frame arrived within timeout
+        '''
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_latest(self, timeout: float=2.0) -> Union[FrameHandle, None]:
+        '''
+        get the most recent frame and discard the older ones (live display)
+        '''
+        frame = self.get(timeout)
+        while frame is not None:
+            try:
+                newer = self.frames.get_nowait()
+            except queue.Empty:
+                break
+            frame.release()
+            frame = newer
+        return frame
+
+    def clear(self):
+        while True:
+            try:
+                self.frames.get_nowait().release()
+            except queue.Empty:
+                break
@@ -0,0 +1,179 @@
+import os, csv
+import numpy as np
+from datetime import datetime
+from typing import Dict, List, Tuple, Union
+
+from lib.utils import parse_column, read_ttl_timeline
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+ALIGN_METHODS = ('interp', 'mean')
+MINUTE_NS = 60 * 10**9
+
+def load_pupil_table(session: str, columns: Tuple[str, ...]=('time_stamp', 'diameter', 'probability')) -> Dict[str, np.ndarray]:
+    '''
+    columns of the pupil data of a session, from the columnar file ({session}.npz) if it exists, otherwise the CSV file
+
+    ----------
+    Input Args
+    -----------
+    session : str
+        session name, path of the results without extension, e.g. "D:/data/Exp_0000"
+    columns : tuple of str
+        columns to load, time_stamp is loaded as str and the others as float64
+
+    ----------
+    Return
+    -----------
+    table : dict
+        column name -> np.ndarray
+    '''
+    if os.path.isfile(f'{session}.npz'):
+        with np.load(f'{session}.npz') as npz:
+            return {key : npz[key] if key=='time_stamp' else npz[key].astype(np.float64) for key in columns}
+
+    with open(f'{session}.csv', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        positions = [header.index(key) for key in columns]
+        values = list(zip(*[[row[position] for position in positions] for row in reader]))
+    if len(values)==0:
+        values = [[] for _ in columns]
+    return {key : np.array(column, dtype=str) if key=='time_stamp' else parse_column(column, np.dtype(np.float64))
+            for key, column in zip(columns, values)}
+
+def parse_time_stamps(time_stamps: np.ndarray) -> np.ndarray:
+    '''
+    time stamps of the pupil data (FRAME_TABLE_TIME_FORMAT, local time) -> datetime64[ns], empty time stamps become NaT
+    '''
+    time_stamps = np.char.replace(np.asarray(time_stamps, dtype=str), '_', 'T')
+    return time_stamps.astype('datetime64[us]').astype('datetime64[ns]')
+
+def load_ttl_onsets(session: str) -> np.ndarray:
+    '''
+    rising edges of the TTL timeline ({session}.ttl.bin) as datetime64[ns] in local time, the clock of the frame time stamps
+    '''
+    edges = read_ttl_timeline(f'{session}.ttl.bin')
+    time_ns = edges['time_ns'][edges['rising']==1]
+    if len(time_ns)==0:
+        return time_ns.astype('datetime64[ns]')
+    # frames are stamped by datetime.now() (naive local time), the timeline holds ns since the epoch,
+    # the UTC offset is looked up for every minute with edges, so edges after a DST change get the new offset
+    minutes, inverse = np.unique(time_ns // MINUTE_NS, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(minute * 60).astimezone().utcoffset().total_seconds() for minute in minutes])
+    return (time_ns + (offsets * 1e9).astype(np.int64)[inverse]).astype('datetime64[ns]')
+
+def valid_mask(diameter: np.ndarray, probability: np.ndarray, fit_threshold: float=0.9) -> np.ndarray:
+    '''
+    frames with a reliable pupil fitting, the same rule as the circle display (probability >= fit_threshold),
+    blinks and failed fittings (non finite or non positive diameter) are masked out
+    '''
+    with np.errstate(invalid='ignore'):
+        return (probability >= fit_threshold) & np.isfinite(diameter) & (diameter > 0)
+
+def align_to_onsets(frame_times: np.ndarray, values: np.ndarray, valid: np.ndarray, onsets: np.ndarray,
+                        method: str='interp', tr: Union[float, None]=None, max_gap: Union[float, None]=None) -> np.ndarray:
+    '''
+    resample a pupil trace onto the volume onsets
+
+        'interp' : linear interpolation of the valid frames at each onset
+        'mean' : average of the valid frames in [onset_i, onset_i+1), the last volume lasts tr
+
+    ----------
+    Input Args
+    -----------
+    frame_times : np.ndarray (datetime64)
+        time stamps of the frames, NaT frames are ignored
+    values : np.ndarray
+        pupil trace, e.g. diameter
+    valid : np.ndarray (bool)
+        frames to use (valid_mask)
+    onsets : np.ndarray (datetime64)
+        volume onsets (TTL rising edges)
+    method : str
+        'interp' or 'mean'
+    tr : float or None
+        repetition time (sec), the median onset interval if None
+    max_gap : float or None
+        'interp' only, onsets between valid frames farther apart than max_gap (sec) are nan (e.g. blinks), None bridges any gap
+
+    ----------
+    Return
+    -----------
+    aligned : np.ndarray (num_onsets, )
+        pupil trace per volume, nan where no valid frame supports the volume
+    '''
+    assert method in ALIGN_METHODS, f'method must be one of {ALIGN_METHODS}'
+    onset_ns = onsets.astype('datetime64[ns]').astype(np.int64)
+    aligned = np.full(len(onset_ns), np.nan)
+    if len(onset_ns)==0:
+        return aligned
+
+    frame_ns = frame_times.astype('datetime64[ns]')
+    use = valid & ~np.isnat(frame_ns)
+    frame_ns, values = frame_ns[use].astype(np.int64), values[use].astype(np.float64)
+    order = np.argsort(frame_ns, kind='stable')
+    frame_ns, values = frame_ns[order], values[order]
+    if len(frame_ns)==0:
+        return aligned
+
+    if method=='interp':
+        # times relative to the first onset keep the float64 precision
+        times = (frame_ns - onset_ns[0]) / 1e9
+        targets = (onset_ns - onset_ns[0]) / 1e9
+        aligned = np.interp(targets, times, values, left=np.nan, right=np.nan)
+        if (max_gap is not None) and (len(times) > 1):
+            right = np.searchsorted(times, targets, side='left') # first frame at or after the onset
+            inner = (right > 0) & (right < len(times))
+            right = np.clip(right, 1, len(times) - 1)
+            gap = times[right] - times[right - 1]
+            exact = (times[right]==targets) | (times[right - 1]==targets)
+            aligned[inner & ~exact & (gap > max_gap)] = np.nan
+        return aligned
+
+    if tr is None:
+        tr = float(np.median(np.diff(onset_ns))) / 1e9 if len(onset_ns) > 1 else np.nan
+    if np.isnan(tr):
+        raise ValueError('tr is required to average a single volume')
+    edges = np.append(onset_ns, onset_ns[-1] + int(round(tr * 1e9)))
+    bins = np.searchsorted(edges, frame_ns, side='right') - 1
+    inside = (bins >= 0) & (bins < len(onset_ns))
+    sums = np.bincount(bins[inside], weights=values[inside], minlength=len(onset_ns))
+    counts = np.bincount(bins[inside], minlength=len(onset_ns))
+    np.divide(sums, counts, out=aligned, where=counts > 0)
+    return aligned
+
+def align_session(session: str, column: str='diameter', fit_threshold: float=0.9, method: str='interp',
+                    tr: Union[float, None]=None, max_gap: Union[float, None]=None) -> np.ndarray:
+    '''
+    pupil trace of a recorded session per MRI volume, see align_to_onsets
+
+    ----------
+    Input Args
+    -----------
+    session : str
+        session name, path of the results without extension ({session}.csv or .npz and {session}.ttl.bin)
+    column : str
+        pupil column to align
+    fit_threshold : float
+        frames with lower key point probability are masked out
+    '''
+    table = load_pupil_table(session, tuple(dict.fromkeys(('time_stamp', column, 'probability'))))
+    valid = valid_mask(table[column], table['probability'], fit_threshold)
+    return align_to_onsets(parse_time_stamps(table['time_stamp']), table[column], valid, load_ttl_onsets(session),
+                            method=method, tr=tr, max_gap=max_gap)
+
+def align_sessions(sessions: List[str], **kwargs) -> Dict[str, np.ndarray]:
+    '''
+    align_session of many sessions, session -> pupil trace per volume
+    sessions without pupil data or TTL timeline are skipped with a warning
+    '''
+    aligned = {}
+    for session in sessions:
+        try:
+            aligned[session] = align_session(session, **kwargs)
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f'{session} is not aligned : {e}')
+    return aligned
@@ -0,0 +1,198 @@
+import threading, time
+import numpy as np
+from collections import deque
+from datetime import datetime
+from typing import Tuple, Union
+
+class FrameHandle():
+    '''
+    Reference to a frame slot in FrameRingBuffer
+    every consumer holds its own handle and the slot returns to the ring
+    when all handles are released (explicitly or when garbage collected)
+
+        time_stamp : acquisition time (datetime.now(), wall clock for the saved data)
+        capture_ns : acquisition time (time.perf_counter_ns(), monotonic for intervals between frames)
+    '''
+    def __init__(self, ring, slot: int, frame_number: int, time_stamp: datetime, capture_ns: int):
+        self.ring = ring
+        self.slot = slot
+        self.frame_number = frame_number
+        self.time_stamp = time_stamp
+        self.capture_ns = capture_ns
+        self.released = False
+
+    @property
+    def image(self) -> np.ndarray:
+        '''
+        read-only view of the frame slot, no copy
+        '''
+        return self.ring.view(self.slot)
+
+    def share(self) -> 'FrameHandle':
+        '''
+        make a new handle for another consumer of the same frame
+        '''
+        self.ring.retain(self.slot)
+        return FrameHandle(self.ring, self.slot, self.frame_number, self.time_stamp, self.capture_ns)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.ring.release(self.slot)
+
+    def __del__(self):
+        self.release()
+
+class FrameRingBuffer():
+    '''
+    Fixed capacity ring of preallocated frame slots
+    the driver buffer is copied once into a free slot and consumers read the slot through FrameHandle,
+    so the memory is bounded and no array is allocated per frame
+    '''
+    def __init__(self, capacity: int, shape: Tuple[int, ...], dtype=np.uint8):
+        '''
+        ----------
+        Input Args
+        -----------
+        capacity : int
+            number of frame slots
+        shape : tuple
+            shape of single frame, (height, width, channels)
+        dtype : numpy dtype
+            data type of frame
+        '''
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self._frames = np.zeros((capacity,) + self.shape, dtype=dtype)
+        self._refcount = np.zeros(capacity, dtype=np.int64)
+        self._free = deque(range(capacity))
+        self._lock = threading.Lock()
+
+        # read-only views are made once and reused for every frame
+        self._views = []
+        for slot in range(capacity):
+            view = self._frames[slot].view()
+            view.flags.writeable = False
+            self._views.append(view)
+
+        self.written = 0
+        self.overrun = 0 # frames dropped because every slot was in use
+
+    def write(self, src: np.ndarray, frame_number: int, time_stamp: datetime, flip_channels: bool=False,
+                capture_ns: Union[int, None]=None) -> Union[FrameHandle, None]:
+        '''
+        copy a frame into a free slot
+
+        ----------
+        Input Args
+        -----------
+        src : np.ndarray
+            frame to copy, it can be a view over the driver buffer
+        frame_number : int
+            frame counter
+        time_stamp : datetime.datetime
+            acquisition time
+        flip_channels : bool
+            reverse the channel order while copying (BGR -> RGB)
+        capture_ns : int or None
+            acquisition time (time.perf_counter_ns), now if None
+
+        ----------
+        Return
+        -----------
+        handle : FrameHandle or None
+            handle owned by the caller, None if every slot is in use
+        '''
+        capture_ns = time.perf_counter_ns() if capture_ns is None else capture_ns
+        with self._lock:
+            if len(self._free)==0:
+                self.overrun += 1
+                return None
+            slot = self._free.popleft()
+            self._refcount[slot] = 1
+
+        np.copyto(self._frames[slot], src[:, :, ::-1] if flip_channels else src)
+        self.written += 1
+        return FrameHandle(self, slot, frame_number, time_stamp, capture_ns)
+
+    def view(self, slot: int) -> np.ndarray:
+        return self._views[slot]
+
+    def retain(self, slot: int):
+        with self._lock:
+            self._refcount[slot] += 1
+
+    def release(self, slot: int):
+        with self._lock:
+            self._refcount[slot] -= 1
+            if self._refcount[slot]==0:
+                self._free.append(slot)
+
+    @property
+    def in_use(self) -> int:
+        with self._lock:
+            return self.capacity - len(self._free)
+
+class TimeSeriesBuffer():
+    '''
+    Append-only (time, value) series for the live plot with a moving average of the last avg_window values
+    arrays are preallocated and doubled when full, so an append is amortized O(1) instead of a copy of the whole series,
+    and the moving average is updated from a running sum instead of averaging the window on every append
+
+        x, y, y_avg : views of the stored series (valid until the next append)
+    '''
+    def __init__(self, capacity: int=1024, avg_window: int=20):
+        '''
+        ----------
+        Input Args
+        -----------
+        capacity : int
+            initial number of points
+        avg_window : int
+            number of the latest values in the moving average
+        '''
+        self.avg_window = avg_window
+        self._data = np.zeros((3, capacity), dtype=np.float64) # x, y, y_avg
+        self._length = 0
+        self._window_sum = 0.0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def append(self, x: float, y: float):
+        if self._length==self._data.shape[1]:
+            grown = np.zeros((3, self._data.shape[1] * 2), dtype=np.float64)
+            grown[:, :self._length] = self._data[:, :self._length]
+            self._data = grown
+
+        n = self._length
+        self._window_sum += y
+        if n >= self.avg_window:
+            self._window_sum -= self._data[1, n - self.avg_window]
+        self._data[:, n] = x, y, self._window_sum / min(n + 1, self.avg_window)
+        self._length += 1
+
+    @property
+    def x(self) -> np.ndarray:
+        return self._data[0, :self._length]
+
+    @property
+    def y(self) -> np.ndarray:
+        return self._data[1, :self._length]
+
+    @property
+    def y_avg(self) -> np.ndarray:
+        return self._data[2, :self._length]
+
+    def last(self, num_points: int) -> slice:
+        '''
+        slice of the latest num_points points
+        '''
+        return slice(max(self._length - num_points, 0), self._length)
+
+    def between(self, xmin: float, xmax: float) -> slice:
+        '''
+        slice of the points with xmin <= x <= xmax, x must be increasing
+        '''
+        x = self.x
+        return slice(int(np.searchsorted(x, xmin, side='left')), int(np.searchsorted(x, xmax, side='right')))
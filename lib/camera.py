@@ -0,0 +1,348 @@
+import ctypes, os, time
+import numpy as np
+import cv2
+from skimage import io
+from datetime import datetime
+from typing import Dict, List, Union
+
+from lib import tisgrabber as tis
+from lib.acquisition import FrameCallbackGrabber
+from lib.buffers import FrameRingBuffer, FrameHandle
+from lib.pacing import DeadlineScheduler
+
+class CameraBackend():
+    '''
+    Camera interface used by the acquisition pipeline
+
+    open -> start -> next_frame ... -> stop -> close
+    next_frame returns a FrameHandle (read-only RGB image, frame number and time stamp) or None
+
+    self_paced : bool
+        True if the backend delivers frames at its own rate (driver callback, replay),
+        False if the caller has to pace next_frame calls
+    '''
+    self_paced = False
+
+    def open(self) -> bool:
+        return self.is_valid()
+
+    def is_valid(self) -> bool:
+        raise NotImplementedError
+
+    def start(self, frame_rate: Union[float, None]=None):
+        raise NotImplementedError
+
+    def next_frame(self, timeout: float=2.0, latest: bool=False) -> Union[FrameHandle, None]:
+        '''
+        ----------
+        Input Args
+        -----------
+        timeout : float
+            maximum waiting time (sec) for a frame
+        latest : bool
+            True : skip the older frames and return the most recent one (live display)
+        '''
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def close(self):
+        self.stop()
+
+    def select_device(self) -> bool:
+        '''
+        let user select the device, return validity of the device
+        '''
+        return self.is_valid()
+
+    def check_connection(self) -> bool:
+        '''
+        probe the connection state without disturbing the acquisition
+        '''
+        return self.is_valid()
+
+    @property
+    def properties(self) -> Dict:
+        '''
+        width, height, channels and frame_rate of the stream
+        '''
+        raise NotImplementedError
+
+class TisCamera(CameraBackend):
+    '''
+    The Imaging Source camera through tisgrabber_x64.dll
+
+    acquisition_mode
+        'Callback' : driver pushes frames through IC_SetFrameReadyCallback
+        'Snap' : poll frames with IC_SnapImage
+    '''
+    def __init__(self, library_path: str='./lib/tisgrabber_x64.dll', acquisition_mode: str='Callback',
+                    device_file: bytes=b'device.xml', buffer_capacity: int=96):
+        # load library for camera control
+        self.ic = ctypes.CDLL(library_path)
+        tis.declareFunctions(self.ic)
+        self.ic.IC_InitLibrary(0)
+
+        self.acquisition_mode = acquisition_mode
+        self.device_file = device_file
+        self.buffer_capacity = buffer_capacity
+        self.frame_buffer = None
+        self.grabber = None
+        self.frame_rate = None
+        self.frame_count = 0
+
+        self.Width = ctypes.c_long()
+        self.Height = ctypes.c_long()
+        self.BitsPerPixel = ctypes.c_int()
+        self.colorformat = ctypes.c_int()
+
+        # connect camera
+        self.hGrabber = tis.openDevice(self.ic)
+
+    @property
+    def self_paced(self) -> bool:
+        return self.acquisition_mode=='Callback'
+
+    def is_valid(self) -> bool:
+        return bool(self.ic.IC_IsDevValid(self.hGrabber))
+
+    def start(self, frame_rate: Union[float, None]=None):
+        self.frame_rate = frame_rate
+        self._first_capture_ns = None
+        self._delivered = 0
+
+        # callback mode, the driver pushes frames into the queue of grabber
+        if self.acquisition_mode=='Callback':
+            if self.grabber is None:
+                self.grabber = FrameCallbackGrabber(self.ic, self.hGrabber, buffer_capacity=self.buffer_capacity)
+            self.grabber.clear()
+            self.grabber.start(frame_rate)
+            self.frame_buffer = self.grabber.frame_buffer
+            return
+
+        # start camera for live
+        self.ic.IC_StartLive(self.hGrabber, 0)
+
+        # Query the values
+        self.ic.IC_GetImageDescription(self.hGrabber, self.Width, self.Height, self.BitsPerPixel, self.colorformat)
+
+        # Calculate the buffer size
+        self.bpp = int(self.BitsPerPixel.value / 8.0 )
+        self.buffer_size = self.Width.value * self.Height.value * self.bpp
+
+        # preallocated frame slots shared by display, inference and saving
+        shape = (self.Height.value, self.Width.value, self.bpp)
+        if (self.frame_buffer is None) or (self.frame_buffer.shape!=shape):
+            self.frame_buffer = FrameRingBuffer(self.buffer_capacity, shape)
+
+    def _snap(self, timeout: float) -> Union[FrameHandle, None]:
+        if self.ic.IC_SnapImage(self.hGrabber, int(timeout * 1000)) != tis.IC_SUCCESS:
+            return None
+
+        # Get the image data
+        imagePtr =  self.ic.IC_GetImagePtr(self.hGrabber)
+        imagedata = ctypes.cast(imagePtr, ctypes.POINTER(ctypes.c_ubyte * self.buffer_size))
+
+        # numpy view over the driver buffer
+        img = np.ndarray(buffer = imagedata.contents,
+                dtype = np.uint8,
+                shape = self.frame_buffer.shape)
+
+        # copy once into the ring while correcting channel order
+        handle = self.frame_buffer.write(img, self.frame_count, datetime.now(), flip_channels=True)
+        self.frame_count += 1
+        return handle
+
+    def next_frame(self, timeout: float=2.0, latest: bool=False) -> Union[FrameHandle, None]:
+        if self.acquisition_mode!='Callback':
+            return self._snap(timeout)
+
+        if latest:
+            return self.grabber.get_latest(timeout)
+
+        # frames faster than the requested frame rate are skipped based on the monotonic acquisition time,
+        # so a step of the wall clock (NTP, DST) neither skips nor bursts frames
+        while True:
+            handle = self.grabber.get(timeout)
+            if (handle is None) or (not self.frame_rate):
+                return handle
+
+            if self._first_capture_ns is None:
+                self._first_capture_ns = handle.capture_ns
+            elif handle.capture_ns - self._first_capture_ns < self._delivered * 1e9 / self.frame_rate:
+                handle.release()
+                continue
+            self._delivered += 1
+            return handle
+
+    def stop(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+        else:
+            self.ic.IC_StopLive(self.hGrabber)
+
+    def close(self):
+        if self.is_valid():
+            self.stop()
+            self.ic.IC_ReleaseGrabber(ctypes.byref(self.hGrabber))
+
+    def select_device(self) -> bool:
+        self.ic.IC_StopLive(self.hGrabber)
+        hGrabber = self.ic.IC_ShowDeviceSelectionDialog(None)
+
+        if self.ic.IC_IsDevValid(hGrabber):
+            self.hGrabber = hGrabber
+            self.grabber = None
+            self.ic.IC_StartLive(self.hGrabber, 0)
+            self.ic.IC_SaveDeviceStateToFile(self.hGrabber, self.device_file)
+        return self.is_valid()
+
+    def check_connection(self) -> bool:
+        camera = self.ic.IC_LoadDeviceStateFromFile(None, self.device_file)
+        return bool(self.ic.IC_IsDevValid(camera))
+
+    @property
+    def properties(self) -> Dict:
+        if self.frame_buffer is None:
+            return {'width' : None, 'height' : None, 'channels' : None, 'frame_rate' : self.frame_rate}
+        height, width, channels = self.frame_buffer.shape
+        return {'width' : width, 'height' : height, 'channels' : channels, 'frame_rate' : self.frame_rate}
+
+class ReplayCamera(CameraBackend):
+    '''
+    Replay a recorded session as a camera
+    source is an AVI file (cv2.VideoCapture) or a directory of images saved by the recorder
+
+    frame_rate : float or None
+        replay rate (Hz), None streams the frames as fast as possible for throughput testing
+    loop : bool
+        restart from the first frame at the end of the source
+
+    a frame that doesn't fit in the ring buffer (every slot in use) is kept and written by the next call,
+    so the replay never skips a frame of the source
+    '''
+    self_paced = True
+
+    def __init__(self, source: str, frame_rate: Union[float, None]=None, loop: bool=False,
+                    buffer_capacity: int=96, img_formats=('.tif', '.jpg', '.png', '.jpeg')):
+        self.source = source
+        self.frame_rate = frame_rate
+        self.loop = loop
+        self.buffer_capacity = buffer_capacity
+        self.img_formats = img_formats
+        self.frame_buffer = None
+        self.scheduler = DeadlineScheduler(frame_rate) if frame_rate else None
+        self.capture = None
+        self.img_names = []
+        self.position = 0
+        self.frame_count = 0
+        self.finished = False
+        self._held = None # frame read from the source and not written to the ring buffer yet
+        self.open()
+
+    def open(self) -> bool:
+        if os.path.isdir(self.source):
+            self.img_names = self._list_images(self.source)
+        elif os.path.isfile(self.source):
+            self.capture = cv2.VideoCapture(self.source)
+        return self.is_valid()
+
+    def _list_images(self, path: str) -> List[str]:
+        img_names = [names for names in os.listdir(path) if names.endswith(self.img_formats)]
+        return sorted(img_names, key=lambda x: int(x[:6]) if x[:6].isdigit() else -1)
+
+    def is_valid(self) -> bool:
+        if self.capture is not None:
+            return self.capture.isOpened()
+        return len(self.img_names) > 0
+
+    def start(self, frame_rate: Union[float, None]=None):
+        '''
+        frame_rate of the caller is ignored, the replay rate is given at construction
+        '''
+        self.finished = False
+        self._rewind()
+        if self.scheduler is not None:
+            self.scheduler.start()
+
+    def _rewind(self):
+        self.position = 0
+        self._held = None
+        if self.capture is not None:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def _read(self) -> Union[np.ndarray, None]:
+        '''
+        read next RGB frame from the source
+        '''
+        if self.capture is not None:
+            # the recorder writes RGB frames to the AVI file as they are, so the decoded frame is already RGB
+            ret, img = self.capture.read()
+            return img if ret else None
+
+        if self.position >= len(self.img_names):
+            return None
+        return io.imread(os.path.join(self.source, self.img_names[self.position]))
+
+    def next_frame(self, timeout: float=2.0, latest: bool=False) -> Union[FrameHandle, None]:
+        if self.finished:
+            return None
+
+        if self._held is None:
+            if self.scheduler is not None:
+                self.scheduler.wait()
+
+            img = self._read()
+            if (img is None) and self.loop:
+                self._rewind()
+                img = self._read()
+            if img is None:
+                self.finished = True
+                return None
+
+            if img.ndim==2: # gray scale image
+                img = np.repeat(img[:, :, None], 3, axis=2)
+            if (self.frame_buffer is None) or (self.frame_buffer.shape!=img.shape):
+                self.frame_buffer = FrameRingBuffer(self.buffer_capacity, img.shape)
+            self._held = img
+
+        # wait for a free slot, the frame is kept for the next call if none is released within timeout
+        deadline = time.perf_counter() + timeout
+        while True:
+            handle = self.frame_buffer.write(self._held, self.frame_count, datetime.now())
+            if (handle is not None) or (time.perf_counter() >= deadline):
+                break
+            time.sleep(0.001)
+        if handle is None:
+            return None
+
+        self._held = None
+        self.position += 1
+        self.frame_count += 1
+        return handle
+
+    def stop(self):
+        pass
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+
+    @property
+    def properties(self) -> Dict:
+        if self.capture is not None:
+            width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            channels = 3
+        elif self.frame_buffer is not None:
+            height, width, channels = self.frame_buffer.shape
+        else:
+            width, height, channels = None, None, None
+        return {'width' : width, 'height' : height, 'channels' : channels, 'frame_rate' : self.frame_rate}
+
+    @property
+    def num_frames(self) -> int:
+        if self.capture is not None:
+            return int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        return len(self.img_names)
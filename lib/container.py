@@ -0,0 +1,223 @@
+import h5py
+import numpy as np
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Tuple, Union
+
+from lib.utils import frame_name
+from lib.writers import SinkWorker
+
+EPOCH = datetime(1970, 1, 1)
+
+def to_microseconds(time_stamp: datetime) -> int:
+    '''
+    time stamp -> microseconds from 1970-01-01 (exact round trip of datetime.now())
+    '''
+    return (time_stamp - EPOCH) // timedelta(microseconds=1)
+
+def from_microseconds(us: int) -> datetime:
+    return EPOCH + timedelta(microseconds=int(us))
+
+class SessionWriter():
+    '''
+    Single file session container (HDF5) replacing one image file per frame
+
+    layout
+        /frames : uint8 (num_frame, height, width, channels), chunked along the frames
+        /index : int64 (num_frame, ), recording index
+        /frame_number : int64 (num_frame, ), frame counter of the camera
+        /time_stamp : int64 (num_frame, ), microseconds from 1970-01-01 (datetime.now() of acquisition)
+
+    frames are appended to a chunk sized buffer and written one chunk at a time,
+    the frame shape is fixed by the first frame
+    '''
+    def __init__(self, path: str, chunk_frames: int=16, compression: Union[str, None]='lzf',
+                    compression_opts: Union[int, None]=None, attrs: Union[Dict, None]=None):
+        '''
+        ----------
+        Input Args
+        -----------
+        path : str
+            path of the container file (.h5)
+        chunk_frames : int
+            number of frames in a chunk, also the number of frames buffered before writing
+        compression : str or None
+            'lzf' (fast), 'gzip' (smaller, slower) or None
+        compression_opts : int or None
+            compression level of 'gzip' (0-9)
+        attrs : dict or None
+            session metadata stored as attributes of the file (e.g. frame_rate, exp_name)
+        '''
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.compression = compression
+        self.compression_opts = compression_opts
+
+        self.file = h5py.File(path, 'w')
+        for key, value in ({} if attrs is None else attrs).items():
+            self.file.attrs[key] = value
+        self.file.attrs['time_stamp_unit'] = 'microseconds from 1970-01-01'
+
+        self.frames = None
+        self._buffer = None
+        self._meta = np.zeros((chunk_frames, 3), dtype=np.int64) # index, frame_number, time_stamp
+        self._buffered = 0
+        self.written = 0
+
+    def _create(self, shape: Tuple[int, ...], dtype: np.dtype):
+        self.frames = self.file.create_dataset('frames', shape=(0, *shape), maxshape=(None, *shape), dtype=dtype,
+                                                chunks=(self.chunk_frames, *shape),
+                                                compression=self.compression, compression_opts=self.compression_opts)
+        for key in ['index', 'frame_number', 'time_stamp']:
+            self.file.create_dataset(key, shape=(0, ), maxshape=(None, ), dtype=np.int64,
+                                        chunks=(max(self.chunk_frames, 1024), ))
+        self._buffer = np.zeros((self.chunk_frames, *shape), dtype=dtype)
+
+    def append(self, img: np.ndarray, index: int, frame_number: int, time_stamp: datetime):
+        if self.frames is None:
+            self._create(img.shape, img.dtype)
+        assert img.shape==self._buffer.shape[1:], f'frame shape {img.shape} is different from the session {self._buffer.shape[1:]}'
+
+        self._buffer[self._buffered] = img
+        self._meta[self._buffered] = index, frame_number, to_microseconds(time_stamp)
+        self._buffered += 1
+        if self._buffered==self.chunk_frames:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._buffered==0:
+            return
+        start, stop = self.written, self.written + self._buffered
+
+        self.frames.resize(stop, axis=0)
+        self.frames[start:stop] = self._buffer[:self._buffered]
+        for col, key in enumerate(['index', 'frame_number', 'time_stamp']):
+            self.file[key].resize(stop, axis=0)
+            self.file[key][start:stop] = self._meta[:self._buffered, col]
+
+        self.written = stop
+        self._buffered = 0
+
+    def flush(self):
+        '''
+        write the buffered frames and flush the file
+        '''
+        if self.frames is not None:
+            self._write_buffer()
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.flush()
+            self.file.close()
+
+    def __len__(self) -> int:
+        return self.written + self._buffered
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SessionReader():
+    '''
+    Random access reader of the session container
+
+    reader[i] or reader[start:stop] -> frames
+    reader.frame(i) -> (image, metadata)
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.frames = self.file['frames'] if 'frames' in self.file else None
+
+        # index table is small, load once
+        self.indices = self.file['index'][:] if 'index' in self.file else np.zeros(0, dtype=np.int64)
+        self.frame_numbers = self.file['frame_number'][:] if 'frame_number' in self.file else np.zeros(0, dtype=np.int64)
+        self._time_stamps = self.file['time_stamp'][:] if 'time_stamp' in self.file else np.zeros(0, dtype=np.int64)
+
+    @property
+    def attrs(self) -> Dict:
+        return dict(self.file.attrs)
+
+    @property
+    def shape(self) -> Union[Tuple[int, ...], None]:
+        return None if self.frames is None else self.frames.shape[1:]
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, key: Union[int, slice]) -> np.ndarray:
+        return self.frames[key]
+
+    def time_stamp(self, position: int) -> datetime:
+        return from_microseconds(self._time_stamps[position])
+
+    @property
+    def time_stamps(self) -> List[datetime]:
+        return [from_microseconds(us) for us in self._time_stamps]
+
+    def frame_name(self, position: int) -> str:
+        '''
+        name of the frame as if it was saved as an image file, {index:06d}_{time stamp}.tif
+        '''
+        return frame_name(int(self.indices[position]), self.time_stamp(position))
+
+    def frame(self, position: int) -> Tuple[np.ndarray, Dict]:
+        meta = {'index' : int(self.indices[position]),
+                'frame_number' : int(self.frame_numbers[position]),
+                'time_stamp' : self.time_stamp(position)}
+        return self.frames[position], meta
+
+    def iter_frames(self, start: int=0, stop: Union[int, None]=None,
+                    chunk: Union[int, None]=None) -> Iterator[Tuple[int, np.ndarray, datetime]]:
+        '''
+        sequential reading, one chunk is decompressed at a time
+
+        ----------
+        Return
+        -----------
+        iterator of (index, image, time stamp)
+        '''
+        if self.frames is None: # no frame was recorded
+            return
+        stop = len(self) if stop is None else min(stop, len(self))
+        chunk = self.frames.chunks[0] if chunk is None else chunk
+        for chunk_start in range(start, stop, chunk):
+            chunk_stop = min(chunk_start + chunk, stop)
+            imgs = self.frames[chunk_start:chunk_stop]
+            for offset, img in enumerate(imgs):
+                position = chunk_start + offset
+                yield int(self.indices[position]), img, self.time_stamp(position)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ContainerSink(SinkWorker):
+    '''
+    session container as an output sink of the writer pool, the file is opened by the worker thread
+    item : (FrameHandle, index)
+    '''
+    def __init__(self, path: str, queue_size: int=64, **writer_kwargs):
+        super().__init__('Container', queue_size)
+        self.path = path
+        self.writer_kwargs = writer_kwargs
+        self.writer = None
+
+    def _write(self, item):
+        handle, index = item
+        if self.writer is None:
+            self.writer = SessionWriter(self.path, **self.writer_kwargs)
+        self.writer.append(handle.image, index, handle.frame_number, handle.time_stamp)
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
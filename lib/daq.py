@@ -0,0 +1,366 @@
+import platform, queue, threading, time
+from collections import deque
+from ctypes import CFUNCTYPE, c_void_p
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+if platform.system().lower()=='windows':
+    from ctypes import WINFUNCTYPE as _EVENT_FUNCTYPE
+else:
+    _EVENT_FUNCTYPE = CFUNCTYPE
+
+# void (BDAQCALL *DaqEventProc)(void *sender, void *args, void *userParam)
+DaqEventProc = _EVENT_FUNCTYPE(None, c_void_p, c_void_p, c_void_p)
+
+class DiEventSource():
+    '''
+    Change of state (both edges) or DI interrupt (rising edge) events of a DI port (InstantDiCtrl)
+    the driver callback only puts time.perf_counter_ns into a queue, the consumer sleeps on the queue
+    '''
+    def __init__(self, trig, port: int, mask: int=0x01):
+        '''
+        ----------
+        Input Args
+        -----------
+        trig : InstantDiCtrl
+            trigger receiving device
+        port : int
+            DI port
+        mask : int
+            bits of the port raising events
+        '''
+        self.trig = trig
+        self.port = port
+        self.mask = mask
+        self.events = 0
+
+        self._events = queue.SimpleQueue()
+        self._event_proc = None
+        self._event_id = None
+        self._event_source = None
+
+    def start(self) -> bool:
+        '''
+        enable the events on the port and register the callback, False if the device doesn't support them
+        '''
+        try:
+            from Automation.BDaq import EventId, ActiveSignal, ErrorCode
+            from Automation.BDaq.BDaqApi import TDaqCtrlBase, TInstantDiCtrl, BioFailed
+
+            bit = (self.mask & -self.mask).bit_length() - 1 # lowest bit of the mask
+            for number, cos_port in enumerate(self.trig.diCosintPorts):
+                if cos_port.port==self.port:
+                    cos_port.mask = self.mask
+                    self._event_id = int(EventId.EvtDiCosintPort000) + number
+                    self._event_source = cos_port
+                    break
+            else:
+                for number, int_channel in enumerate(self.trig.diIntChannels):
+                    if int_channel.channel==self.port * 8 + bit:
+                        int_channel.trigEdge = ActiveSignal.RisingEdge
+                        int_channel.enabled = True
+                        self._event_id = int(EventId.EvtDiintChannel000) + number
+                        self._event_source = int_channel
+                        break
+                else:
+                    return False
+
+            self._event_proc = DaqEventProc(self._on_event) # referenced while registered
+            TDaqCtrlBase.addEventHandler(self.trig._obj, self._event_id, self._event_proc, None)
+            if BioFailed(ErrorCode.lookup(TInstantDiCtrl.snapStart(self.trig._obj))):
+                self.stop()
+                return False
+            return True
+        except Exception as e:
+            logger.debug(f'DI events unavailable on port {self.port} : {e}')
+            self.stop()
+            return False
+
+    def stop(self):
+        try:
+            from Automation.BDaq.BDaqApi import TDaqCtrlBase, TInstantDiCtrl
+            if self._event_proc is not None:
+                TInstantDiCtrl.snapStop(self.trig._obj)
+                TDaqCtrlBase.removeEventHandler(self.trig._obj, self._event_id, self._event_proc, None)
+            if hasattr(self._event_source, 'mask'):
+                self._event_source.mask = 0
+            elif self._event_source is not None:
+                self._event_source.enabled = False
+        except Exception as e:
+            logger.debug(f'failed to stop DI events : {e}')
+        self._event_proc = None
+        self._event_source = None
+
+    def _on_event(self, sender, args, user_param):
+        # driver thread, nothing but a time stamp into the queue
+        self._events.put_nowait(time.perf_counter_ns())
+
+    def next_event(self, timeout: float) -> Union[int, None]:
+        '''
+        time.perf_counter_ns of the next event, None if no event within timeout (sec)
+        '''
+        try:
+            event_ns = self._events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        self.events += 1
+        return event_ns
+
+class DiEdge(NamedTuple):
+    time_ns : int # time.perf_counter_ns of the transition (event or first sample of the new level)
+    rising : bool
+    data : Tuple[int, ...] # port values confirming the transition
+
+class DiSubscription():
+    '''
+    Edge queue of one subscriber of DiInputService
+    the service appends and the subscriber pops (deque append and popleft are atomic, no lock is shared with the service),
+    the oldest edges are dropped if the subscriber doesn't keep up with maxlen
+    '''
+    def __init__(self, service: 'DiInputService', maxlen: int=1024):
+        self.service = service
+        self.edges = deque(maxlen=maxlen)
+        self._wakeup = threading.Event()
+        self.dropped = 0
+
+    def _publish(self, edge: DiEdge):
+        if len(self.edges)==self.edges.maxlen:
+            self.dropped += 1
+        self.edges.append(edge)
+        self._wakeup.set()
+
+    def get(self, timeout: Union[float, None]=None) -> Union[DiEdge, None]:
+        '''
+        next edge, None if no edge within timeout (sec)
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.edges.popleft()
+            except IndexError:
+                pass
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None) and (remaining <= 0):
+                return None
+            # cleared before the next pop, so an edge published meanwhile is never missed
+            self._wakeup.wait(remaining)
+            self._wakeup.clear()
+
+    def close(self):
+        self.service.unsubscribe(self)
+
+class DiInputService():
+    '''
+    Single owner of the trigger receiving device (InstantDiCtrl)
+    one thread samples the ports and publishes debounced edges to any number of subscribers (DiSubscription),
+    so DLL calls, handles and CPU use don't grow with the consumers (trigger wait, TTL termination, BNC and connection checks)
+
+        'event' : samples on change of state / DI interrupt events of the TTL bit, and at heartbeat_rate otherwise
+        'poll' : samples at sample_rate
+        'auto' : 'event' if the device supports it on the port, 'poll' otherwise
+
+    a transition becomes an edge when the level stays for debounce (outlier TTL signal filter),
+    the device is reopened every reconnect_interval while it is disconnected
+    TTL on state, data = 255 / TTL off state, data = 254 (bit 0 of the port)
+    '''
+    modes = ('auto', 'event', 'poll')
+
+    def __init__(self, dev_description: str, port: int, port_count: int=1, mask: int=0x01, mode: str='auto',
+                    sample_rate: float=1000.0, heartbeat_rate: float=10.0, debounce: float=0.002, reconnect_interval: float=2.0):
+        '''
+        ----------
+        Input Args
+        -----------
+        dev_description : str
+            description of the trigger receiving device, e.g. "USB-4751L,BID#0"
+        port, port_count : int
+            ports to read, the TTL is on the first port
+        mask : int
+            bits of the first port carrying the TTL signal
+        mode : str
+            'auto', 'event' or 'poll'
+        sample_rate : float
+            sampling rate (Hz) in poll mode
+        heartbeat_rate : float
+            sampling rate (Hz) between events in event mode
+        debounce : float
+            time (sec) a new level must hold to become an edge
+        reconnect_interval : float
+            time (sec) between attempts to open a disconnected device
+        '''
+        assert mode in self.modes, f'mode must be one of {self.modes}'
+        self.dev_description = dev_description
+        self.port = port
+        self.port_count = port_count
+        self.mask = mask
+        self.requested_mode = mode
+        self.mode = None
+        self.sample_rate = sample_rate
+        self.heartbeat_rate = heartbeat_rate
+        self.debounce_ns = int(debounce * 1e9)
+        self.reconnect_interval = reconnect_interval
+
+        self.trig = None
+        self.event_source = None
+        self.data = None # latest port values
+        self.level = False # debounced TTL level
+        self.level_since_ns = None # time.perf_counter_ns of the last edge
+        self._pending_ns = None # start of an unconfirmed transition
+
+        self._subscribers = [] # replaced (not mutated) on (un)subscribe, the sampling thread iterates a snapshot
+        self._subscribe_lock = threading.Lock()
+        self._running = threading.Event()
+        self._thread = None
+
+        self.samples = 0
+        self.edges = 0
+
+    @property
+    def connected(self) -> bool:
+        return self.trig is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name='DiInputService', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._close()
+
+    def subscribe(self, maxlen: int=1024) -> DiSubscription:
+        subscription = DiSubscription(self, maxlen)
+        with self._subscribe_lock:
+            self._subscribers = self._subscribers + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: DiSubscription):
+        with self._subscribe_lock:
+            self._subscribers = [subscriber for subscriber in self._subscribers if subscriber is not subscription]
+
+    def _open(self) -> bool:
+        try:
+            from lib.Automation.BDaq.InstantDiCtrl import InstantDiCtrl
+            from Automation.BDaq.BDaqApi import BioFailed
+            self._failed = BioFailed
+            trig = InstantDiCtrl(self.dev_description)
+            if trig.device.location==b'':
+                return False
+        except Exception:
+            return False
+
+        self.trig = trig
+        self.event_source = None
+        if self.requested_mode in ['auto', 'event']:
+            event_source = DiEventSource(trig, self.port, self.mask)
+            if event_source.start():
+                self.event_source = event_source
+            elif self.requested_mode=='event':
+                logger.warning(f'DI events are not supported on port {self.port}, polling at {self.sample_rate} Hz')
+        self.mode = 'poll' if self.event_source is None else 'event'
+        self._pending_ns = None
+        logger.debug(f'trigger device opened, {self.mode} mode')
+        return True
+
+    def _close(self):
+        if self.event_source is not None:
+            self.event_source.stop()
+            self.event_source = None
+        if self.trig is not None:
+            logger.debug(f'trigger device closed')
+        self.trig = None
+        self.data = None
+        self.mode = None
+
+    def _run(self):
+        while self._running.is_set():
+            if (self.trig is None) and (not self._open()):
+                self._running.wait(self.reconnect_interval)
+                continue
+
+            # an unconfirmed transition is sampled again after the debounce time
+            if self._pending_ns is not None:
+                timeout = self.debounce_ns / 1e9
+            else:
+                timeout = 1 / (self.heartbeat_rate if self.event_source is not None else self.sample_rate)
+
+            if self.event_source is not None:
+                event_ns = self.event_source.next_event(timeout)
+            else:
+                time.sleep(timeout)
+                event_ns = None
+
+            try:
+                self._sample(event_ns)
+            except Exception as e:
+                logger.warning(f'trigger device disconnected : {e}')
+                self._close()
+
+    def _sample(self, event_ns: Union[int, None]):
+        ret, data = self.trig.readAny(self.port, self.port_count)
+        if self._failed(ret):
+            raise IOError(f'readAny failed {ret}')
+        now_ns = time.perf_counter_ns()
+        self.samples += 1
+        self.data = data
+
+        raw = bool(data[0] & self.mask)
+        if raw==self.level: # no transition or a glitch shorter than debounce
+            self._pending_ns = None
+            return
+        if self._pending_ns is None:
+            self._pending_ns = now_ns if event_ns is None else event_ns
+        if now_ns - self._pending_ns >= self.debounce_ns:
+            self.level = raw
+            self.level_since_ns = self._pending_ns
+            self._pending_ns = None
+            self._publish(DiEdge(self.level_since_ns, raw, tuple(data)))
+
+    def _publish(self, edge: DiEdge):
+        self.edges += 1
+        for subscriber in self._subscribers:
+            subscriber._publish(edge)
+
+    def wait_high(self, running: Callable[[], bool]) -> Union[int, None]:
+        '''
+        block until the TTL level is high
+
+        ----------
+        Input Args
+        -----------
+        running : callable
+            returns False to cancel the waiting
+
+        ----------
+        Return
+        -----------
+        edge_ns : int or None
+            time.perf_counter_ns of the rising edge, None if cancelled
+        '''
+        subscription = self.subscribe()
+        try:
+            if self.level:
+                return self.level_since_ns
+            while running():
+                edge = subscription.get(timeout=0.1)
+                if (edge is not None) and edge.rising:
+                    return edge.time_ns
+            return None
+        finally:
+            subscription.close()
+
+    def stats(self) -> Dict:
+        return {'mode' : self.mode,
+                'connected' : self.connected,
+                'samples' : self.samples,
+                'events' : 0 if self.event_source is None else self.event_source.events,
+                'edges' : self.edges,
+                'subscribers' : len(self._subscribers)}
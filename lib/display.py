@@ -0,0 +1,180 @@
+import threading, time
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, Qt, QPointF, QRectF, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen
+from PyQt5.QtWidgets import QSizePolicy, QWidget
+from typing import Dict, Union
+
+class RenderScheduler(QObject):
+    '''
+    Decouples the display from the camera rate
+    frames are submitted from the capture (or recording) thread at full rate and only the latest one is kept,
+    a timer on the GUI thread renders it at display_rate, so capture and saving are never throttled by painting.
+    frames replaced before they are rendered are coalesced, and their frame handles are released at once
+
+        render : latest frame signal, emitted on the GUI thread once per tick if a new frame arrived
+        tick : emitted on the GUI thread every display period (e.g. to refresh the plot)
+    '''
+    render = pyqtSignal(dict)
+    tick = pyqtSignal()
+
+    def __init__(self, display_rate: float=15.0, parent: Union[QObject, None]=None):
+        '''
+        ----------
+        Input Args
+        -----------
+        display_rate : float
+            repaint rate (Hz), e.g. 15 Hz or the refresh rate of the monitor
+        '''
+        super().__init__(parent)
+        self._lock = threading.Lock()
+        self._latest = None
+
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._tick)
+        self.set_display_rate(display_rate)
+
+        self.submitted = 0
+        self.rendered = 0
+        self.coalesced = 0
+        self.render_time = 0.0 # time (sec) of the last render slot
+
+    def set_display_rate(self, display_rate: float):
+        self.display_rate = display_rate
+        self._timer.setInterval(max(1, int(round(1000 / display_rate))))
+
+    def start(self):
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+        self.clear()
+
+    @pyqtSlot(dict)
+    def submit(self, signal: Dict):
+        '''
+        keep the frame to render at the next tick, thread-safe
+        '''
+        with self._lock:
+            previous, self._latest = self._latest, signal
+            self.submitted += 1
+        if previous is not None:
+            self._discard(previous)
+
+    def clear(self):
+        '''
+        drop the frame waiting to be rendered
+        '''
+        with self._lock:
+            previous, self._latest = self._latest, None
+        if previous is not None:
+            self._discard(previous)
+
+    def _discard(self, signal: Dict):
+        self.coalesced += 1
+        frame = signal.get('frame')
+        if frame is not None:
+            frame.release()
+
+    @pyqtSlot()
+    def _tick(self):
+        with self._lock:
+            signal, self._latest = self._latest, None
+        start_time = time.perf_counter()
+        if signal is not None:
+            self.rendered += 1
+            self.render.emit(signal)
+        self.tick.emit()
+        self.render_time = time.perf_counter() - start_time
+
+    def stats(self) -> Dict:
+        return {'display_rate' : self.display_rate,
+                'submitted' : self.submitted,
+                'rendered' : self.rendered,
+                'coalesced' : self.coalesced,
+                'render_time' : self.render_time}
+
+class VideoView(QWidget):
+    '''
+    Video widget painting the latest frame directly in paintEvent
+    the QImage wraps the frame slot of the ring buffer (no conversion to QPixmap), the painter scales it once
+    into the widget keeping the aspect ratio, and the pupil circle and key points are drawn on top in image coordinates,
+    so the frame itself is never modified.
+    the frame handle is held until the next frame replaces it, because the QImage doesn't own its pixels
+    '''
+    keypoint_colors = ('#FF9900', '#33CC33', '#3399FF', '#FF3333')
+
+    def __init__(self, parent: Union[QWidget, None]=None):
+        super().__init__(parent)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+        self.setAttribute(Qt.WA_OpaquePaintEvent) # the background is painted with the frame
+        self._image = None
+        self._frame = None
+        self._overlay = None
+
+        self.render_time = 0.0 # time (sec) of the last paint
+        self.render_time_avg = 0.0 # exponential average of the paint time
+        self.painted = 0
+
+    def set_frame(self, image: QImage, frame=None):
+        '''
+        ----------
+        Input Args
+        -----------
+        image : QImage
+            frame to show
+        frame : FrameHandle or None
+            owner of the image memory, released when the next frame is set
+        '''
+        previous, self._frame = self._frame, frame
+        self._image = image
+        if previous is not None:
+            previous.release()
+        self.update()
+
+    def set_overlay(self, center: Union[np.ndarray, None]=None, diameter: float=0.0,
+                        keypoints: Union[np.ndarray, None]=None):
+        '''
+        pupil circle and key points (num_keypoints x 2, x and y) in image coordinates, None center removes the overlay
+        '''
+        self._overlay = None if center is None else (float(center[0]), float(center[1]), float(diameter),
+                                                        None if keypoints is None else np.asarray(keypoints)[:, :2])
+
+    def clear(self):
+        self.set_frame(None)
+        self._overlay = None
+
+    def paintEvent(self, event):
+        start_time = time.perf_counter()
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.black)
+        if (self._image is not None) and (not self._image.isNull()):
+            width, height = self._image.width(), self._image.height()
+            scale = min(self.width() / width, self.height() / height)
+            target = QRectF((self.width() - width * scale) / 2, (self.height() - height * scale) / 2, width * scale, height * scale)
+            painter.drawImage(target, self._image)
+
+            if self._overlay is not None:
+                # overlay in image coordinates, cosmetic pens keep their width in screen pixels
+                painter.translate(target.topLeft())
+                painter.scale(scale, scale)
+                x, y, diameter, keypoints = self._overlay
+                pen = QPen(Qt.red, 1)
+                pen.setCosmetic(True)
+                painter.setPen(pen)
+                painter.drawEllipse(QPointF(x, y), diameter / 2, diameter / 2)
+                if keypoints is not None:
+                    for color, (key_x, key_y) in zip(self.keypoint_colors, keypoints):
+                        pen = QPen(QColor(color), 4)
+                        pen.setCosmetic(True)
+                        painter.setPen(pen)
+                        painter.drawPoint(QPointF(key_x, key_y))
+        painter.end()
+
+        self.render_time = time.perf_counter() - start_time
+        self.render_time_avg = self.render_time if self.painted==0 else 0.9 * self.render_time_avg + 0.1 * self.render_time
+        self.painted += 1
+
+    def stats(self) -> Dict:
+        return {'painted' : self.painted, 'render_time' : self.render_time, 'render_time_avg' : self.render_time_avg}
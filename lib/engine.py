@@ -0,0 +1,285 @@
+import os, re, time
+import numpy as np
+from typing import Callable, Dict, Union
+
+from lib.buffers import FrameHandle
+from lib.camera import CameraBackend
+from lib.inference import InferenceWorker
+from lib.pacing import DeadlineScheduler
+from lib.utils import frame_name, metadata_row, pupil_row, FRAME_TABLE_TIME_FORMAT
+from lib.writers import WriterPool, TiffSink, VideoSink, PupilSink, TableSink, TtlTimelineSink
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+def wait_for_ttl(di_service, running: Callable[[], bool]) -> Union[int, None]:
+    '''
+    ready TTL signal for triggered recording
+    Vmin = 0V, Vmax = 5V, duration > 200 ms
+    TTL on state, data = 255
+    TTL off state, data = 254
+
+    ----------
+    Input Args
+    -----------
+    di_service : lib.daq.DiInputService
+        shared sampler of the trigger receiving device
+    running : callable
+        returns False to cancel the waiting
+
+    ----------
+    Return
+    -----------
+    edge_ns : int or None
+        time.perf_counter_ns of the TTL signal, None if cancelled
+    '''
+    edge_ns = di_service.wait_high(running)
+    logger.debug(f'TTL {"received" if edge_ns is not None else "cancelled"} {di_service.stats()}')
+    return edge_ns
+
+def unique_exp_name(save_dir: str, exp_name: str) -> str:
+    '''
+    add 4 digits nonce to experiment name and increase it until no directory (or session container) has the same name
+    '''
+    dir_filter = re.compile(r'(?P<nonce>_\d{4})')
+    if dir_filter.search(exp_name) is None:
+        exp_name = f'{exp_name}_{0:04d}'
+
+    nonce = 0
+    while os.path.exists(os.path.join(save_dir, exp_name)) or os.path.exists(os.path.join(save_dir, f'{exp_name}.h5')):
+        nonce += 1
+        exp_name = dir_filter.sub(f'_{nonce:04d}', exp_name)
+    return exp_name
+
+class RecordingEngine():
+    '''
+    Headless recording pipeline, trigger wait -> capture -> infer -> save
+    Qt is not required, GUI and command line observe the engine through callbacks
+    saving runs on the writer pool threads, the capture loop only queues the frames
+
+    outputs (same layout as the GUI recorder)
+        {save_dir}/{exp_name}/{index:06d}_{time stamp}.tif (storage='tiff')
+        {save_dir}/{exp_name}.h5 (storage='container', see lib.container)
+        {save_dir}/{exp_name}.avi
+        {save_dir}/{exp_name}.frames.csv (index, frame number and time stamp of the frames in the AVI file)
+        {save_dir}/{exp_name}.csv (pupil data, only if DeepLabCut model is given)
+        {save_dir}/{exp_name}.npz (columnar pupil data, pupil_npz=True)
+        {save_dir}/{exp_name}.ttl.bin (TTL edge timeline, only if DI input service is given, see lib.utils.TTL_EDGE_DTYPE)
+    '''
+    storages = ('tiff', 'container')
+
+    def __init__(self, camera: CameraBackend, save_dir: str, exp_name: str, frames: int, frame_rate: float,
+                    dlclive=None, inference_policy: str='drop_oldest',
+                    wait_trigger: Union[Callable[[], Union[bool, int, None]], None]=None, video_codec: str='MJPG', storage: str='tiff',
+                    pupil_npz: bool=False, di_service=None):
+        '''
+        ----------
+        Input Args
+        -----------
+        camera : CameraBackend
+            frame source
+        save_dir : str
+            parent directory of the experiment
+        exp_name : str
+            name of the experiment directory
+        frames : int
+            number of frames to record
+        frame_rate : float
+            recording frame rate (Hz)
+        dlclive : dlclive.DLCLive or None
+            initialized DeepLabCut live model, pupil fitting is skipped if None
+        inference_policy : str
+            backpressure policy of the inference worker, 'block', 'drop_oldest' or 'latest'
+        wait_trigger : callable or None
+            blocking function returning True or time.perf_counter_ns of the trigger when triggered (False or None to cancel),
+            None starts immediately
+        video_codec : str
+            fourcc of the AVI file
+        storage : str
+            'tiff' : one image file per frame
+            'container' : chunked single file session container (HDF5)
+        pupil_npz : bool
+            save the pupil data also as a columnar numpy file ({exp_name}.npz)
+        di_service : lib.daq.DiInputService or None
+            every TTL edge from the trigger wait to the end of the recording is logged ({exp_name}.ttl.bin)
+        '''
+        assert storage in self.storages, f'storage must be one of {self.storages}'
+        self.camera = camera
+        self.save_dir = save_dir
+        self.exp_name = exp_name
+        self.frames = frames
+        self.frame_rate = frame_rate
+        self.dlclive = dlclive
+        self.inference_policy = inference_policy
+        self.wait_trigger = wait_trigger
+        self.video_codec = video_codec
+        self.storage = storage
+        self.pupil_npz = pupil_npz
+        self.di_service = di_service
+
+        self.exp_dir = os.path.join(save_dir, exp_name)
+        self.video_name = f'{self.exp_dir}.avi'
+        self.csv_name = f'{self.exp_dir}.csv'
+        self.npz_name = f'{self.exp_dir}.npz'
+        self.frame_table_name = f'{self.exp_dir}.frames.csv'
+        self.container_name = f'{self.exp_dir}.h5'
+        self.ttl_name = f'{self.exp_dir}.ttl.bin'
+
+        self.scheduler = DeadlineScheduler(frame_rate)
+        self.inference = None
+        self.writers = None
+        self.first_time_stamp = None
+        self.running = True # engine runs once, stop before run cancels the recording
+        self.trigger_ns = None # time.perf_counter_ns of the trigger
+        self.first_frame_ns = None # time.perf_counter_ns of the first frame
+        self.recorded = 0
+
+        # observers
+        self.on_started = [] # callable()
+        self.on_frame = [] # callable(handle, frame_data), share the handle to keep the frame after the call
+        self.on_saved = [] # callable(index), the frame is queued to the writers
+        self.on_pupil = [] # callable(pupil)
+
+    def add_observer(self, on_started: Callable=None, on_frame: Callable=None, on_saved: Callable=None, on_pupil: Callable=None):
+        for observers, callback in zip([self.on_started, self.on_frame, self.on_saved, self.on_pupil],
+                                        [on_started, on_frame, on_saved, on_pupil]):
+            if callback is not None:
+                observers.append(callback)
+
+    def stop(self):
+        self.running = False
+
+    def run(self) -> Dict:
+        '''
+        record the session, blocks until all frames are recorded or stop is called
+
+        ----------
+        Return
+        -----------
+        stats : dict
+            number of recorded frames, frame pacing and inference statistics
+        '''
+        # subscribed before the trigger wait, so the trigger edge is in the timeline
+        ttl_edges = self.di_service.subscribe(maxlen=65536) if self.di_service is not None else None
+        triggered = self.wait_trigger() if self.wait_trigger is not None else True
+        if (not triggered) or (not self.running):
+            if ttl_edges is not None:
+                ttl_edges.close()
+            return self.stats()
+        if self.wait_trigger is not None:
+            self.trigger_ns = triggered if type(triggered) is int else time.perf_counter_ns()
+
+        self.writers = WriterPool({'video' : VideoSink(self.video_name, self.frame_rate, self.video_codec),
+                                    'frames' : TableSink(self.frame_table_name, 'Frames')})
+        if self.storage=='container':
+            from lib.container import ContainerSink
+            self.writers.add('container', ContainerSink(self.container_name,
+                                                        attrs={'exp_name' : self.exp_name, 'frame_rate' : self.frame_rate}))
+        else:
+            os.makedirs(self.exp_dir, exist_ok=True)
+            self.writers.add('tiff', TiffSink())
+        if ttl_edges is not None:
+            self.writers.add('ttl', TtlTimelineSink(self.ttl_name, ttl_edges))
+        if self.dlclive is not None:
+            self.writers.add('pupil', PupilSink(self.csv_name, npz_path=self.npz_name if self.pupil_npz else None))
+        self.writers.start()
+
+        try:
+            self.camera.start(self.frame_rate)
+            self.scheduler.start()
+            if self.dlclive is not None:
+                self.inference = InferenceWorker(self.dlclive, self._pupil_estimated, policy=self.inference_policy)
+                self.inference.start()
+
+            for callback in self.on_started:
+                callback()
+
+            # n-th frame is captured at start + n / frame rate
+            idx = 0
+            while self.running and (idx < self.frames):
+                lateness = 0 if self.camera.self_paced else self.scheduler.wait(idx)
+                handle = self.camera.next_frame()
+                if handle is None:
+                    if getattr(self.camera, 'finished', False): # end of replay
+                        break
+                    continue
+                if self.camera.self_paced:
+                    self.scheduler.tick() # measure frame rate only, the camera paces the frames
+
+                self._record_frame(handle, idx, lateness)
+                idx += 1
+        finally:
+            # any exit (end, stop, error or KeyboardInterrupt) closes the outputs
+            try:
+                self.camera.stop()
+                if self.inference is not None:
+                    self.inference.stop(drain=True)
+            finally:
+                self.writers.stop(flush=True) # pending frames and pupil data are written before returning
+                self.running = False
+
+        stats = self.stats()
+        logger.debug(f'recording finished {stats}')
+        return stats
+
+    def _record_frame(self, handle: FrameHandle, idx: int, lateness: int):
+        if idx==0: # reference of relative imaging time
+            self.first_time_stamp = handle.time_stamp
+            self.first_frame_ns = time.perf_counter_ns()
+
+        frame_data = {'index' : idx,
+                        'frame_rate' : self.scheduler.measured_frame_rate,
+                        'lateness' : lateness / 1e9,
+                        'write_queue' : max(sink.queue_depth for sink in self.writers.sinks.values())}
+        if self.inference is not None:
+            frame_data['inference'] = self.inference.stats()
+            self.inference.submit(handle.share(), idx)
+
+        for callback in self.on_frame:
+            callback(handle, frame_data)
+
+        self._save_frame(handle, idx)
+        handle.release()
+
+        self.recorded = idx + 1
+        for callback in self.on_saved:
+            callback(idx)
+
+    def _save_frame(self, handle: FrameHandle, idx: int):
+        # each sink owns a shared handle and releases it after writing
+        if self.storage=='container':
+            self.writers.submit('container', (handle.share(), idx))
+        else:
+            self.writers.submit('tiff', (handle.share(), os.path.join(self.exp_dir, frame_name(idx, handle.time_stamp))))
+        self.writers.submit('video', handle.share())
+        self.writers.submit('frames', {'index' : idx,
+                                        'frame_number' : handle.frame_number,
+                                        'time_stamp' : handle.time_stamp.strftime(FRAME_TABLE_TIME_FORMAT)})
+
+    def _pupil_estimated(self, pupil: Dict):
+        '''
+        save pupil size and metadata of a recorded frame, called from the inference worker thread
+        '''
+        self._save_pupil(pupil)
+        for callback in self.on_pupil:
+            callback(pupil)
+
+    def _save_pupil(self, pupil: Dict):
+        idx = pupil['index']
+        row = {}
+        metadata_row(row, idx, frame_name(idx, pupil['time_stamp']), pupil['time_stamp'], self.first_time_stamp)
+        pupil_row(row, pupil['dlc_output'])
+        self.writers.submit('pupil', row)
+
+    def stats(self) -> Dict:
+        stats = {'exp_dir' : self.exp_dir,
+                    'recorded' : self.recorded,
+                    'pacing' : self.scheduler.stats()}
+        if (self.trigger_ns is not None) and (self.first_frame_ns is not None):
+            stats['trigger_to_first_frame'] = (self.first_frame_ns - self.trigger_ns) / 1e9
+        if self.inference is not None:
+            stats['inference'] = self.inference.stats()
+        if self.writers is not None:
+            stats['writers'] = self.writers.stats()
+        return stats
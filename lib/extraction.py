@@ -0,0 +1,585 @@
+import os, copy, csv, threading, time
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+import cv2
+from skimage import io
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
+from lib.utils import find_circles, frame_name, metadata_row, pupil_row, FRAME_TABLE_TIME_FORMAT
+from lib.writers import PupilTableWriter
+from lib.session import SessionIndex, SessionManifest, model_hash
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+IMG_FORMATS = ('.tif', '.jpg', '.png', '.jpeg')
+
+def _decode_skimage(path: str) -> np.ndarray:
+    return io.imread(path)
+
+def _decode_cv2(path: str) -> np.ndarray:
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError(f'cv2 failed to decode {path}')
+    return img[:, :, ::-1].copy() if img.ndim==3 else img # BGR -> RGB
+
+def _decode_tifffile(path: str) -> np.ndarray:
+    import tifffile
+    try:
+        return np.array(tifffile.memmap(path, mode='r')) # uncompressed tiff (recorder output) is read without decoding
+    except ValueError:
+        return tifffile.imread(path)
+
+# image decoders of the prefetch reader
+DECODERS = {'skimage' : _decode_skimage,
+            'cv2' : _decode_cv2,
+            'tifffile' : _decode_tifffile}
+
+def select_decoder(paths: List[str], candidates: Union[List[str], None]=None) -> str:
+    '''
+    measure the decoding throughput on sample images and return the fastest decoder
+    decoders which are not installed, fail or give a different image from skimage are excluded,
+    skimage is used if a sample image can't be read
+    '''
+    candidates = list(DECODERS) if candidates is None else candidates
+    if len(paths)==0:
+        return 'skimage'
+
+    try:
+        reference = [_decode_skimage(path) for path in paths]
+    except Exception as e: # the unreadable frame fails only its own shard
+        logger.warning(f'decoder is not measured, skimage is used : {e}')
+        return 'skimage'
+    elapsed = {}
+    for name in candidates:
+        decode = DECODERS[name]
+        try:
+            decode(paths[0]) # warm up (import, file cache)
+            start = time.perf_counter()
+            imgs = [decode(path) for path in paths]
+            elapsed[name] = time.perf_counter() - start
+        except Exception:
+            continue
+        if any((img.shape!=ref.shape) or (not np.array_equal(img, ref)) for img, ref in zip(imgs, reference)):
+            del elapsed[name]
+    if len(elapsed)==0:
+        return 'skimage'
+    decoder = min(elapsed, key=elapsed.get)
+    logger.debug(f'decoder throughput (sec / {len(paths)} images) {elapsed}, {decoder} is selected')
+    return decoder
+
+class PrefetchReader():
+    '''
+    Streaming image reader, upcoming frames are decoded on a thread pool into a bounded prefetch queue
+    while the consumer (inference) works on the current one, frames are yielded in order
+
+    for key, img in PrefetchReader([(key, path), ...], decode):
+    '''
+    def __init__(self, items: List[Tuple], decode: Callable[[str], np.ndarray], threads: int=2, depth: int=16):
+        '''
+        ----------
+        Input Args
+        -----------
+        items : list
+            (key, path) of the images in reading order
+        decode : callable
+            image decoder, path -> image
+        threads : int
+            number of decoding threads
+        depth : int
+            maximum number of decoded (or decoding) images waiting for the consumer
+        '''
+        self.items = items
+        self.decode = decode
+        self.threads = threads
+        self.depth = depth
+
+    def __iter__(self) -> Iterator[Tuple]:
+        items = iter(self.items)
+        pending = deque()
+        with ThreadPoolExecutor(self.threads, thread_name_prefix='Prefetch') as executor:
+            for key, path in items:
+                pending.append((key, executor.submit(self.decode, path)))
+                if len(pending)==self.depth:
+                    break
+            while pending:
+                key, future = pending.popleft()
+                for next_key, path in items: # keep the prefetch queue full
+                    pending.append((next_key, executor.submit(self.decode, path)))
+                    break
+                yield key, future.result()
+
+# decoder selected for each image directory by select_decoder in the process reading it, shared by the shards of the directory
+_decoders = {}
+
+class ImageDirSource():
+    '''
+    Frames of a directory of images saved by the recorder, results are saved as {path}.csv
+    the frames are listed by the session index (lib.session), cached next to the directory
+    '''
+    def __init__(self, path: str, img_formats: Tuple[str, ...]=IMG_FORMATS, decoder: str='auto',
+                    prefetch_threads: int=2, prefetch_depth: int=16):
+        '''
+        ----------
+        Input Args
+        -----------
+        decoder : str
+            'skimage', 'cv2', 'tifffile' or 'auto' (the fastest on the first images read, measured by the reading process)
+        prefetch_threads, prefetch_depth : int
+            decoding threads and maximum number of prefetched images
+        '''
+        self.path = path
+        self.name = path
+        self.index = SessionIndex.load(path, img_formats)
+        self.img_names = self.index.img_names
+        self.offset = 0 # position of the first frame of the index (shard)
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_depth = prefetch_depth
+        self.decoder = decoder
+
+    def __len__(self) -> int:
+        return len(self.img_names)
+
+    def frame_indices(self) -> np.ndarray:
+        '''
+        image index of each frame, numbered after the recorded indices if the name has no index
+        '''
+        return self.index.indices
+
+    def shard(self, start: int, stop: int) -> 'ImageDirSource':
+        '''
+        copy holding only the index of the frames [start, stop), sent to a worker process instead of the whole session index
+        '''
+        shard = copy.copy(self)
+        first, last = start - self.offset, min(stop, self.offset + len(self)) - self.offset
+        shard.index = SessionIndex(self.index.path, self.img_names[first:last], self.index.indices[first:last],
+                                    self.index.time_stamps[first:last])
+        shard.img_names = shard.index.img_names
+        shard.offset = start
+        return shard
+
+    def read_range(self, start: int, stop: int) -> Iterator[Tuple[int, str, np.ndarray, Union[datetime, None]]]:
+        '''
+        ----------
+        Return
+        -----------
+        iterator of (image index, image name, image, time stamp)
+        '''
+        first, last = max(start, self.offset) - self.offset, min(stop, self.offset + len(self)) - self.offset
+        items = [(position, os.path.join(self.path, self.img_names[position])) for position in range(first, last)]
+        if self.decoder=='auto': # measured on the first read, only sessions with frames to extract are benchmarked
+            if self.path not in _decoders:
+                _decoders[self.path] = select_decoder([path for _, path in items[:8]])
+            self.decoder = _decoders[self.path]
+        reader = PrefetchReader(items, DECODERS[self.decoder], self.prefetch_threads, self.prefetch_depth)
+        for position, img in reader:
+            yield int(self.index.indices[position]), str(self.img_names[position]), img, self.index.time_stamp(position)
+
+class ContainerSource():
+    '''
+    Frames of a session container (lib.container), results are saved as {container name}.csv
+    the file is opened in the process reading it, so the source can be sent to the workers
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.splitext(path)[0]
+        self._reader = None
+        with self._open() as reader:
+            self._length = len(reader)
+
+    def _open(self):
+        from lib.container import SessionReader
+        return SessionReader(self.path)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getstate__(self) -> Dict:
+        state = dict(self.__dict__)
+        state['_reader'] = None
+        return state
+
+    def frame_indices(self) -> np.ndarray:
+        with self._open() as reader:
+            return reader.indices
+
+    def shard(self, start: int, stop: int) -> 'ContainerSource':
+        return self # the metadata is read from the file by the worker
+
+    def read_range(self, start: int, stop: int) -> Iterator[Tuple[int, str, np.ndarray, datetime]]:
+        if self._reader is None:
+            self._reader = self._open()
+        for position, (img_index, img, time_stamp) in enumerate(self._reader.iter_frames(start, stop), start):
+            yield img_index, self._reader.frame_name(position), img, time_stamp
+
+# capture of the process reading a video, kept open between the shards of the same video,
+# so a worker given the next shard of the video continues without seeking
+_video = {'path' : None, 'capture' : None, 'position' : None}
+
+class VideoSource():
+    '''
+    Frames of a recorded AVI file decoded as a stream (cv2.VideoCapture), results are saved as {video name}.csv
+    frame n of the video is the recorded index n, time stamps are joined by the index from
+        {video name}.frames.csv (frame table of the recorder)
+        {video name}/ (names of the recorded images)
+        {video name}.h5 (session container)
+    the capture is opened in the process reading it, so the source can be sent to the workers
+    '''
+    def __init__(self, path: str, img_formats: Tuple[str, ...]=IMG_FORMATS):
+        self.path = path
+        self.name = os.path.splitext(path)[0]
+
+        capture = self._open()
+        self._length = int(capture.get(cv2.CAP_PROP_FRAME_COUNT)) if capture.isOpened() else 0
+        capture.release()
+
+        self.time_stamps = self._load_time_stamps(img_formats)
+
+    def _open(self):
+        return cv2.VideoCapture(self.path)
+
+    def _load_time_stamps(self, img_formats: Tuple[str, ...]) -> Dict[int, datetime]:
+        '''
+        recorded index -> time stamp
+        '''
+        if os.path.isfile(f'{self.name}.frames.csv'):
+            with open(f'{self.name}.frames.csv', newline='') as f:
+                return {int(row['index']) : datetime.strptime(row['time_stamp'], FRAME_TABLE_TIME_FORMAT)
+                            for row in csv.DictReader(f)}
+
+        if os.path.isdir(self.name):
+            index = SessionIndex.load(self.name, img_formats)
+            return {int(img_index) : index.time_stamp(position) for position, img_index in enumerate(index.indices)}
+
+        if os.path.isfile(f'{self.name}.h5'):
+            from lib.container import SessionReader
+            with SessionReader(f'{self.name}.h5') as reader:
+                return {int(img_index) : reader.time_stamp(position) for position, img_index in enumerate(reader.indices)}
+        return {}
+
+    def __len__(self) -> int:
+        return self._length
+
+    def frame_indices(self) -> np.ndarray:
+        return np.arange(len(self), dtype=np.int64)
+
+    def shard(self, start: int, stop: int) -> 'VideoSource':
+        '''
+        copy holding only the time stamps of the frames [start, stop), sent to a worker process
+        '''
+        shard = copy.copy(self)
+        shard.time_stamps = {img_index : self.time_stamps[img_index] for img_index in range(start, min(stop, len(self)))
+                                if img_index in self.time_stamps}
+        return shard
+
+    def read_range(self, start: int, stop: int) -> Iterator[Tuple[int, str, np.ndarray, Union[datetime, None]]]:
+        if _video['path']!=self.path:
+            if _video['capture'] is not None:
+                _video['capture'].release()
+            _video.update(path=self.path, capture=self._open(), position=None)
+        capture = _video['capture']
+        if _video['position']!=start: # consecutive shards continue without seeking
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+        for img_index in range(start, min(stop, len(self))):
+            # the recorder writes RGB frames to the AVI file as they are, so the decoded frame is already RGB
+            ret, img = capture.read()
+            if not ret: # the shard fails, so the session is not reported as done with missing frames
+                _video['position'] = None
+                raise IOError(f'failed to decode frame {img_index} of "{self.path}" ({len(self)} frames)')
+            _video['position'] = img_index + 1
+
+            time_stamp = self.time_stamps.get(img_index)
+            img_name = f'{img_index:06d}' if time_stamp is None else frame_name(img_index, time_stamp)
+            yield img_index, img_name, img, time_stamp
+
+def find_sessions(path: str, img_formats: Tuple[str, ...]=IMG_FORMATS, decoder: str='auto') -> List:
+    '''
+    sessions of a selected path, one source per session name (images > session container > AVI file)
+        images in the directory
+        {path}.h5 or {path}.avi next to the directory
+        *.h5 and *.avi in the directory
+        .h5 or .avi file itself
+    '''
+    if os.path.isfile(path):
+        if path.endswith('.h5'):
+            return [ContainerSource(path)]
+        if path.endswith('.avi'):
+            return [VideoSource(path, img_formats)]
+        return []
+
+    sessions = {}
+    def _add(source):
+        if (source.name not in sessions) and (len(source) > 0):
+            sessions[source.name] = source
+
+    _add(ImageDirSource(path, img_formats, decoder))
+    if os.path.isfile(f'{path}.h5'):
+        _add(ContainerSource(f'{path}.h5'))
+    if os.path.isfile(f'{path}.avi'):
+        _add(VideoSource(f'{path}.avi', img_formats))
+
+    names = sorted(os.listdir(path))
+    for name in names:
+        if name.endswith('.h5'):
+            _add(ContainerSource(os.path.join(path, name)))
+    for name in names:
+        if name.endswith('.avi'):
+            _add(VideoSource(os.path.join(path, name), img_formats))
+    return list(sessions.values())
+
+def split_shards(positions: np.ndarray, chunk_size: int) -> List[Tuple[int, int]]:
+    '''
+    [start, stop) ranges of at most chunk_size frames covering the positions
+    '''
+    ranges = []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    for run in np.split(positions, breaks):
+        if len(run)==0:
+            continue
+        for start in range(int(run[0]), int(run[-1]) + 1, chunk_size):
+            ranges.append((start, min(start + chunk_size, int(run[-1]) + 1)))
+    return ranges
+
+# DeepLabCut model of the worker process, initialized once per process
+_dlclive = None
+
+def _init_worker(model_path: str):
+    global _dlclive
+    from dlclive import DLCLive, Processor
+    _dlclive = DLCLive(model_path, processor=Processor())
+    _dlclive.init_inference()
+
+def _extract_shard(source, start: int, stop: int) -> List[Tuple[int, str, Union[datetime, None], np.ndarray]]:
+    '''
+    key points of frames [start, stop) of the source, runs in a worker process
+    '''
+    return [(img_index, img_name, time_stamp, _dlclive.get_pose(img))
+                for img_index, img_name, img, time_stamp in source.read_range(start, stop)]
+
+class _SessionMerge():
+    '''
+    writes the shard results of a session in frame order, out of order shards wait until their turn,
+    rows are streamed to the CSV file in chunks of checkpoint_rows (fsync) and the manifest is checkpointed after each chunk,
+    so the memory stays constant regardless of the session length and a crash loses at most one chunk
+    '''
+    def __init__(self, source, num_shards: int, manifest: SessionManifest, npz: bool, checkpoint_rows: int):
+        self.source = source
+        self.num_shards = num_shards
+        self.manifest = manifest
+        self.table = PupilTableWriter(f'{source.name}.csv', npz_path=f'{source.name}.npz' if npz else None,
+                                        resume_from=manifest.csv_bytes if len(manifest.frames) > 0 else None,
+                                        flush_rows=checkpoint_rows, flush_interval=10.0, on_flush=self._checkpoint, fsync=True)
+        self.first_time_stamp = manifest.first_time_stamp
+        self.next_shard = 0
+        self.pending = {}
+        self.unflushed = deque() # image indices appended to the table and not flushed yet
+        self.failed = False
+
+    def add(self, shard: int, results: List):
+        self.pending[shard] = results
+        while self.next_shard in self.pending:
+            results = self.pending.pop(self.next_shard)
+            self.next_shard += 1
+            if len(results)==0:
+                continue
+
+            # circles of the whole shard are fitted at once
+            circles = zip(*find_circles(np.stack([dlc_output for _, _, _, dlc_output in results]))[:3])
+            for (img_index, img_name, time_stamp, dlc_output), circle in zip(results, circles):
+                if (time_stamp is not None) and (img_index==0): # if first image, save time stamp to get relative imaging time
+                    self.first_time_stamp = time_stamp
+                    self.manifest.first_time_stamp = time_stamp
+
+                row = {}
+                metadata_row(row, img_index, img_name, time_stamp, self.first_time_stamp)
+                pupil_row(row, dlc_output, circle)
+                self.unflushed.append(img_index)
+                self.table.append(row)
+
+    def _checkpoint(self, count: int, csv_bytes: int):
+        self.manifest.checkpoint([self.unflushed.popleft() for _ in range(count)], csv_bytes)
+
+    @property
+    def done(self) -> bool:
+        return self.next_shard==self.num_shards
+
+    def close(self):
+        self.table.close()
+
+class BatchExtractor():
+    '''
+    Offline pupil extraction over many sessions on a process pool
+    frames of every session are split into shards of chunk_size frames, each worker process
+    has its own initialized DLCLive, and the results are merged in frame order per session
+
+    progress(done, total) is called with the number of extracted frames,
+    cancel() stops submitting shards, running shards finish and pending ones are dropped
+
+    with resume, the frames recorded in the manifest of the session (lib.session) are skipped
+    and the new results are appended, the session is extracted again if the model has changed
+    '''
+    def __init__(self, model_path: str, workers: Union[int, None]=None, chunk_size: int=256,
+                    img_formats: Tuple[str, ...]=IMG_FORMATS, decoder: str='auto', npz: bool=False, resume: bool=True,
+                    checkpoint_rows: int=1024,
+                    progress: Union[Callable[[int, int], None], None]=None):
+        '''
+        ----------
+        Input Args
+        -----------
+        model_path : str
+            DeepLabCut model directory containing "pose_cfg.yaml"
+        workers : int or None
+            number of worker processes, half of the CPU cores if None
+            (each process loads the model, mind the GPU memory)
+        chunk_size : int
+            number of frames in a shard
+        img_formats : tuple
+            extensions of image files
+        decoder : str
+            image decoder, 'skimage', 'cv2', 'tifffile' or 'auto' (measured per directory)
+        npz : bool
+            save the pupil data also as columnar numpy file ({session}.npz)
+        resume : bool
+            True : extract only the frames missing in the results of the same model
+            False : extract every frame again
+        checkpoint_rows : int
+            number of rows written (and synchronized to the disk) at once
+        progress : callable or None
+            called with (extracted frames, total frames)
+        '''
+        self.model_path = model_path
+        self.workers = max(1, (os.cpu_count() or 2) // 2) if workers is None else workers
+        self.chunk_size = chunk_size
+        self.img_formats = img_formats
+        self.decoder = decoder
+        self.npz = npz
+        self.resume = resume
+        self.checkpoint_rows = checkpoint_rows
+        self.progress = progress
+        self._cancel = threading.Event()
+
+        self.total = 0
+        self.done = 0
+        self.sessions = {}
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def run(self, paths: List[str]) -> Dict:
+        '''
+        extract pupil size of every session in the paths, blocks until finished or cancelled
+
+        ----------
+        Return
+        -----------
+        stats : dict
+            sessions (frames and state per session), extracted frames, elapsed time and throughput
+        '''
+        start_time = time.perf_counter()
+        self._cancel.clear()
+
+        model = model_hash(self.model_path)
+        sources = {} # a session reached by several paths (e.g. Exp_0000 and Exp_0000.avi) is extracted once
+        for path in paths:
+            for source in find_sessions(path, self.img_formats, self.decoder):
+                sources.setdefault(source.name, source)
+        sources = list(sources.values())
+
+        shards, manifests = [], {}
+        self.sessions = {}
+        for source in sources:
+            manifest = SessionManifest.resume(source.name, model) if self.resume else SessionManifest(source.name, model)
+            missing = np.flatnonzero(~manifest.processed(source.frame_indices()))
+            session_shards = split_shards(missing, self.chunk_size)
+
+            manifests[source.name] = manifest
+            shards += [(source, start, stop, number, len(session_shards)) for number, (start, stop) in enumerate(session_shards)]
+            self.sessions[source.name] = {'frames' : len(source), 'extracted' : 0, 'skipped' : len(source) - len(missing),
+                                            'state' : 'pending' if len(missing) > 0 else 'done'}
+        self.total = sum(stop - start for _, start, stop, _, _ in shards)
+        self.done = 0
+
+        merges = {}
+        if len(shards) > 0:
+            with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.model_path, )) as executor:
+                self._run_shards(executor, shards, manifests, merges)
+
+        for merge in merges.values(): # unfinished sessions (cancelled or failed)
+            merge.close()
+            session = self.sessions[merge.source.name]
+            session['state'] = 'failed' if merge.failed else 'cancelled'
+
+        elapsed = time.perf_counter() - start_time
+        return {'sessions' : self.sessions,
+                'frames' : self.done,
+                'total' : self.total,
+                'cancelled' : self.cancelled,
+                'elapsed' : elapsed,
+                'fps' : self.done / elapsed if elapsed > 0 else 0.0,
+                'workers' : self.workers}
+
+    def _run_shards(self, executor: ProcessPoolExecutor, shards: List, manifests: Dict, merges: Dict):
+        # bounded number of shards in flight, later shards are submitted as earlier ones finish
+        max_in_flight = self.workers * 2
+        queued = iter(shards)
+        in_flight = {}
+
+        def _submit_next() -> bool:
+            for source, start, stop, number, num_shards in queued:
+                if self.sessions[source.name]['state']=='failed':
+                    continue
+                if source.name not in merges:
+                    merges[source.name] = _SessionMerge(source, num_shards, manifests[source.name], self.npz, self.checkpoint_rows)
+                    self.sessions[source.name]['state'] = 'running'
+                # each shard carries only its own names and time stamps, not the metadata of the whole session
+                in_flight[executor.submit(_extract_shard, source.shard(start, stop), start, stop)] = (source, number)
+                return True
+            return False
+
+        while (len(in_flight) < max_in_flight) and _submit_next():
+            pass
+
+        while in_flight:
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                source, number = in_flight.pop(future)
+                merge = merges[source.name]
+                session = self.sessions[source.name]
+                if future.cancelled():
+                    continue
+                try:
+                    results = future.result()
+                except Exception as e:
+                    logger.error(f'failed to extract "{source.name}" : {e}')
+                    merge.failed = True
+                    session['state'] = 'failed'
+                    continue
+                if merge.failed:
+                    continue
+
+                merge.add(number, results)
+                session['extracted'] += len(results)
+                self.done += len(results)
+                if merge.done:
+                    merge.close()
+                    del merges[source.name]
+                    session['state'] = 'done'
+                    logger.debug(f'pupil size extracted "{source.name}"')
+
+                if self.progress is not None:
+                    self.progress(self.done, self.total)
+
+            if self.cancelled:
+                for future in in_flight:
+                    future.cancel()
+                continue
+            while (len(in_flight) < max_in_flight) and _submit_next():
+                pass
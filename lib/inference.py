@@ -0,0 +1,176 @@
+import threading, time
+from collections import deque
+from typing import Callable, Dict, Union
+
+from lib.buffers import FrameHandle
+from lib.utils import find_circle
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+class InferenceWorker():
+    '''
+    Pupil fitting stage running on its own thread
+    frames are submitted to a bounded queue and results are delivered to the callback with the frame index,
+    so a slow inference never stalls the acquisition loop,
+    a frame failing the inference (or the callback) is counted and logged, and the worker goes on with the next one
+
+    backpressure policy when the queue is full
+        'block' : submit waits until the worker takes a frame (every frame is inferred)
+        'drop_oldest' : the oldest pending frame is skipped
+        'latest' : only the most recent frame is kept, pending frames are skipped
+    '''
+    policies = ('block', 'drop_oldest', 'latest')
+
+    def __init__(self, dlclive, callback: Callable[[Dict], None], policy: str='drop_oldest', queue_size: int=8):
+        '''
+        ----------
+        Input Args
+        -----------
+        dlclive : dlclive.DLCLive
+            initialized DeepLabCut live model
+        callback : callable
+            called from the worker thread with the pupil fitting result (dict)
+        policy : str
+            backpressure policy, 'block', 'drop_oldest' or 'latest'
+        queue_size : int
+            maximum number of pending frames
+        '''
+        assert policy in self.policies, f'policy must be one of {self.policies}'
+        self.dlclive = dlclive
+        self.callback = callback
+        self.policy = policy
+        self.queue_size = 1 if policy=='latest' else queue_size
+
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.running = False
+
+        # counters
+        self.submitted = 0
+        self.processed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.last_latency = 0.0 # seconds from submit to result
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name='InferenceWorker', daemon=True)
+        self._thread.start()
+
+    def stop(self, drain: bool=False, timeout: float=10.0):
+        '''
+        stop the worker
+
+        ----------
+        Input Args
+        -----------
+        drain : bool
+            True : infer the pending frames before stopping
+            False : the pending frames are skipped and released
+        timeout : float
+            maximum waiting time for the worker thread
+        '''
+        with self._condition:
+            if drain:
+                deadline = time.perf_counter() + timeout
+                while self._pending and (time.perf_counter() < deadline):
+                    self._condition.wait(0.1)
+            self.running = False
+            while self._pending:
+                self._skip(self._pending.popleft())
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, frame: FrameHandle, index: Union[int, None]=None) -> bool:
+        '''
+        queue a frame for inference, the worker owns (and releases) the frame handle
+
+        ----------
+        Input Args
+        -----------
+        frame : FrameHandle
+            frame to infer
+        index : int or None
+            recording index of the frame, None for live display
+
+        ----------
+        Return
+        -----------
+        queued : bool
+            False if the worker is not running
+        '''
+        with self._condition:
+            if self.policy=='block':
+                while self.running and len(self._pending) >= self.queue_size:
+                    self._condition.wait()
+            else:
+                while len(self._pending) >= self.queue_size:
+                    self._skip(self._pending.popleft())
+
+            if not self.running:
+                frame.release()
+                return False
+
+            self._pending.append((frame, index, time.perf_counter()))
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+            self._condition.notify_all()
+        return True
+
+    def _skip(self, item):
+        frame, _, _ = item
+        frame.release()
+        self.skipped += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self.running and not self._pending:
+                    self._condition.wait()
+                if not self.running:
+                    return
+                frame, index, submit_time = self._pending.popleft()
+                self._condition.notify_all()
+
+            try:
+                self._infer(frame, index, submit_time)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'pupil fitting failed (frame {index}) : {e}')
+
+    def _infer(self, frame: FrameHandle, index: Union[int, None], submit_time: float):
+        try:
+            dlc_output = self.dlclive.get_pose(frame.image)
+        finally:
+            frame.release()
+        center, diameter, probability, _ = find_circle(dlc_output)
+        self.processed += 1
+        self.last_latency = time.perf_counter() - submit_time
+
+        self.callback({'index' : index,
+                        'frame_number' : frame.frame_number,
+                        'time_stamp' : frame.time_stamp,
+                        'center' : center,
+                        'diameter' : diameter,
+                        'probability' : probability,
+                        'dlc_output' : dlc_output})
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> Dict:
+        return {'policy' : self.policy,
+                'queue_depth' : self.queue_depth,
+                'max_queue_depth' : self.max_queue_depth,
+                'submitted' : self.submitted,
+                'processed' : self.processed,
+                'skipped' : self.skipped,
+                'failed' : self.failed,
+                'latency' : self.last_latency}
@@ -0,0 +1,129 @@
+import time
+import numpy as np
+from typing import Dict, Union
+
+class DeadlineScheduler():
+    '''
+    Drift-free frame pacing on absolute deadlines
+    the n-th frame is due at start + n / frame_rate (time.perf_counter_ns),
+    so the error of each wait doesn't accumulate over the session
+
+    waiting is hybrid : sleep until spin_threshold before the deadline, then spin for sub-millisecond precision
+    '''
+    def __init__(self, frame_rate: float, spin_threshold: float=0.002, window: int=25):
+        '''
+        ----------
+        Input Args
+        -----------
+        frame_rate : float
+            target frame rate (Hz)
+        spin_threshold : float
+            time (sec) before the deadline to stop sleeping and start spinning
+        window : int
+            number of ticks to estimate the actual frame rate
+        '''
+        self.spin_threshold_ns = int(spin_threshold * 1e9)
+        self.window = window
+        self.set_frame_rate(frame_rate)
+        self.start()
+
+    def set_frame_rate(self, frame_rate: float):
+        '''
+        change the frame rate, the grid is rebased on the last deadline
+        '''
+        if hasattr(self, 'start_ns') and self.ticks > 0:
+            self.start_ns = self.deadline_ns(self.ticks)
+            self.index_offset = self.ticks
+        self.frame_rate = frame_rate
+        self.period_ns = int(round(1e9 / frame_rate))
+
+    def start(self, start_ns: Union[int, None]=None):
+        '''
+        reset the deadline grid
+
+        ----------
+        Input Args
+        -----------
+        start_ns : int or None
+            perf_counter_ns of the first deadline, now if None
+        '''
+        self.start_ns = time.perf_counter_ns() if start_ns is None else start_ns
+        self.index_offset = 0
+        self.ticks = 0
+
+        # lateness statistics (ns)
+        self.late_count = 0
+        self.lateness_sum = 0
+        self.lateness_max = 0
+        self.last_lateness = 0
+
+        # circular buffer of tick times to estimate frame rate
+        self._tick_times = np.zeros(self.window, dtype=np.int64)
+
+    def deadline_ns(self, index: int) -> int:
+        return self.start_ns + (index - self.index_offset) * self.period_ns
+
+    def wait(self, index: Union[int, None]=None) -> int:
+        '''
+        wait until the deadline of the frame
+
+        ----------
+        Input Args
+        -----------
+        index : int or None
+            frame index on the grid, the next tick if None
+
+        ----------
+        Return
+        -----------
+        lateness : int
+            time (ns) the deadline was already passed when wait was called, 0 if on time
+        '''
+        index = self.ticks if index is None else index
+        deadline = self.deadline_ns(index)
+
+        now = time.perf_counter_ns()
+        remain = deadline - now
+        if remain > self.spin_threshold_ns:
+            time.sleep((remain - self.spin_threshold_ns) / 1e9)
+        while time.perf_counter_ns() < deadline:
+            pass
+
+        lateness = max(now - deadline, 0)
+        self.last_lateness = lateness
+        if lateness > 0:
+            self.late_count += 1
+            self.lateness_sum += lateness
+            self.lateness_max = max(self.lateness_max, lateness)
+        self.tick()
+        return lateness
+
+    def tick(self, tick_ns: Union[int, None]=None):
+        '''
+        record the time of a frame for frame rate estimation
+        '''
+        self._tick_times[self.ticks % self.window] = time.perf_counter_ns() if tick_ns is None else tick_ns
+        self.ticks += 1
+
+    @property
+    def measured_frame_rate(self) -> float:
+        '''
+        frame rate averaged over the last window ticks
+        '''
+        count = min(self.ticks, self.window)
+        if count < 2:
+            return self.frame_rate
+        last = self._tick_times[(self.ticks - 1) % self.window]
+        first = self._tick_times[(self.ticks - count) % self.window]
+        return 0.0 if last==first else float((count - 1) * 1e9 / (last - first))
+
+    def stats(self) -> Dict:
+        '''
+        per-frame lateness statistics (sec)
+        '''
+        return {'frames' : self.ticks,
+                'late_frames' : self.late_count,
+                'mean_lateness' : self.lateness_sum / self.late_count / 1e9 if self.late_count else 0.0,
+                'max_lateness' : self.lateness_max / 1e9,
+                'last_lateness' : self.last_lateness / 1e9,
+                'frame_rate' : self.measured_frame_rate}
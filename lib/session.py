@@ -0,0 +1,260 @@
+import os, json, hashlib
+import numpy as np
+from datetime import datetime
+from typing import Dict, List, Tuple, Union
+
+MANIFEST_VERSION = 1
+
+def model_hash(model_path: str) -> str:
+    '''
+    sha1 of the DeepLabCut model, "pose_cfg.yaml" and weights (snapshot-*, *.pb) in the model directory
+    '''
+    names = sorted(names for names in os.listdir(model_path)
+                    if (names=='pose_cfg.yaml') or names.startswith('snapshot') or names.endswith('.pb'))
+    sha = hashlib.sha1()
+    for name in names:
+        sha.update(name.encode())
+        with open(os.path.join(model_path, name), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def _to_ranges(indices: np.ndarray) -> List[List[int]]:
+    '''
+    sorted unique indices -> [[start, stop), ...]
+    '''
+    if len(indices)==0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(indices)]])
+    return [[int(indices[start]), int(indices[stop - 1]) + 1] for start, stop in zip(starts, stops)]
+
+def _from_ranges(ranges: List[List[int]]) -> np.ndarray:
+    if len(ranges)==0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, stop, dtype=np.int64) for start, stop in ranges])
+
+class SessionManifest():
+    '''
+    Record of the offline extraction of a session, saved as {session}.manifest.json
+
+        model : hash of the DeepLabCut model which extracted the frames
+        frames : image indices whose pupil data are in the CSV file, saved as [start, stop) ranges
+        csv_bytes : size of the CSV file at the last checkpoint, rows after it are discarded on resume
+        first_time_stamp : time stamp of the frame 0, reference of relative imaging time
+        runs : time and number of frames of each extraction run
+
+    the manifest is replaced atomically at every checkpoint, so it never describes more rows than the CSV holds
+    '''
+    def __init__(self, session: str, model: str):
+        '''
+        ----------
+        Input Args
+        -----------
+        session : str
+            session name, path of the results without extension
+        model : str
+            hash of the DeepLabCut model (model_hash)
+        '''
+        self.session = session
+        self.path = f'{session}.manifest.json'
+        self.model = model
+        self.frames = np.zeros(0, dtype=np.int64)
+        self.csv_bytes = 0
+        self.first_time_stamp = None
+        self.created = datetime.now().isoformat()
+        self.updated = self.created
+        self.runs = []
+
+    @classmethod
+    def load(cls, session: str) -> Union['SessionManifest', None]:
+        '''
+        manifest of the session, None if there is no (readable) manifest
+        '''
+        try:
+            with open(f'{session}.manifest.json') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version')!=MANIFEST_VERSION:
+            return None
+
+        manifest = cls(session, data['model'])
+        manifest.frames = _from_ranges(data['frames'])
+        manifest.csv_bytes = data['csv_bytes']
+        manifest.first_time_stamp = None if data['first_time_stamp'] is None else datetime.fromisoformat(data['first_time_stamp'])
+        manifest.created = data['created']
+        manifest.updated = data['updated']
+        manifest.runs = data['runs']
+        return manifest
+
+    @classmethod
+    def resume(cls, session: str, model: str) -> 'SessionManifest':
+        '''
+        manifest to continue the extraction of the session with the model,
+        a new (empty) manifest if there is none, the model has changed or the results are lost
+        '''
+        manifest = cls.load(session)
+        if (manifest is None) or (manifest.model!=model) or (not manifest.results_valid()):
+            manifest = cls(session, model)
+        manifest.runs.append({'time' : datetime.now().isoformat(), 'frames' : 0})
+        return manifest
+
+    def results_valid(self) -> bool:
+        '''
+        the CSV file holds at least the rows recorded in the manifest
+        '''
+        csv_path = f'{self.session}.csv'
+        return os.path.isfile(csv_path) and (os.path.getsize(csv_path) >= self.csv_bytes)
+
+    def processed(self, indices: np.ndarray) -> np.ndarray:
+        '''
+        mask of the image indices already extracted with the model
+        '''
+        return np.isin(indices, self.frames)
+
+    def checkpoint(self, indices: List[int], csv_bytes: int):
+        '''
+        record newly written frames and the size of the CSV file
+        '''
+        if len(indices) > 0:
+            self.frames = np.union1d(self.frames, np.asarray(indices, dtype=np.int64))
+            if len(self.runs) > 0:
+                self.runs[-1]['frames'] += len(indices)
+        self.csv_bytes = csv_bytes
+        self.updated = datetime.now().isoformat()
+        self.save()
+
+    def save(self):
+        data = {'version' : MANIFEST_VERSION,
+                'model' : self.model,
+                'created' : self.created,
+                'updated' : self.updated,
+                'csv_bytes' : self.csv_bytes,
+                'first_time_stamp' : None if self.first_time_stamp is None else self.first_time_stamp.isoformat(),
+                'frames' : _to_ranges(self.frames),
+                'runs' : self.runs}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def to_dict(self) -> Dict:
+        return {'model' : self.model, 'frames' : len(self.frames), 'updated' : self.updated}
+
+INDEX_VERSION = 1
+
+def _columns(chars: np.ndarray, start: int, stop: int) -> np.ndarray:
+    '''
+    characters [start, stop) of every name, chars is (num_names, width) array of single characters
+    '''
+    return np.ascontiguousarray(chars[:, start:stop]).view(f'U{stop - start}')[:, 0]
+
+def parse_frame_names(img_names: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    vectorized parsing of recorded image names, {index}_{%Y-%m-%d_%Hhr-%Mmin-%S.%fsec}.tif
+    the index may have more than 6 digits
+
+    ----------
+    Return
+    -----------
+    indices : np.ndarray (int64)
+        image index, -1 if the name has no index
+    time_stamps : np.ndarray (datetime64[us])
+        time stamp, NaT if the name has no time stamp
+    '''
+    indices = np.full(len(img_names), -1, dtype=np.int64)
+    time_stamps = np.full(len(img_names), np.datetime64('NaT'), dtype='datetime64[us]')
+    if len(img_names)==0:
+        return indices, time_stamps
+
+    prefix, _, rest = np.char.partition(img_names.astype(str), '_').T
+    has_index = np.char.isdigit(prefix)
+    indices[has_index] = prefix[has_index].astype(np.int64)
+
+    # fixed positions of 2024-01-01_00hr-00min-00.000000sec
+    width = max(rest.dtype.itemsize // 4, 34)
+    chars = rest.astype(f'U{width}').view('U1').reshape(len(rest), width)
+    valid = has_index & (_columns(chars, 4, 5)=='-') & (_columns(chars, 10, 11)=='_') & (_columns(chars, 13, 16)=='hr-') \
+                & (_columns(chars, 18, 22)=='min-') & (_columns(chars, 24, 25)=='.') & (_columns(chars, 31, 34)=='sec')
+    iso = np.char.add(np.char.add(_columns(chars, 0, 10), 'T'), _columns(chars, 11, 13))
+    iso = np.char.add(np.char.add(np.char.add(iso, ':'), _columns(chars, 16, 18)), ':')
+    iso = np.char.add(iso, _columns(chars, 22, 31))
+    time_stamps[valid] = iso[valid].astype('datetime64[us]')
+    return indices, time_stamps
+
+class SessionIndex():
+    '''
+    Frame index of a directory of recorded images
+    the directory is scanned once with os.scandir, the names are parsed vectorized, and the result is cached
+    as a sidecar file {path}.index.npz next to the directory, which is invalidated by the mtime of the directory
+
+        img_names : image names sorted by index (names without index last, by name)
+        indices : image index (numbered after the largest recorded index if the name has no index)
+        time_stamps : datetime64[us], NaT if the name has no time stamp
+    '''
+    def __init__(self, path: str, img_names: np.ndarray, indices: np.ndarray, time_stamps: np.ndarray):
+        self.path = path
+        self.img_names = img_names
+        self.indices = indices
+        self.time_stamps = time_stamps
+
+    @classmethod
+    def load(cls, path: str, img_formats: Tuple[str, ...], cache: bool=True) -> 'SessionIndex':
+        '''
+        ----------
+        Input Args
+        -----------
+        path : str
+            directory of recorded images
+        img_formats : tuple
+            extensions of image files
+        cache : bool
+            read and write the sidecar index file
+        '''
+        path = os.path.normpath(path)
+        cache_path = f'{path}.index.npz'
+        mtime = os.stat(path).st_mtime_ns
+        formats = np.array(sorted(img_formats))
+
+        if cache and os.path.isfile(cache_path):
+            try:
+                with np.load(cache_path) as cached:
+                    if (int(cached['version'])==INDEX_VERSION) and (int(cached['mtime'])==mtime) \
+                        and np.array_equal(cached['img_formats'], formats):
+                        return cls(path, cached['img_names'], cached['indices'], cached['time_stamps'].astype('datetime64[us]'))
+            except (OSError, ValueError, KeyError):
+                pass
+
+        index = cls.scan(path, img_formats)
+        if cache:
+            try:
+                np.savez(cache_path, version=INDEX_VERSION, mtime=mtime, img_formats=formats, img_names=index.img_names,
+                            indices=index.indices, time_stamps=index.time_stamps.astype(np.int64))
+            except OSError: # read only directory, the index is not cached
+                pass
+        return index
+
+    @classmethod
+    def scan(cls, path: str, img_formats: Tuple[str, ...]) -> 'SessionIndex':
+        with os.scandir(path) as entries:
+            img_names = np.array([entry.name for entry in entries if entry.name.endswith(img_formats) and entry.is_file()], dtype=str)
+        indices, time_stamps = parse_frame_names(img_names)
+
+        no_index = indices < 0
+        order = np.lexsort((img_names, indices, no_index)) # by index, names without index last
+        img_names, indices, time_stamps, no_index = img_names[order], indices[order], time_stamps[order], no_index[order]
+        # numbered after the recorded indices, so they never collide in the manifest and the CSV file
+        first = indices[~no_index].max() + 1 if (~no_index).any() else 0
+        indices[no_index] = first + np.arange(no_index.sum())
+        return cls(path, img_names, indices, time_stamps)
+
+    def __len__(self) -> int:
+        return len(self.img_names)
+
+    def time_stamp(self, position: int) -> Union[datetime, None]:
+        time_stamp = self.time_stamps[position]
+        return None if np.isnat(time_stamp) else time_stamp.astype(datetime)
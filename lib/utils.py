@@ -1,5 +1,7 @@
+import re
 import numpy as np
-from typing import Tuple
+from typing import Dict, List, Tuple, Union
+from datetime import datetime
 import logging
 
 import logging.config
@@ -8,6 +10,66 @@ import os
 if not os.path.isdir('./logs'):
     os.makedirs('./logs', exist_ok=True)
     
+def find_circles(dlc_outputs: np.ndarray, rcond: float=1e-10) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Circle fitting of stacked key points, all frames are solved at once
+    ----------
+    Input Args
+    -----------
+    dlc_outputs : ndarray (3D, num_frame x num_keypoint x 3)
+        stacked outputs from DeepLabCut model
+        [coord x, coord y, probability]
+    rcond : float
+        singular values smaller than rcond * largest singular value are treated as zero (degenerate key points)
+
+    ----------
+    Return
+    -----------
+    centers : np.ndarray (num_frame x 2)
+        x, y coordinates for center of circles
+    diameters : np.ndarray (num_frame, )
+        diameter of circles
+    probabilities : np.ndarray (num_frame, )
+        averaged key point recognition probability
+    residuals : np.ndarray (num_frame, )
+        root mean square distance (pixel) between key points and fitted circle
+    '''
+    assert type(dlc_outputs)==np.ndarray, f'Input must be numpy array'
+    assert dlc_outputs.ndim==3, f'Input must be (num_frame, num_keypoint, 3) array'
+
+    coords = dlc_outputs[:, :, :-1].astype(np.float64) # key points x, y coordinates
+    probabilities = dlc_outputs[:, :, -1].mean(axis=1) # key point recognition probability
+    num_frame, num_points, _ = coords.shape
+
+    # key points are centered on their mean for the conditioning of A
+    origin = coords.mean(axis=1, keepdims=True)
+    local = coords - origin
+
+    # to find the diameter and center of circle, Ac=b must be solved
+    # (x - xc)^2 + (y - yc)^2 = r^2 (circle equation)
+    # c0 + c1x + c2y = x^2 + y^2
+    # c0 = r^2 - xc^2 - yc^2, c1 = 2xc, c2 = 2yc
+    # the solution vector c that has least squared error, c^ = argmin_c |b - Ac|^2
+    # solved by SVD of A (c^ = V S^-1 U'b) instead of the normal equation (A'A)^-1(A'b),
+    # which squares the condition number of A
+    A = np.concatenate([np.ones((num_frame, num_points, 1)), local], axis=2)
+    b = (local**2).sum(axis=2)
+    U, S, Vt = np.linalg.svd(A, full_matrices=False)
+    cutoff = rcond * S[:, :1]
+    S_inv = np.divide(1, S, out=np.zeros_like(S), where=S > cutoff)
+    c = np.einsum('nji,nj,nkj,nk->ni', Vt, S_inv, U, b)
+
+    local_centers = c[:, 1:] / 2
+    centers = local_centers + origin[:, 0]
+    with np.errstate(invalid='ignore'):
+        radius = np.sqrt(c[:, 0] + (local_centers**2).sum(axis=1))
+    diameters = radius * 2
+
+    distance = np.linalg.norm(local - local_centers[:, None], axis=2)
+    residuals = np.sqrt(((distance - radius[:, None])**2).mean(axis=1))
+
+    return centers, diameters, probabilities, residuals
+
 def find_circle(dlc_output: np.ndarray) -> Tuple[np.ndarray, float, float, int]:
     '''
     ----------
@@ -31,27 +93,8 @@ def find_circle(dlc_output: np.ndarray) -> Tuple[np.ndarray, float, float, int]:
     '''
     assert type(dlc_output)==np.ndarray, f'Input must be numpy array'
 
-    coords = dlc_output[:, :-1] # key points x, y coordinated
-    probability = dlc_output[:, -1].mean() # key point recognition probability
-    num_points = coords.shape[0] # Number of key points
-
-    # to find the diameter and center of circle, Ac=b must be solved
-    # (x - xc)^2 + (y - yc)^2 = r^2 (circle equation)
-    # c0 + c1x + c2y = x^2 + y^2
-    # c0 = r^2 - xc^2, c1 = 2xc, c2 = 2yc
-    # vector c = [c0, c1, c2].T
-    # the solution vector c that has least squared error, c^ = argmin_c |b - Ac|^2 
-    # c^ = (A'A)^-1(A'b), (A' = transpose A)
-    A = np.concatenate([np.ones((num_points, 1)), coords], axis=1)
-    b = (A**2)[:, 1:].sum(axis=1)
-    c = np.linalg.inv(A.T.dot(A)).dot(A.T).dot(b)
-
-    xc = c[1] / 2
-    yc = c[2] / 2
-    center = np.array([xc, yc])
-    diameter = np.sqrt(c[0] + xc**2 + yc**2)*2
-
-    return center, diameter, probability, num_points
+    centers, diameters, probabilities, _ = find_circles(dlc_output[None])
+    return centers[0], diameters[0], probabilities[0], dlc_output.shape[0]
 
 def make_circle(center: np.ndarray, diameter, num_sample: int=256) -> np.ndarray:
     '''
@@ -77,7 +120,108 @@ def make_circle(center: np.ndarray, diameter, num_sample: int=256) -> np.ndarray
     circle_points = np.vstack((x, y)).T + center
     return circle_points
 
+# time stamp format in the name of recorded image
+TIME_STAMP_FORMAT = '%Y-%m-%d_%Hhr-%Mmin-%S.%fsec'
+
+def frame_name(index: int, time_stamp: datetime, ext: str='.tif') -> str:
+    '''
+    name of recorded image, {index:06d}_{time stamp}.tif
+    '''
+    return f'{index:06d}_{time_stamp.strftime(TIME_STAMP_FORMAT)}{ext}'
+
+# time stamp format in the frame table ({exp_name}.frames.csv) and pupil data
+FRAME_TABLE_TIME_FORMAT = '%Y-%m-%d_%H:%M:%S.%f'
+
+# recorded image name parser, {index:06d}_{time stamp}.tif
+FRAME_NAME_PARSER = re.compile(r'(?P<index>\d{6,})_(?P<time_stamp>\d{4}-\d{2}-\d{2}_\d{2}hr-\d{2}min-\d{2}.\d{6}sec).tif')
+
+def parse_frame_name(img_name: str) -> Tuple[Union[int, None], Union[datetime, None]]:
+    '''
+    index and time stamp from the name of recorded image, (None, None) if the name doesn't match
+    '''
+    meta = FRAME_NAME_PARSER.search(img_name)
+    if meta is None:
+        return None, None
+    return int(meta.group('index')), datetime.strptime(meta.group('time_stamp'), TIME_STAMP_FORMAT)
+
+def metadata_row(img_data: Dict, img_index: int, img_name: str, time_stamp: Union[datetime, None], first_time_stamp: Union[datetime, None]):
+    '''
+    Metadata columns of pupil data
+    ----------
+    Input Args
+    -----------
+    img_data : dict
+        dictionary to store metadate
+    img_index : int
+        index based on image name
+    img_name : str
+        image name
+    time_stamp : None or datetime.datetime
+        time stamp when image was acquired
+    first_time_stamp : None or datetime.datetime
+        time stamp of the first image, reference of relative imaging time
+    '''
+    img_data['index'] = img_index
+    img_data['img_name'] = img_name
+
+    # if no metadata, leave time columns empty
+    if (time_stamp is None) or (first_time_stamp is None):
+        img_data['time_stamp'], img_data['time (sec)'] = '', ''
+    else:
+        img_data['time_stamp'] = datetime.strftime(time_stamp, FRAME_TABLE_TIME_FORMAT)
+        img_data['time (sec)'] = (time_stamp - first_time_stamp).total_seconds() # relative imaging time
 
+def pupil_row(img_data: Dict, dlc_output: np.ndarray, circle: Union[Tuple[np.ndarray, float, float], None]=None):
+    '''
+    Pupil columns of pupil data, circle fitting and key point coordinates
+    ----------
+    Input Args
+    -----------
+    img_data : dict
+        dictionary to store pupil data
+    dlc_output : np.ndarray
+        key points coordinates and probability
+    circle : tuple or None
+        center, diameter and probability already fitted (find_circles of a batch), fitted from dlc_output if None
+    '''
+    if circle is None:
+        center, diameter, probability, num_points = find_circle(dlc_output) # dlc outputs
+    else:
+        (center, diameter, probability), num_points = circle, dlc_output.shape[0]
+    xc, yc = center # pupil center coordinates
+
+    for dlc_key, dlc_value in zip(['num_points', 'xc', 'yc', 'diameter', 'probability'], [num_points, xc, yc, diameter, probability]):
+        img_data[dlc_key] = dlc_value # store dlc output
+    
+    for idx, coords in enumerate(dlc_output): # extract key point coordinates
+        x, y, _ = coords
+        img_data[f'x{idx}'] = x # x-coordinate of n th key point 
+        img_data[f'y{idx}'] = y # y-coordinate of n th key point
+
+def parse_column(values: List[str], dtype: np.dtype) -> np.ndarray:
+    '''
+    CSV strings -> column of the dtype, empty numeric values become nan (float) or 0 (int)
+    '''
+    if dtype.kind=='U':
+        return np.array(values, dtype=dtype)
+    try:
+        return np.array(values, dtype=np.float64).astype(dtype)
+    except ValueError:
+        return np.array([float(value) if value!='' else np.nan for value in values]).astype(dtype)
+
+# record of the TTL edge timeline file ({exp_name}.ttl.bin), little endian, no header
+#   perf_counter_ns : time.perf_counter_ns of the edge (monotonic, intervals between edges)
+#   time_ns : the same instant on the clock of the frame time stamps (datetime.now()), ns since the epoch
+#   rising : 1 rising edge (TTL on), 0 falling edge (TTL off)
+#   data : value of the DI port confirming the edge
+TTL_EDGE_DTYPE = np.dtype([('perf_counter_ns', '<i8'), ('time_ns', '<i8'), ('rising', 'u1'), ('data', 'u1')])
+
+def read_ttl_timeline(path: str) -> np.ndarray:
+    '''
+    TTL edges of a session as a structured array of TTL_EDGE_DTYPE, a partial last record (crash) is ignored
+    '''
+    count = os.path.getsize(path) // TTL_EDGE_DTYPE.itemsize
+    return np.fromfile(path, dtype=TTL_EDGE_DTYPE, count=count)
 
         
 LOGGING_CONFIG = {
@@ -0,0 +1,374 @@
+import os, json, pickle, socket, threading, time
+import numpy as np
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple, Union
+
+from lib.extraction import find_sessions, split_shards, _SessionMerge, IMG_FORMATS
+from lib.session import SessionManifest, model_hash
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+QUEUE_VERSION = 1
+
+def worker_name() -> str:
+    '''
+    default worker name, {host}-{pid} (dots are reserved by the queue file names)
+    '''
+    return f'{socket.gethostname()}-{os.getpid()}'.replace('.', '-')
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f'{path}.{worker_name()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class WorkQueue():
+    '''
+    Offline extraction distributed over machines through a directory on shared storage
+
+        queue.json : model, options and creation time of the queue
+        sessions/{session}.pkl : source (lib.extraction) and number of shards of each session
+        pending/{item}.json : shards waiting for a worker, {item} is {session}_{shard number}
+        claimed/{item}.{worker} : shards being extracted, the mtime is the lease renewed by the worker
+        done/{item}.json, results/{item}.pkl : extracted shards and their key points
+        failed/{item}.json : shards whose extraction raised, with the error
+        merged/{session}.json : sessions whose results are written next to the session
+
+    a worker claims a shard by renaming it from pending/ to claimed/, which succeeds for exactly one worker,
+    a lease older than lease_timeout (crashed or disconnected worker) is moved back to pending/ by anyone polling the queue.
+    the coordinator merges the shards of a finished session into {session}.csv (and .npz) in frame order,
+    the same way as BatchExtractor, so a session can be resumed by either of them,
+    and merging a session again (coordinator crashed before merged/) appends only the frames missing in the manifest.
+    paths of the sessions and the model must be the same on every machine
+    '''
+    dirs = ('sessions', 'pending', 'claimed', 'done', 'results', 'failed', 'merged')
+
+    def __init__(self, root: str, lease_timeout: float=300.0):
+        '''
+        ----------
+        Input Args
+        -----------
+        root : str
+            queue directory on shared storage
+        lease_timeout : float
+            seconds without renewal until a claimed shard is given to another worker,
+            must be much longer than the extraction of a shard and the clock difference of the machines
+        '''
+        self.root = root
+        self.lease_timeout = lease_timeout
+        with open(self._path('queue.json')) as f:
+            self.config = json.load(f)
+        if self.config.get('version')!=QUEUE_VERSION:
+            raise ValueError(f'unsupported work queue version in {root}')
+        self._sessions = {}
+
+    @classmethod
+    def create(cls, root: str, model_path: str, paths: List[str], chunk_size: int=256,
+                img_formats: Tuple[str, ...]=IMG_FORMATS, decoder: str='auto', npz: bool=False, resume: bool=True,
+                checkpoint_rows: int=1024, lease_timeout: float=300.0) -> 'WorkQueue':
+        '''
+        write the shards of every session in the paths to a new queue,
+        options are the same as BatchExtractor
+        '''
+        if os.path.isfile(os.path.join(root, 'queue.json')):
+            raise FileExistsError(f'work queue already exists in {root}')
+        for name in cls.dirs:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+
+        model = model_hash(model_path)
+        sources = {}
+        for path in paths:
+            for source in find_sessions(path, img_formats, decoder):
+                sources.setdefault(source.name, source)
+
+        for number, source in enumerate(sources.values()):
+            session = f'{number:04d}'
+            manifest = SessionManifest.load(source.name) if resume else None
+            if (manifest is None) or (manifest.model!=model) or (not manifest.results_valid()):
+                manifest = SessionManifest(source.name, model)
+            missing = np.flatnonzero(~manifest.processed(source.frame_indices()))
+            shards = split_shards(missing, chunk_size)
+
+            _write_atomic(os.path.join(root, 'sessions', f'{session}.pkl'), pickle.dumps(
+                {'source' : source, 'num_shards' : len(shards), 'frames' : len(source), 'skipped' : len(source) - len(missing)}))
+            for shard, (start, stop) in enumerate(shards):
+                item = {'session' : session, 'shard' : shard, 'start' : start, 'stop' : stop}
+                _write_atomic(os.path.join(root, 'pending', f'{session}_{shard:06d}.json'), json.dumps(item).encode())
+            if len(shards)==0: # nothing to extract
+                _write_atomic(os.path.join(root, 'merged', f'{session}.json'), json.dumps({'name' : source.name}).encode())
+
+        config = {'version' : QUEUE_VERSION,
+                    'model_path' : os.path.abspath(model_path),
+                    'model' : model,
+                    'npz' : npz,
+                    'resume' : resume,
+                    'checkpoint_rows' : checkpoint_rows,
+                    'created' : datetime.now().isoformat()}
+        # queue.json is written last, workers never see a half-written queue
+        _write_atomic(os.path.join(root, 'queue.json'), json.dumps(config, indent=1).encode())
+        logger.info(f'work queue created "{root}", {len(sources)} sessions')
+        return cls(root, lease_timeout)
+
+    def _path(self, *names: str) -> str:
+        return os.path.join(self.root, *names)
+
+    def _items(self, name: str) -> List[str]:
+        '''
+        item names in a queue directory
+        '''
+        try:
+            return sorted(entry.split('.', 1)[0] for entry in os.listdir(self._path(name)) if not entry.endswith('.tmp'))
+        except FileNotFoundError:
+            return []
+
+    def session(self, session: str) -> Dict:
+        '''
+        source and number of shards of a session, loaded once
+        '''
+        if session not in self._sessions:
+            with open(self._path('sessions', f'{session}.pkl'), 'rb') as f:
+                self._sessions[session] = pickle.load(f)
+        return self._sessions[session]
+
+    def claim(self, worker: str) -> Union[Dict, None]:
+        '''
+        lease the next pending shard, None if no shard is pending
+        '''
+        for item in self._items('pending'):
+            pending = self._path('pending', f'{item}.json')
+            claimed = self._path('claimed', f'{item}.{worker}')
+            try:
+                os.utime(pending) # the lease starts fresh, the renamed file keeps its mtime
+                os.rename(pending, claimed)
+            except FileNotFoundError: # claimed by another worker
+                continue
+            with open(claimed) as f:
+                work = json.load(f)
+            work['item'] = item
+            work['lease'] = claimed
+            return work
+        return None
+
+    def renew(self, work: Dict) -> bool:
+        '''
+        extend the lease of a claimed shard, False if the lease has been lost
+        '''
+        try:
+            os.utime(work['lease'])
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, work: Dict, results: List) -> bool:
+        '''
+        save the results of a claimed shard, False if the lease had been lost
+        (the results are the same whichever worker extracted the shard, so they are kept anyway)
+        '''
+        _write_atomic(self._path('results', f'{work["item"]}.pkl'), pickle.dumps(results))
+        try:
+            os.rename(work['lease'], self._path('done', f'{work["item"]}.json'))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def fail(self, work: Dict, error: str):
+        '''
+        mark a claimed shard as failed, the session is not merged
+        '''
+        try:
+            os.rename(work['lease'], self._path('failed', f'{work["item"]}.json'))
+        except FileNotFoundError:
+            return
+        with open(self._path('failed', f'{work["item"]}.json'), 'w') as f:
+            json.dump(dict(work, error=error), f)
+
+    def reclaim_expired(self) -> int:
+        '''
+        move the shards with expired leases back to pending, returns the number of reclaimed shards
+        '''
+        reclaimed = 0
+        deadline = time.time() - self.lease_timeout
+        for entry in os.listdir(self._path('claimed')):
+            path = self._path('claimed', entry)
+            try:
+                if os.stat(path).st_mtime >= deadline:
+                    continue
+                os.rename(path, self._path('pending', f'{entry.split(".", 1)[0]}.json'))
+            except FileNotFoundError: # completed or reclaimed meanwhile
+                continue
+            logger.warning(f'lease of "{entry}" expired, shard returned to the queue')
+            reclaimed += 1
+        return reclaimed
+
+    def merge(self) -> List[str]:
+        '''
+        write the results of every session whose shards are all done, returns the names of the merged sessions
+        '''
+        merged = set(self._items('merged'))
+        failed = {item.split('_')[0] for item in self._items('failed')}
+        done = {}
+        for item in self._items('done'):
+            session, shard = item.split('_')
+            done.setdefault(session, []).append(int(shard))
+
+        names = []
+        for session, shards in sorted(done.items()):
+            meta = self.session(session)
+            if (session in merged) or (session in failed) or (len(shards) < meta['num_shards']):
+                continue
+            source = meta['source']
+            manifest = SessionManifest.resume(source.name, self.config['model']) if self.config['resume'] \
+                        else SessionManifest(source.name, self.config['model'])
+            merge = _SessionMerge(source, meta['num_shards'], manifest, self.config['npz'], self.config['checkpoint_rows'])
+            try:
+                for shard in range(meta['num_shards']):
+                    with open(self._path('results', f'{session}_{shard:06d}.pkl'), 'rb') as f:
+                        results = pickle.load(f)
+                    # frames already in the CSV file (merge interrupted after a checkpoint) are not appended again
+                    processed = manifest.processed(np.array([img_index for img_index, _, _, _ in results], dtype=np.int64))
+                    merge.add(shard, [result for result, skip in zip(results, processed) if not skip])
+            finally:
+                merge.close()
+            _write_atomic(self._path('merged', f'{session}.json'), json.dumps({'name' : source.name}).encode())
+            for shard in range(meta['num_shards']):
+                os.remove(self._path('results', f'{session}_{shard:06d}.pkl'))
+            logger.debug(f'pupil size extracted "{source.name}"')
+            names.append(source.name)
+        return names
+
+    def status(self) -> Dict:
+        '''
+        number of shards per state and state of each session
+        '''
+        counts = {name : self._items(name) for name in ('pending', 'claimed', 'done', 'failed')}
+        merged = set(self._items('merged'))
+        sessions = {}
+        for session in self._items('sessions'):
+            meta = self.session(session)
+            if session in merged:
+                state = 'done'
+            elif any(item.startswith(f'{session}_') for item in counts['failed']):
+                state = 'failed'
+            elif any(item.startswith(f'{session}_') for item in counts['done'] + counts['claimed']):
+                state = 'running'
+            else:
+                state = 'pending'
+            sessions[meta['source'].name] = {'frames' : meta['frames'], 'skipped' : meta['skipped'], 'state' : state}
+        return {'sessions' : sessions,
+                'shards' : {name : len(items) for name, items in counts.items()}}
+
+    @property
+    def finished(self) -> bool:
+        '''
+        every session is merged or failed
+        '''
+        merged = set(self._items('merged'))
+        failed = {item.split('_')[0] for item in self._items('failed')}
+        return all((session in merged) or (session in failed) for session in self._items('sessions'))
+
+    def wait(self, poll_interval: float=10.0, cancel: Union[threading.Event, None]=None,
+                progress: Union[Callable[[Dict], None], None]=None) -> Dict:
+        '''
+        coordinator loop, reclaims expired leases and merges finished sessions until every session is finished
+
+        ----------
+        Return
+        -----------
+        stats : dict
+            status of the queue, elapsed time and whether it was cancelled
+        '''
+        start_time = time.perf_counter()
+        cancel = threading.Event() if cancel is None else cancel
+        while True:
+            self.reclaim_expired()
+            self.merge()
+            if self.finished or cancel.wait(0):
+                break
+            if progress is not None:
+                progress(self.status())
+            cancel.wait(poll_interval)
+
+        stats = self.status()
+        stats['cancelled'] = cancel.is_set() and not self.finished
+        stats['elapsed'] = time.perf_counter() - start_time
+        return stats
+
+def run_worker(root: str, worker: Union[str, None]=None, model_path: Union[str, None]=None, lease_timeout: float=300.0,
+                poll_interval: float=5.0, cancel: Union[threading.Event, None]=None) -> Dict:
+    '''
+    extract the shards of a work queue until no shard is left, one DLCLive per worker process
+    the lease of the current shard is renewed by a thread while it is extracted
+
+    ----------
+    Input Args
+    -----------
+    root : str
+        queue directory on shared storage
+    worker : str or None
+        unique name of the worker, {host}-{pid} if None
+    model_path : str or None
+        DeepLabCut model directory, the model of the queue if None (must be the same model)
+    lease_timeout, poll_interval : float
+        seconds until an unrenewed lease expires, and between polls of an empty queue
+    cancel : threading.Event or None
+        stops after the current shard
+
+    ----------
+    Return
+    -----------
+    stats : dict
+        number of extracted shards and frames, lost leases, failed shards and throughput
+    '''
+    from lib.extraction import _init_worker, _extract_shard
+
+    work_queue = WorkQueue(root, lease_timeout)
+    worker = worker_name() if worker is None else worker.replace('.', '-')
+    cancel = threading.Event() if cancel is None else cancel
+    model_path = work_queue.config['model_path'] if model_path is None else model_path
+    if model_hash(model_path)!=work_queue.config['model']:
+        raise ValueError(f'model "{model_path}" differs from the model of the queue')
+    _init_worker(model_path)
+
+    stats = {'worker' : worker, 'shards' : 0, 'frames' : 0, 'lost_leases' : 0, 'failed' : 0}
+    start_time = time.perf_counter()
+    while not cancel.is_set():
+        work_queue.reclaim_expired()
+        work = work_queue.claim(worker)
+        if work is None:
+            if work_queue.status()['shards']['claimed']==0: # nothing pending and nobody working
+                break
+            cancel.wait(poll_interval) # shards of other workers may return to the queue
+            continue
+
+        extracted = threading.Event()
+        def _renew():
+            while not extracted.wait(lease_timeout / 3):
+                if not work_queue.renew(work):
+                    return
+        renewal = threading.Thread(target=_renew, daemon=True)
+        renewal.start()
+        try:
+            source = work_queue.session(work['session'])['source']
+            results = _extract_shard(source, work['start'], work['stop'])
+        except Exception as e:
+            logger.error(f'failed to extract shard {work["item"]} : {e}')
+            work_queue.fail(work, str(e))
+            stats['failed'] += 1
+            continue
+        finally:
+            extracted.set()
+            renewal.join()
+
+        if not work_queue.complete(work, results):
+            stats['lost_leases'] += 1
+        stats['shards'] += 1
+        stats['frames'] += len(results)
+
+    stats['cancelled'] = cancel.is_set()
+    stats['elapsed'] = time.perf_counter() - start_time
+    stats['fps'] = stats['frames'] / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+    return stats
@@ -0,0 +1,560 @@
+import os, csv, queue, threading, time, zipfile
+import numpy as np
+import cv2
+from skimage import io
+from typing import Any, Callable, Dict, Union
+
+from lib.buffers import FrameHandle
+from lib.utils import parse_column, TTL_EDGE_DTYPE
+
+from utils import CustomLogger
+
+logger = CustomLogger().info_logger
+
+class SinkWorker():
+    '''
+    Output sink running on its own thread
+    items are submitted to a bounded queue and written in order by the worker,
+    so disk I/O never runs on the acquisition loop or the UI thread
+
+    when the queue is full, submit blocks (saving never drops data),
+    the acquisition is throttled instead of growing the memory without bound
+
+    subclass implements _write(item) and optionally _close(),
+    _idle() is called when no item arrives for idle_timeout seconds (None : never)
+    '''
+    idle_timeout = None
+
+    def __init__(self, name: str, queue_size: int=64):
+        '''
+        ----------
+        Input Args
+        -----------
+        name : str
+            name of the sink (worker thread name)
+        queue_size : int
+            maximum number of pending items
+        '''
+        self.name = name
+        self.queue_size = queue_size
+        self._items = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self.running = False
+
+        # counters
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.blocked_time = 0.0 # seconds submit waited for a free queue slot
+        self.last_latency = 0.0 # seconds from submit to written
+        self.max_latency = 0.0
+        self._latency_sum = 0.0
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name=f'{self.name}Sink', daemon=True)
+        self._thread.start()
+
+    def stop(self, flush: bool=True, timeout: float=30.0):
+        '''
+        stop the worker and close the output
+
+        ----------
+        Input Args
+        -----------
+        flush : bool
+            True : write the pending items before stopping
+            False : the pending items are discarded
+        timeout : float
+            maximum waiting time for the worker thread
+        '''
+        if self._thread is None:
+            return
+        self.running = False
+        if not flush:
+            while True:
+                try:
+                    self._discard(self._items.get_nowait()[0])
+                except queue.Empty:
+                    break
+        self._items.put(None) # sentinel, the worker exits after the pending items
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f'{self.name} sink did not finish in {timeout} sec')
+        self._thread = None
+
+    def submit(self, item: Any) -> bool:
+        '''
+        queue an item to write, FrameHandle in the item is owned (and released) by the sink
+
+        ----------
+        Return
+        -----------
+        queued : bool
+            False if the sink is not running
+        '''
+        if not self.running:
+            self._discard(item)
+            return False
+
+        submit_time = time.perf_counter()
+        self._items.put((item, submit_time))
+        self.blocked_time += time.perf_counter() - submit_time
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._items.qsize())
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                entry = self._items.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._idle()
+                continue
+            if entry is None:
+                break
+            item, submit_time = entry
+            try:
+                self._write(item)
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'{self.name} sink failed to write : {e}')
+            finally:
+                self._discard(item)
+
+            latency = time.perf_counter() - submit_time
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self._latency_sum += latency
+
+        try:
+            self._close()
+        except Exception as e:
+            logger.error(f'{self.name} sink failed to close : {e}')
+
+    def _write(self, item: Any):
+        raise NotImplementedError
+
+    def _close(self):
+        pass
+
+    def _idle(self):
+        pass
+
+    def _discard(self, item: Any):
+        '''
+        release frame handles of a written (or discarded) item
+        '''
+        items = item if isinstance(item, tuple) else (item, )
+        for value in items:
+            if isinstance(value, FrameHandle):
+                value.release()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._items.qsize()
+
+    def stats(self) -> Dict:
+        return {'queue_depth' : self.queue_depth,
+                'max_queue_depth' : self.max_queue_depth,
+                'submitted' : self.submitted,
+                'written' : self.written,
+                'failed' : self.failed,
+                'blocked_time' : self.blocked_time,
+                'latency' : self.last_latency,
+                'max_latency' : self.max_latency,
+                'mean_latency' : self._latency_sum / self.written if self.written else 0.0}
+
+class TiffSink(SinkWorker):
+    '''
+    one image file per frame
+    item : (FrameHandle, file path)
+    '''
+    def __init__(self, queue_size: int=64):
+        super().__init__('Tiff', queue_size)
+
+    def _write(self, item):
+        handle, path = item
+        io.imsave(path, handle.image)
+
+class VideoSink(SinkWorker):
+    '''
+    AVI file, the writer is opened with the size of the first frame
+    item : FrameHandle
+    '''
+    def __init__(self, path: str, frame_rate: float, codec: str='MJPG', queue_size: int=64):
+        super().__init__('Video', queue_size)
+        self.path = path
+        self.frame_rate = frame_rate
+        self.codec = codec
+        self.video = None
+
+    def _write(self, handle: FrameHandle):
+        img = handle.image
+        if self.video is None:
+            fourcc = cv2.VideoWriter_fourcc(*self.codec) # set codec
+            self.video = cv2.VideoWriter(self.path, fourcc, self.frame_rate, (img.shape[1], img.shape[0]))
+        self.video.write(img)
+
+    def _close(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+
+# width of the string columns in the npz file
+NPZ_STR_WIDTH = 64
+
+class PupilTableWriter():
+    '''
+    Columnar pupil data writer
+    the CSV file is held open during the session, rows are gathered in typed numpy column buffers
+    and written every flush_rows rows or flush_interval seconds, instead of reopening the file for every frame
+
+    the columns are fixed by the first row (int -> int64, float -> float64, others -> str),
+    optionally the whole table is saved as a binary columnar file (.npz, one array per column) when closed,
+    the flushed columns are spilled to temporary files until then, so the memory doesn't grow with the session
+    '''
+    def __init__(self, path: str, flush_rows: int=64, flush_interval: float=1.0, npz_path: Union[str, None]=None,
+                    resume_from: Union[int, None]=None, on_flush: Union[Callable[[int, int], None], None]=None,
+                    fsync: bool=False):
+        '''
+        ----------
+        Input Args
+        -----------
+        path : str
+            path of the CSV file
+        flush_rows : int
+            number of buffered rows written at once
+        flush_interval : float
+            maximum time (sec) a row stays in the buffer
+        npz_path : str or None
+            path of the columnar copy (np.load(npz_path)['diameter']), not saved if None
+        resume_from : int or None
+            append to the existing CSV file truncated to this size (bytes), None starts a new file
+        on_flush : callable or None
+            called after each flush with (number of written rows, size of the CSV file in bytes)
+        fsync : bool
+            force the written rows to the disk before on_flush (checkpoint survives a power loss)
+        '''
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.npz_path = npz_path
+        self.resume_from = resume_from
+        self.on_flush = on_flush
+        self.fsync = fsync
+
+        self.columns = None
+        self._buffers = {}
+        self._spills = {} # flushed columns for the npz file, key -> (temporary file, dtype)
+        self._buffered = 0
+        self._file = None
+        self._writer = None
+        self._last_flush = time.perf_counter()
+        self.written = 0
+
+    def _create(self, row: Dict):
+        self.columns = list(row.keys())
+        for key, value in row.items():
+            if isinstance(value, (bool, np.bool_)):
+                dtype = object
+            elif isinstance(value, (int, np.integer)):
+                dtype = np.int64
+            elif isinstance(value, (float, np.floating)):
+                dtype = np.float64
+            else:
+                dtype = object
+            self._buffers[key] = np.empty(self.flush_rows, dtype=dtype)
+
+        if self.resume_from:
+            with open(self.path, 'r+b') as f: # drop the rows written after the last checkpoint
+                f.truncate(self.resume_from)
+        if self.npz_path is not None:
+            self._open_spills()
+
+        if self.resume_from:
+            self._file = open(self.path, 'a', newline='')
+            self._writer = csv.writer(self._file)
+        else:
+            self._file = open(self.path, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(self.columns)
+
+    def _open_spills(self):
+        os.makedirs(f'{self.npz_path}.spill', exist_ok=True)
+        for number, (key, buffer) in enumerate(self._buffers.items()):
+            dtype = np.dtype(f'U{NPZ_STR_WIDTH}') if buffer.dtype==object else buffer.dtype
+            self._spills[key] = (open(os.path.join(f'{self.npz_path}.spill', f'{number}.bin'), 'wb'), dtype)
+
+        # rows of the previous runs are only in the CSV file
+        if self.resume_from:
+            with open(self.path, newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None) # header
+                while True:
+                    rows = [row for _, row in zip(range(self.flush_rows), reader)]
+                    if len(rows)==0:
+                        break
+                    for key, values in zip(self.columns, zip(*rows)):
+                        self._spill(key, parse_column(values, self._spills[key][1]))
+
+    def _spill(self, key: str, column: np.ndarray):
+        spill, dtype = self._spills[key]
+        spill.write(column.astype(dtype).tobytes())
+
+    def append(self, row: Dict):
+        if self.columns is None:
+            self._create(row)
+
+        for key in self.columns:
+            buffer = self._buffers[key]
+            value = row.get(key, '')
+            try:
+                buffer[self._buffered] = value
+            except (TypeError, ValueError): # missing value in a numeric column
+                buffer[self._buffered] = np.nan if buffer.dtype==np.float64 else 0
+        self._buffered += 1
+
+        if (self._buffered==self.flush_rows) or (time.perf_counter() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''
+        write the buffered rows to the CSV file
+        '''
+        self._last_flush = time.perf_counter()
+        if self._buffered==0:
+            return
+
+        columns = [self._buffers[key][:self._buffered] for key in self.columns]
+        self._writer.writerows(zip(*[column.tolist() for column in columns]))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+        if self.npz_path is not None:
+            for key, column in zip(self.columns, columns):
+                self._spill(key, column)
+
+        self.written += self._buffered
+        count, self._buffered = self._buffered, 0
+        if self.on_flush is not None:
+            self.on_flush(count, self._file.tell())
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file, self._writer = None, None
+
+        if self.npz_path is not None:
+            self._write_npz()
+
+    def _write_npz(self):
+        '''
+        assemble the npz file from the spilled columns, each column is streamed from a memory map
+        '''
+        with zipfile.ZipFile(self.npz_path, 'w') as npz:
+            for key, (spill, dtype) in self._spills.items():
+                spill.close()
+                if os.path.getsize(spill.name) > 0:
+                    column = np.memmap(spill.name, dtype=dtype, mode='r')
+                else:
+                    column = np.zeros(0, dtype=dtype)
+                with npz.open(f'{key}.npy', 'w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, column, allow_pickle=False)
+                del column
+                os.remove(spill.name)
+        os.rmdir(f'{self.npz_path}.spill')
+        self._spills = {}
+
+    def __len__(self) -> int:
+        return self.written + self._buffered
+
+class TableSink(SinkWorker):
+    '''
+    table (CSV and optional npz) as an output sink of the writer pool
+    item : dict (one row)
+    '''
+    def __init__(self, path: str, name: str='Table', queue_size: int=256, **writer_kwargs):
+        super().__init__(name, queue_size)
+        self.table = PupilTableWriter(path, **writer_kwargs)
+        self.idle_timeout = self.table.flush_interval
+
+    def _write(self, row: Dict):
+        self.table.append(row)
+
+    def _idle(self):
+        if self.table.columns is not None:
+            self.table.flush()
+
+    def _close(self):
+        self.table.close()
+
+class PupilSink(TableSink):
+    '''
+    pupil data of the recorded frames
+    '''
+    def __init__(self, path: str, queue_size: int=256, **writer_kwargs):
+        super().__init__(path, 'Pupil', queue_size, **writer_kwargs)
+
+def clock_offset_ns() -> int:
+    '''
+    time.time_ns() - time.perf_counter_ns(), the wall clock is read between two monotonic reads
+    '''
+    start_ns = time.perf_counter_ns()
+    wall_ns = time.time_ns()
+    end_ns = time.perf_counter_ns()
+    return wall_ns - (start_ns + end_ns) // 2
+
+class TtlTimelineWriter():
+    '''
+    Binary TTL edge timeline writer
+    edges are gathered in a record buffer and appended to the file every flush_rows edges (or by flush),
+    the file holds fixed size records of TTL_EDGE_DTYPE, so it can be read while it grows and survives a crash
+    '''
+    def __init__(self, path: str, flush_rows: int=256):
+        '''
+        ----------
+        Input Args
+        -----------
+        path : str
+            path of the timeline file
+        flush_rows : int
+            number of buffered edges written at once
+        '''
+        self.path = path
+        self.flush_rows = flush_rows
+        self._buffer = np.zeros(flush_rows, dtype=TTL_EDGE_DTYPE)
+        self._buffered = 0
+        self._file = None
+        self.written = 0
+
+    def append(self, perf_counter_ns: int, time_ns: int, rising: bool, data: int):
+        self._buffer[self._buffered] = (perf_counter_ns, time_ns, rising, data & 0xFF)
+        self._buffered += 1
+        if self._buffered==self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+        if self._buffered==0:
+            return
+        self._file.write(self._buffer[:self._buffered].tobytes())
+        self._file.flush()
+        self.written += self._buffered
+        self._buffered = 0
+
+    def close(self):
+        self.flush() # an empty file records a session without edges
+        self._file.close()
+        self._file = None
+
+    def __len__(self) -> int:
+        return self.written + self._buffered
+
+class TtlTimelineSink(SinkWorker):
+    '''
+    TTL edge timeline as an output sink of the writer pool
+    the edges are not submitted, the worker drains a subscription of lib.daq.DiInputService every flush_interval,
+    so the sampling thread never waits for the disk and the CSV files get nothing per edge.
+    subscribe before waiting for the trigger to keep the trigger edge, the subscription buffers it until start
+
+    the offset between the monotonic and the wall clock is measured once when the sink starts,
+    so the intervals between the edges are those of time.perf_counter_ns in both time columns
+    item : lib.daq.DiEdge
+    '''
+    def __init__(self, path: str, subscription, flush_rows: int=256, flush_interval: float=1.0):
+        '''
+        ----------
+        Input Args
+        -----------
+        path : str
+            path of the timeline file
+        subscription : lib.daq.DiSubscription
+            edges to record, closed when the sink stops
+        flush_rows : int
+            number of buffered edges written at once
+        flush_interval : float
+            time (sec) between the drains of the subscription
+        '''
+        super().__init__('TtlTimeline')
+        self.subscription = subscription
+        self.timeline = TtlTimelineWriter(path, flush_rows)
+        self.idle_timeout = flush_interval
+        self.offset_ns = None # time.time_ns() - time.perf_counter_ns()
+
+    def start(self):
+        self.offset_ns = clock_offset_ns()
+        super().start()
+
+    def _write(self, edge):
+        self.timeline.append(edge.time_ns, edge.time_ns + self.offset_ns, edge.rising, edge.data[0])
+
+    def _drain(self):
+        while True:
+            edge = self.subscription.get(timeout=0)
+            if edge is None:
+                break
+            try:
+                self._write(edge)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'{self.name} sink failed to write : {e}')
+
+    def _idle(self):
+        self._drain()
+        self.timeline.flush()
+
+    def _close(self):
+        self._drain()
+        self.subscription.close()
+        self.timeline.close()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.subscription.edges)
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats.update({'queue_depth' : self.queue_depth,
+                        'edges' : len(self.timeline),
+                        'dropped' : self.subscription.dropped})
+        return stats
+
+class WriterPool():
+    '''
+    Group of output sinks of a recording session, each sink has a dedicated worker thread
+
+    pool = WriterPool({'tiff' : TiffSink(), 'video' : VideoSink(path, frame_rate)})
+    pool.start() -> pool.submit('tiff', (handle, path)) ... -> pool.stop() (flush)
+    '''
+    def __init__(self, sinks: Union[Dict[str, SinkWorker], None]=None):
+        self.sinks = {} if sinks is None else dict(sinks)
+
+    def add(self, name: str, sink: SinkWorker):
+        self.sinks[name] = sink
+        if self.running:
+            sink.start()
+
+    @property
+    def running(self) -> bool:
+        return any(sink.running for sink in self.sinks.values())
+
+    def start(self):
+        for sink in self.sinks.values():
+            sink.start()
+
+    def submit(self, name: str, item: Any) -> bool:
+        return self.sinks[name].submit(item)
+
+    def stop(self, flush: bool=True, timeout: float=30.0):
+        for sink in self.sinks.values():
+            sink.stop(flush, timeout)
+
+    def stats(self) -> Dict:
+        return {name : sink.stats() for name, sink in self.sinks.items()}
@@ -0,0 +1,97 @@
+import sys, os, argparse, json, threading, time
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+sys.path.append(LIB_DIR)
+if (sys.version_info.minor <= 7) and (sys.version_info.major==3): # add .dll search path for python 3.7 and older
+    os.environ['PATH'] = LIB_DIR + os.pathsep + os.environ['PATH']
+
+from lib.camera import TisCamera, ReplayCamera
+from lib.daq import DiInputService
+from lib.engine import RecordingEngine, wait_for_ttl, unique_exp_name
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Headless pupil recording, trigger wait -> capture -> infer -> save')
+    parser.add_argument('--save-dir', default=os.getcwd(), help='parent directory of the experiment')
+    parser.add_argument('--exp-name', default='Exp', help='experiment name, 4 digits nonce is added')
+    parser.add_argument('--frames', type=int, default=550, help='number of frames to record')
+    parser.add_argument('--frame-rate', type=float, default=2, help='recording frame rate (Hz)')
+    parser.add_argument('--model', default=None, help='DeepLabCut model directory containing "pose_cfg.yaml"')
+    parser.add_argument('--inference-policy', default='drop_oldest', choices=['block', 'drop_oldest', 'latest'],
+                        help='backpressure policy of the inference worker')
+    parser.add_argument('--storage', default='tiff', choices=['tiff', 'container'],
+                        help='tiff : one image file per frame, container : single HDF5 file ({exp_name}.h5)')
+    parser.add_argument('--npz', action='store_true', help='save the pupil data also as columnar numpy file ({exp_name}.npz)')
+    parser.add_argument('--trigger', action='store_true', help='start and stop the recording by TTL signal')
+    parser.add_argument('--trigger-device', default='USB-4751L,BID#0', help='description of trigger receiving device')
+    parser.add_argument('--trigger-port', type=int, default=2, help='DI port receiving TTL signal')
+    parser.add_argument('--trigger-mode', default='auto', choices=['auto', 'event', 'poll'],
+                        help='TTL detection, event : DI change of state/interrupt events, poll : read the port at --trigger-sample-rate')
+    parser.add_argument('--trigger-sample-rate', type=float, default=1000.0, help='sampling rate (Hz) of the port in poll mode')
+    parser.add_argument('--acquisition-mode', default='Callback', choices=['Callback', 'Snap'], help='camera acquisition mode')
+    parser.add_argument('--replay', default=None, help='AVI file or image directory replayed instead of the camera')
+    parser.add_argument('--replay-rate', type=float, default=None, help='replay frame rate (Hz), as fast as possible if not given')
+    return parser.parse_args()
+
+def load_model(model_path: str):
+    from dlclive import DLCLive, Processor
+    dlclive = DLCLive(model_path, processor=Processor())
+    dlclive.init_inference()
+    return dlclive
+
+def main():
+    args = parse_args()
+
+    if args.replay is None:
+        camera = TisCamera(os.path.join(LIB_DIR, 'tisgrabber_x64.dll'), acquisition_mode=args.acquisition_mode)
+    else:
+        camera = ReplayCamera(args.replay, frame_rate=args.replay_rate)
+    if not camera.is_valid():
+        sys.exit('Connect camera')
+
+    dlclive = None if args.model is None else load_model(args.model)
+
+    di_service = None
+    if args.trigger:
+        di_service = DiInputService(args.trigger_device, args.trigger_port, mode=args.trigger_mode,
+                                    sample_rate=args.trigger_sample_rate)
+        di_service.start()
+
+    exp_name = unique_exp_name(args.save_dir, args.exp_name)
+    engine = RecordingEngine(camera, args.save_dir, exp_name, args.frames, args.frame_rate,
+                                dlclive=dlclive, inference_policy=args.inference_policy, storage=args.storage,
+                                pupil_npz=args.npz, di_service=di_service)
+
+    if di_service is not None:
+        def _wait_ttl():
+            return wait_for_ttl(di_service, lambda: engine.running)
+        engine.wait_trigger = _wait_ttl
+
+        # the next TTL signal terminates the recording
+        def _terminate_by_ttl():
+            time.sleep(2) # wait 2s during TTL keeps high (5V) state
+            if _wait_ttl():
+                engine.stop()
+        engine.add_observer(on_started=lambda: threading.Thread(target=_terminate_by_ttl, daemon=True).start())
+
+    def _progress(idx: int):
+        if (idx + 1) % 100==0:
+            print(f'Progress | {idx+1:06d}/{args.frames:06d}', file=sys.stderr)
+    engine.add_observer(on_saved=_progress)
+
+    start_time = time.perf_counter()
+    try:
+        stats = engine.run()
+    except KeyboardInterrupt:
+        engine.stop()
+        stats = engine.stats()
+    finally:
+        camera.close()
+        if di_service is not None:
+            di_service.stop()
+    stats['elapsed'] = time.perf_counter() - start_time
+    if di_service is not None:
+        stats['trigger'] = di_service.stats()
+    print(json.dumps(stats, default=str))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,10 @@
+import os, sys, atexit, shutil, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'lib')]
+
+# the logger of lib.utils writes to ./logs, the tests (and the worker processes they spawn) run in a temporary directory
+# so nothing is written into the working tree
+_workdir = tempfile.mkdtemp(prefix='pupil-tests-')
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.chdir(_workdir)
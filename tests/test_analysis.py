@@ -0,0 +1,86 @@
+import time
+import numpy as np
+import pytest
+from datetime import datetime, timezone
+
+from lib.analysis import align_to_onsets, load_ttl_onsets, valid_mask
+from lib.utils import TTL_EDGE_DTYPE
+
+START = np.datetime64('2024-01-01T10:00:00', 'ns')
+
+def _times(seconds) -> np.ndarray:
+    return START + (np.asarray(seconds) * 1e9).astype('timedelta64[ns]')
+
+def test_interp_at_the_onsets():
+    frame_times = _times(np.arange(0, 10, 0.5))
+    values = np.arange(0, 10, 0.5) * 2 # linear trace, value = 2 * time
+    onsets = _times([1.25, 4.0, 7.75, 12.0])
+    aligned = align_to_onsets(frame_times, values, np.ones(len(values), dtype=bool), onsets)
+    assert np.allclose(aligned[:3], [2.5, 8.0, 15.5])
+    assert np.isnan(aligned[3]) # after the last frame
+
+def test_interp_skips_invalid_frames_and_max_gap_masks_blinks():
+    seconds = np.arange(0, 10, 0.5)
+    values = np.full(len(seconds), 5.0)
+    probability = np.full(len(seconds), 0.95)
+    probability[(seconds > 3) & (seconds < 6)] = 0.1 # blink from 3.5 to 5.5 sec
+    values[seconds==4.5] = np.nan
+    valid = valid_mask(values, probability, fit_threshold=0.9)
+    onsets = _times([1.0, 4.0, 8.0])
+
+    bridged = align_to_onsets(_times(seconds), values, valid, onsets)
+    assert np.allclose(bridged, 5)
+
+    masked = align_to_onsets(_times(seconds), values, valid, onsets, max_gap=1.0)
+    assert np.isclose(masked[0], 5) and np.isnan(masked[1]) and np.isclose(masked[2], 5)
+
+    # an onset exactly on a valid frame is kept even next to a gap
+    on_frame = align_to_onsets(_times(seconds), values, valid, _times([3.0]), max_gap=1.0)
+    assert np.isclose(on_frame[0], 5)
+
+def test_mean_per_volume():
+    seconds = np.arange(0, 6, 0.5)
+    values = seconds.copy()
+    valid = np.ones(len(values), dtype=bool)
+    valid[seconds==2.5] = False
+    onsets = _times([0.0, 2.0, 4.0])
+
+    # the last volume lasts tr (median onset interval if not given)
+    aligned = align_to_onsets(_times(seconds), values, valid, onsets, method='mean')
+    assert np.allclose(aligned, [0.75, 8.5 / 3, 4.75]) # volume 1 without the 2.5 sec frame : (2 + 3 + 3.5) / 3
+
+    short_tr = align_to_onsets(_times(seconds), values, valid, onsets, method='mean', tr=1.0)
+    assert np.allclose(short_tr, [0.75, 8.5 / 3, 4.25])
+
+def test_mean_of_a_volume_without_valid_frames_is_nan():
+    seconds = np.arange(0, 4, 0.5)
+    valid = seconds < 2
+    aligned = align_to_onsets(_times(seconds), seconds, valid, _times([0.0, 2.0]), method='mean')
+    assert np.isclose(aligned[0], 0.75) and np.isnan(aligned[1])
+
+def test_nat_frames_are_ignored():
+    frame_times = _times([0.0, 1.0, 2.0]).copy()
+    frame_times[1] = np.datetime64('NaT')
+    aligned = align_to_onsets(frame_times, np.array([0.0, 100.0, 2.0]), np.ones(3, dtype=bool), _times([1.0]))
+    assert np.isclose(aligned[0], 1.0)
+
+@pytest.fixture
+def berlin_time(monkeypatch):
+    monkeypatch.setenv('TZ', 'Europe/Berlin')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+@pytest.mark.skipif(not hasattr(time, 'tzset'), reason='time zone of the process can\'t be changed')
+def test_ttl_onsets_across_a_dst_change(tmp_path, berlin_time):
+    # 2024-03-31 01:00 UTC, local time jumps from 02:00 (CET) to 03:00 (CEST)
+    start_ns = int(datetime(2024, 3, 31, 0, 59, 30, tzinfo=timezone.utc).timestamp()) * 10**9
+    edges = np.zeros(4, dtype=TTL_EDGE_DTYPE)
+    edges['time_ns'] = start_ns + np.array([0, 10, 60, 120]) * 10**9
+    edges['rising'] = [1, 0, 1, 1]
+    edges.tofile(str(tmp_path / 'Exp_0000.ttl.bin'))
+
+    onsets = load_ttl_onsets(str(tmp_path / 'Exp_0000'))
+    assert onsets.tolist()==np.array(['2024-03-31T01:59:30', '2024-03-31T03:00:30', '2024-03-31T03:01:30'],
+                                        dtype='datetime64[ns]').tolist()
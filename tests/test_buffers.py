@@ -0,0 +1,23 @@
+import numpy as np
+
+from lib.buffers import TimeSeriesBuffer
+
+def test_moving_average_of_the_last_window():
+    values = np.random.RandomState(0).uniform(0, 10, 50)
+    series = TimeSeriesBuffer(capacity=4, avg_window=5) # grows past the initial capacity
+    for x, y in enumerate(values):
+        series.append(x, y)
+
+    expected = [values[max(n - 4, 0):n + 1].mean() for n in range(len(values))]
+    assert len(series)==50
+    assert np.allclose(series.x, np.arange(50))
+    assert np.allclose(series.y, values)
+    assert np.allclose(series.y_avg, expected)
+
+def test_last_and_between():
+    series = TimeSeriesBuffer(avg_window=3)
+    for x in range(10):
+        series.append(x * 0.5, x)
+    assert series.y[series.last(3)].tolist()==[7, 8, 9]
+    assert series.y[series.last(20)].tolist()==list(range(10))
+    assert series.x[series.between(1.0, 2.0)].tolist()==[1.0, 1.5, 2.0]
@@ -0,0 +1,25 @@
+from lib.pacing import DeadlineScheduler
+
+def test_deadlines_are_on_the_grid():
+    scheduler = DeadlineScheduler(frame_rate=4)
+    scheduler.start(start_ns=1000)
+    assert [scheduler.deadline_ns(index) for index in range(3)]==[1000, 250001000, 500001000]
+
+def test_set_frame_rate_rebases_on_the_last_deadline():
+    scheduler = DeadlineScheduler(frame_rate=2)
+    scheduler.start(start_ns=0)
+    for tick in range(3):
+        scheduler.tick(tick * 500000000)
+
+    # the next frame (3) keeps the deadline of the old rate, the period changes after it
+    scheduler.set_frame_rate(10)
+    assert scheduler.deadline_ns(3)==1500000000
+    assert scheduler.deadline_ns(4)==1600000000
+    assert scheduler.deadline_ns(13)==2500000000
+
+def test_set_frame_rate_before_the_first_tick_keeps_the_start():
+    scheduler = DeadlineScheduler(frame_rate=2)
+    scheduler.start(start_ns=0)
+    scheduler.set_frame_rate(10)
+    assert scheduler.deadline_ns(0)==0
+    assert scheduler.deadline_ns(1)==100000000
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+
+from lib.session import parse_frame_names, SessionIndex
+
+IMG_FORMATS = ('.tif', '.png')
+
+def test_parse_frame_names():
+    indices, time_stamps = parse_frame_names(np.array(['000012_2024-01-01_13hr-05min-07.250000sec.tif',
+                                                        '1234567_2024-12-31_23hr-59min-59.999999sec.tif',
+                                                        'snapshot.tif',
+                                                        '000003_no_time_stamp.tif']))
+    assert indices.tolist()==[12, 1234567, -1, 3]
+    assert time_stamps[0]==np.datetime64('2024-01-01T13:05:07.250000')
+    assert time_stamps[1]==np.datetime64('2024-12-31T23:59:59.999999')
+    assert np.isnat(time_stamps[2]) and np.isnat(time_stamps[3])
+
+def test_parse_no_names():
+    indices, time_stamps = parse_frame_names(np.array([], dtype=str))
+    assert len(indices)==0 and len(time_stamps)==0
+
+def _touch(path: str, names):
+    os.makedirs(path, exist_ok=True)
+    for name in names:
+        open(os.path.join(path, name), 'w').close()
+
+def test_index_orders_by_index_and_numbers_unindexed_images_last(tmp_path):
+    path = str(tmp_path / 'Exp_0000')
+    _touch(path, ['b.png', '000005_2024-01-01_00hr-00min-05.000000sec.tif', 'a.tif', 'notes.txt',
+                    '000000_2024-01-01_00hr-00min-00.000000sec.tif'])
+
+    index = SessionIndex.scan(path, IMG_FORMATS)
+    assert index.img_names.tolist()==['000000_2024-01-01_00hr-00min-00.000000sec.tif',
+                                        '000005_2024-01-01_00hr-00min-05.000000sec.tif', 'a.tif', 'b.png']
+    # unindexed images follow the largest recorded index, so they never collide with a recorded frame
+    assert index.indices.tolist()==[0, 5, 6, 7]
+    assert index.time_stamp(1).second==5
+    assert index.time_stamp(2) is None
+
+def test_index_without_recorded_indices(tmp_path):
+    path = str(tmp_path / 'Exp_0000')
+    _touch(path, ['c.tif', 'a.tif', 'b.tif'])
+    index = SessionIndex.scan(path, IMG_FORMATS)
+    assert index.img_names.tolist()==['a.tif', 'b.tif', 'c.tif']
+    assert index.indices.tolist()==[0, 1, 2]
+
+def test_cached_index_is_invalidated_by_a_new_image(tmp_path):
+    path = str(tmp_path / 'Exp_0000')
+    _touch(path, ['000001_2024-01-01_00hr-00min-01.000000sec.tif'])
+    assert len(SessionIndex.load(path, IMG_FORMATS))==1
+    assert os.path.isfile(f'{path}.index.npz')
+
+    _touch(path, ['000002_2024-01-01_00hr-00min-02.000000sec.tif'])
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1)) # coarse mtime of some file systems
+    index = SessionIndex.load(path, IMG_FORMATS)
+    assert index.indices.tolist()==[1, 2]
@@ -0,0 +1,49 @@
+import numpy as np
+
+from lib.utils import find_circles, find_circle
+
+def _normal_equation_circle(dlc_output: np.ndarray):
+    # per-frame solution before the batched fitting, c^ = (A'A)^-1(A'b)
+    coords = dlc_output[:, :-1]
+    A = np.concatenate([np.ones((coords.shape[0], 1)), coords], axis=1)
+    b = (coords**2).sum(axis=1)
+    c = np.linalg.inv(A.T.dot(A)).dot(A.T).dot(b)
+    xc, yc = c[1] / 2, c[2] / 2
+    return np.array([xc, yc]), np.sqrt(c[0] + xc**2 + yc**2) * 2
+
+def _key_points(centers: np.ndarray, diameters: np.ndarray, num_points: int, noise: float, rng) -> np.ndarray:
+    theta = rng.uniform(0, 2 * np.pi, (len(centers), num_points))
+    coords = centers[:, None] + diameters[:, None, None] / 2 * np.stack([np.cos(theta), np.sin(theta)], axis=2)
+    coords += rng.normal(0, noise, coords.shape)
+    probabilities = rng.uniform(0.5, 1, (len(centers), num_points, 1))
+    return np.concatenate([coords, probabilities], axis=2)
+
+def test_find_circles_matches_the_per_frame_solution():
+    rng = np.random.RandomState(0)
+    centers = rng.uniform(100, 500, (64, 2))
+    diameters = rng.uniform(20, 80, 64)
+    dlc_outputs = _key_points(centers, diameters, 8, 0.5, rng)
+
+    fitted_centers, fitted_diameters, probabilities, residuals = find_circles(dlc_outputs)
+    for frame, dlc_output in enumerate(dlc_outputs):
+        center, diameter = _normal_equation_circle(dlc_output)
+        assert np.allclose(fitted_centers[frame], center, atol=1e-6)
+        assert np.isclose(fitted_diameters[frame], diameter, atol=1e-6)
+    assert np.allclose(probabilities, dlc_outputs[:, :, 2].mean(axis=1))
+    assert np.all(residuals < 2)
+
+def test_find_circles_is_exact_on_a_circle():
+    rng = np.random.RandomState(1)
+    dlc_outputs = _key_points(np.array([[320.0, 240.0]]), np.array([50.0]), 8, 0, rng)
+    centers, diameters, _, residuals = find_circles(dlc_outputs)
+    assert np.allclose(centers[0], [320, 240])
+    assert np.isclose(diameters[0], 50)
+    assert residuals[0] < 1e-9
+
+def test_find_circle_is_a_batch_of_one():
+    rng = np.random.RandomState(2)
+    dlc_output = _key_points(np.array([[60.0, 80.0]]), np.array([30.0]), 6, 0.3, rng)[0]
+    center, diameter, probability, num_points = find_circle(dlc_output)
+    centers, diameters, probabilities, _ = find_circles(dlc_output[None])
+    assert np.allclose(center, centers[0]) and np.isclose(diameter, diameters[0])
+    assert np.isclose(probability, probabilities[0]) and num_points==6
@@ -0,0 +1,116 @@
+import os, csv, time
+import multiprocessing
+import numpy as np
+from typing import List, Tuple
+
+from lib import workqueue
+from lib.workqueue import WorkQueue, run_worker
+
+FRAMES = 300
+CHUNK_SIZE = 25
+LEASE_TIMEOUT = 2.0
+
+class FakeDLCLive():
+    '''
+    4 key points on a circle whose diameter is the image index, so every row can be checked
+    '''
+    def get_pose(self, img: np.ndarray) -> np.ndarray:
+        radius = float(img[0]) / 2
+        return np.array([[radius, 0, 0.9], [0, radius, 0.9], [-radius, 0, 0.9], [0, -radius, 0.9]])
+
+def _decode(path: str) -> np.ndarray:
+    return np.array([int(os.path.basename(path)[:6])])
+
+class CoordinatorCrash(Exception):
+    pass
+
+def _init_worker(model_path: str):
+    from lib import extraction
+    extraction._dlclive = FakeDLCLive()
+
+def _patch_worker(setattr=setattr):
+    # the model and the decoder are replaced in the worker process, no GPU or image library is needed
+    from lib import extraction
+    setattr(extraction, 'DECODERS', dict(extraction.DECODERS, skimage=_decode))
+    setattr(extraction, '_init_worker', _init_worker)
+
+def _worker(root: str, name: str):
+    _patch_worker()
+    run_worker(root, name, lease_timeout=LEASE_TIMEOUT, poll_interval=0.2)
+
+def _crashing_worker(root: str, name: str):
+    # claims a shard and hangs until it is killed, its lease expires
+    WorkQueue(root, LEASE_TIMEOUT).claim(name)
+    time.sleep(3600)
+
+def _make_session(path: str, frames: int):
+    os.makedirs(path)
+    for idx in range(frames):
+        open(os.path.join(path, f'{idx:06d}_2024-01-01_00hr-00min-{idx % 60:02d}.000000sec.tif'), 'w').close()
+
+def _make_queue(tmp_path) -> Tuple[str, List[str]]:
+    model = tmp_path / 'model'
+    model.mkdir()
+    (model / 'pose_cfg.yaml').write_text('fake model')
+    sessions = [str(tmp_path / f'Exp_{number:04d}') for number in range(2)]
+    for session in sessions:
+        _make_session(session, FRAMES)
+
+    root = str(tmp_path / 'queue')
+    WorkQueue.create(root, str(model), sessions, chunk_size=CHUNK_SIZE, decoder='skimage', lease_timeout=LEASE_TIMEOUT)
+    return root, sessions
+
+def _read_indices(session: str) -> np.ndarray:
+    with open(f'{session}.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        assert abs(float(row['diameter']) - int(row['index'])) < 1e-6
+    return np.array([int(row['index']) for row in rows])
+
+def test_workers_recover_a_killed_worker(tmp_path):
+    root, sessions = _make_queue(tmp_path)
+    context = multiprocessing.get_context('spawn')
+
+    crashed = context.Process(target=_crashing_worker, args=(root, 'crashed'))
+    crashed.start()
+    deadline = time.time() + 30
+    while (not os.listdir(os.path.join(root, 'claimed'))) and (time.time() < deadline):
+        time.sleep(0.05)
+    crashed.kill()
+    crashed.join()
+
+    workers = [context.Process(target=_worker, args=(root, f'worker{number}')) for number in range(3)]
+    for worker in workers:
+        worker.start()
+    stats = WorkQueue(root, LEASE_TIMEOUT).wait(poll_interval=0.2)
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode==0
+
+    assert all(session['state']=='done' for session in stats['sessions'].values())
+    for session in sessions:
+        assert np.array_equal(_read_indices(session), np.arange(FRAMES))
+
+def test_merge_after_coordinator_crash(tmp_path, monkeypatch):
+    root, sessions = _make_queue(tmp_path)
+    _patch_worker(monkeypatch.setattr)
+    run_worker(root, 'worker', lease_timeout=LEASE_TIMEOUT, poll_interval=0.2)
+
+    # the coordinator crashes after the CSV file is written, before the session is marked as merged
+    write_atomic = workqueue._write_atomic
+    def _crash(path: str, data: bytes):
+        if os.sep + 'merged' + os.sep in path:
+            raise CoordinatorCrash(path)
+        write_atomic(path, data)
+    monkeypatch.setattr(workqueue, '_write_atomic', _crash)
+    try:
+        WorkQueue(root, LEASE_TIMEOUT).merge()
+    except CoordinatorCrash:
+        pass
+    monkeypatch.setattr(workqueue, '_write_atomic', write_atomic)
+
+    work_queue = WorkQueue(root, LEASE_TIMEOUT)
+    work_queue.merge()
+    assert work_queue.finished
+    for session in sessions:
+        assert np.array_equal(_read_indices(session), np.arange(FRAMES))
@@ -0,0 +1,54 @@
+import csv
+import numpy as np
+
+from lib.writers import PupilTableWriter
+
+def _row(index: int) -> dict:
+    return {'index' : index, 'img_name' : f'{index:06d}.tif', 'time_stamp' : '' if index==2 else f'2024-01-01_00:00:{index:02d}.000000',
+            'diameter' : '' if index==3 else index * 1.5, 'probability' : 0.9}
+
+def _read_csv(path: str) -> list:
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def test_table_writes_csv_and_npz(tmp_path):
+    path, npz_path = str(tmp_path / 'Exp_0000.csv'), str(tmp_path / 'Exp_0000.npz')
+    table = PupilTableWriter(path, flush_rows=4, flush_interval=3600, npz_path=npz_path)
+    for index in range(10):
+        table.append(_row(index))
+    assert len(table)==10
+    table.close()
+
+    rows = _read_csv(path)
+    assert [int(row['index']) for row in rows]==list(range(10))
+    assert rows[3]['diameter']=='nan' and rows[2]['time_stamp']==''
+    with np.load(npz_path) as npz:
+        assert npz['index'].dtype==np.int64 and npz['index'].tolist()==list(range(10))
+        assert np.isnan(npz['diameter'][3])
+        assert np.allclose(np.delete(npz['diameter'], 3), np.delete(np.arange(10) * 1.5, 3))
+        assert npz['img_name'].tolist()==[f'{index:06d}.tif' for index in range(10)]
+        assert npz['time_stamp'][2]==''
+
+def test_resume_drops_the_rows_after_the_checkpoint(tmp_path):
+    path, npz_path = str(tmp_path / 'Exp_0000.csv'), str(tmp_path / 'Exp_0000.npz')
+    checkpoints = []
+    table = PupilTableWriter(path, flush_rows=3, flush_interval=3600, npz_path=npz_path,
+                                on_flush=lambda rows, csv_bytes: checkpoints.append(csv_bytes))
+    for index in range(8): # 2 flushes, the rows 6, 7 are still buffered
+        table.append(_row(index))
+    # the process is killed after a row reaches the file, before it is checkpointed
+    table._writer.writerows([[6, 'lost', '', '', 0.9]])
+    table._file.close()
+
+    table = PupilTableWriter(path, flush_rows=3, flush_interval=3600, npz_path=npz_path, resume_from=checkpoints[-1])
+    for index in range(6, 10):
+        table.append(_row(index))
+    table.close()
+
+    rows = _read_csv(path)
+    assert [int(row['index']) for row in rows]==list(range(10))
+    assert all(row['img_name']!='lost' for row in rows)
+    with np.load(npz_path) as npz: # the rows of the previous run are read back from the CSV file
+        assert npz['index'].tolist()==list(range(10))
+        assert np.isnan(npz['diameter'][3]) and np.isclose(npz['diameter'][9], 13.5)
+        assert npz['time_stamp'][2]=='' and npz['time_stamp'][4]=='2024-01-01_00:00:04.000000'